@@ -10,6 +10,7 @@ import torch
 
 from nanochat.common import get_base_dir
 from nanochat.gpt import GPT, GPTConfig
+from nanochat.quantize import quantize_model
 from nanochat.tokenizer import get_tokenizer
 from nanochat.common import setup_default_logging
 
@@ -58,10 +59,12 @@ def save_checkpoint(checkpoint_dir, step, model_data, optimizer_data, meta_data,
         torch.save(optimizer_data, optimizer_path)
         logger.info(f"Saved optimizer state to: {optimizer_path}")
 
-def load_checkpoint(checkpoint_dir, step, device, load_optimizer=False, rank=0):
+def load_checkpoint(checkpoint_dir, step, device, load_optimizer=False, rank=0, load_model=True):
     # Load the model state
-    model_path = os.path.join(checkpoint_dir, f"model_{step:06d}.pt")
-    model_data = torch.load(model_path, map_location=device)
+    model_data = None
+    if load_model:
+        model_path = os.path.join(checkpoint_dir, f"model_{step:06d}.pt")
+        model_data = torch.load(model_path, map_location=device)
     # Load the optimizer state if requested
     optimizer_data = None
     if load_optimizer:
@@ -74,16 +77,29 @@ def load_checkpoint(checkpoint_dir, step, device, load_optimizer=False, rank=0):
     return model_data, optimizer_data, meta_data
 
 
-def build_model(checkpoint_dir, step, device, phase):
+def quantized_model_path(checkpoint_dir, step, quantize):
+    return os.path.join(checkpoint_dir, f"model_{step:06d}_{quantize}.pt")
+
+def build_model(checkpoint_dir, step, device, phase, quantize=None):
     """
     A bunch of repetitive code to build a model from a given checkpoint.
+    With quantize ("int8" or "int4", see nanochat/quantize.py), the big linear layers get quantized
+    weights, loaded straight from the quantized checkpoint if one was saved, else quantized on the fly.
     Returns:
     - base model - uncompiled, not wrapped in DDP
     - tokenizer
     - meta data saved during base model training
     """
     assert phase in ["train", "eval"], f"Invalid phase: {phase}"
-    model_data, optimizer_data, meta_data = load_checkpoint(checkpoint_dir, step, device, load_optimizer=False)
+    assert quantize is None or phase == "eval", "Quantized models are for inference only"
+    quantized_path = quantized_model_path(checkpoint_dir, step, quantize) if quantize is not None else None
+    is_quantized = quantized_path is not None and os.path.exists(quantized_path)
+    if is_quantized:
+        log0(f"Loading {quantize} quantized model from {quantized_path}")
+        _, _, meta_data = load_checkpoint(checkpoint_dir, step, device, load_optimizer=False, load_model=False)
+        model_data = torch.load(quantized_path, map_location=device)
+    else:
+        model_data, optimizer_data, meta_data = load_checkpoint(checkpoint_dir, step, device, load_optimizer=False)
     if device.type in {"cpu", "mps"}:
         # Convert bfloat16 tensors to float for CPU inference
         model_data = {
@@ -101,8 +117,14 @@ def build_model(checkpoint_dir, step, device, phase):
         model = GPT(model_config)
     # Load the model state
     model.to_empty(device=device)
-    model.init_weights() # note: this is dumb, but we need to init the rotary embeddings. TODO: fix model re-init
+    # note: the weights all come from the checkpoint below, this is only for the rotary embeddings: it looks up (or builds)
+    # the rotary tables of this device, which are shared by all models and lock guarded (see rotary_embeddings in gpt.py). TODO: fix model re-init
+    model.init_weights()
+    if is_quantized:
+        quantize_model(model, quantize, empty=True)
     model.load_state_dict(model_data, strict=True, assign=True)
+    if quantize is not None and not is_quantized:
+        quantize_model(model, quantize)
     # Put the model in the right training phase / mode
     if phase == "eval":
         model.eval()
@@ -137,16 +159,19 @@ def find_largest_model(checkpoints_dir):
 
 def find_last_step(checkpoint_dir):
     # Look into checkpoint_dir and find model_<step>.pt with the highest step
+    # (quantized models are saved as model_<step>_<quantize>.pt, skip those)
     checkpoint_files = glob.glob(os.path.join(checkpoint_dir, "model_*.pt"))
-    if not checkpoint_files:
+    steps = [int(match.group(1)) for f in checkpoint_files if (match := re.fullmatch(r"model_(\d+)\.pt", os.path.basename(f)))]
+    if not steps:
         raise FileNotFoundError(f"No checkpoints found in {checkpoint_dir}")
-    last_step = int(max(os.path.basename(f).split("_")[-1].split(".")[0] for f in checkpoint_files))
+    last_step = max(steps)
     return last_step
 
 # -----------------------------------------------------------------------------
 # convenience functions that take into account nanochat's directory structure
 
-def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=None):
+def find_checkpoint(checkpoints_dir, model_tag=None, step=None):
+    """Resolve the checkpoint directory and step, defaulting to the largest model and its last step."""
     if model_tag is None:
         # guess the model tag by defaulting to the largest model
         model_tag = find_largest_model(checkpoints_dir)
@@ -156,17 +181,30 @@ def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=Non
         # guess the step by defaulting to the last step
         step = find_last_step(checkpoint_dir)
     assert step is not None, f"No checkpoints found in {checkpoint_dir}"
+    return checkpoint_dir, step
+
+def load_model_from_dir(checkpoints_dir, device, phase, model_tag=None, step=None, quantize=None):
+    checkpoint_dir, step = find_checkpoint(checkpoints_dir, model_tag, step)
     # build the model
     log0(f"Loading model from {checkpoint_dir} with step {step}")
-    model, tokenizer, meta_data = build_model(checkpoint_dir, step, device, phase)
+    model, tokenizer, meta_data = build_model(checkpoint_dir, step, device, phase, quantize=quantize)
     return model, tokenizer, meta_data
 
-def load_model(source, *args, **kwargs):
+def get_checkpoints_dir(source):
     model_dir = {
         "base": "base_checkpoints",
         "sft": "chatsft_checkpoints",
         "rl": "chatrl_checkpoints",
     }[source]
     base_dir = get_base_dir()
-    checkpoints_dir = os.path.join(base_dir, model_dir)
-    return load_model_from_dir(checkpoints_dir, *args, **kwargs)
+    return os.path.join(base_dir, model_dir)
+
+def load_model(source, *args, **kwargs):
+    return load_model_from_dir(get_checkpoints_dir(source), *args, **kwargs)
+
+def save_quantized_model(model, source, quantize, model_tag=None, step=None):
+    """Save the state of a model quantized with quantize_model next to its checkpoint, load_model(..., quantize=...) picks it up."""
+    checkpoint_dir, step = find_checkpoint(get_checkpoints_dir(source), model_tag, step)
+    quantized_path = quantized_model_path(checkpoint_dir, step, quantize)
+    torch.save(model.state_dict(), quantized_path)
+    logger.info(f"Saved {quantize} quantized model to: {quantized_path}")
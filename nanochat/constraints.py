@@ -0,0 +1,79 @@
+"""
+Constrained decoding: restrict the generated text to a regular expression.
+
+A constraint maps the text generated so far to the set of tokens that may come next: the tokens
+whose text keeps it a prefix of some match (partial matching of the regex module). The Engine masks
+all other tokens out of the logits before sampling, and allows <|assistant_end|> once the text is
+a full match. So the output always matches, and generation ends as soon as nothing else could.
+
+RegexConstraint(tokenizer, vocab_size, r"#### -?[0-9]+") # a GSM8K style final answer
+choice_constraint(tokenizer, vocab_size, ["A", "B", "C", "D"]) # a multiple choice letter
+
+Notes:
+- The masks are computed once per distinct generated text and cached (LRU, max_states of them).
+  The vocab is grouped by the first character of each token, so only the groups whose first
+  character can follow are checked token by token.
+- Tokens are matched by their individual decoded text, special tokens and tokens that aren't
+  valid UTF-8 on their own are never allowed.
+"""
+
+from collections import OrderedDict
+import regex
+import torch
+
+_token_texts = {} # (tokenizer id, vocab_size) -> [text of every token, None if it can't be constrained]
+
+def token_texts(tokenizer, vocab_size):
+    """The decoded text of every token id (None for special, empty and partial UTF-8 tokens), computed once per tokenizer."""
+    key = (id(tokenizer), vocab_size)
+    if key not in _token_texts:
+        special = {tokenizer.encode_special(name) for name in tokenizer.get_special_tokens()} if hasattr(tokenizer, "get_special_tokens") else set()
+        texts = []
+        for token in range(vocab_size):
+            text = tokenizer.decode([token]) if token not in special else ""
+            texts.append(text if text and "\ufffd" not in text else None)
+        _token_texts[key] = texts
+    return _token_texts[key]
+
+class RegexConstraint:
+
+    def __init__(self, tokenizer, vocab_size, pattern, max_states=1024):
+        self.pattern = regex.compile(pattern)
+        self.vocab_size = vocab_size
+        self.max_states = max_states
+        self.masks = OrderedDict() # generated text -> allowed tokens (vocab_size,) bool, LRU
+        # Token ids and texts grouped by their first character
+        self.groups = {}
+        for token, text in enumerate(token_texts(tokenizer, vocab_size)):
+            if text is not None:
+                ids, texts = self.groups.setdefault(text[0], ([], []))
+                ids.append(token)
+                texts.append(text)
+
+    def can_continue(self, text):
+        """Whether text is a prefix of a match."""
+        return self.pattern.fullmatch(text, partial=True) is not None
+
+    def is_complete(self, text):
+        return self.pattern.fullmatch(text) is not None
+
+    def allowed(self, text):
+        """The tokens (a (vocab_size,) bool mask on the CPU) that may follow the generated text."""
+        mask = self.masks.get(text)
+        if mask is not None:
+            self.masks.move_to_end(text)
+            return mask
+        allowed_ids = []
+        for first_char, (ids, texts) in self.groups.items():
+            if self.can_continue(text + first_char):
+                allowed_ids.extend(token for token, token_text in zip(ids, texts) if self.can_continue(text + token_text))
+        mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+        mask[allowed_ids] = True
+        self.masks[text] = mask
+        if len(self.masks) > self.max_states:
+            self.masks.popitem(last=False)
+        return mask
+
+def choice_constraint(tokenizer, vocab_size, choices, **kwargs):
+    """A constraint to exactly one of the given strings."""
+    return RegexConstraint(tokenizer, vocab_size, "|".join(regex.escape(choice) for choice in choices), **kwargs)
@@ -0,0 +1,47 @@
+"""
+A torch.compile'd single token decode step, for the Engine and the Scheduler.
+
+Every decode step runs the whole model on one token per row. In eager mode that is mostly
+Python: per layer dispatch, rotary/window bookkeeping and (in the SDPA fallback) a host sync
+to find the cache positions. Compiled, the step is one graph per shape without any of that.
+
+To keep the shapes static (one compilation each, no recompiles as generation goes on):
+- Batches are padded up to a bucket (powers of two up to the batch size of the KV cache).
+  The padding rows are the next rows of the cache: whatever they hold (finished rows, free rows,
+  a row being prefilled) only gets a write at its own position, and their positions are restored.
+- The KV caches are allocated at full length instead of growing (see Engine.new_kv_cache).
+- Under compilation the SDPA fallback attends over the whole cache, masked per row (FA3 is unaffected).
+
+Paged caches are decoded eagerly: their free rows point at page 0, which padding would overwrite.
+
+engine = Engine(model, tokenizer, compile_decode=True)
+engine.warmup(batch_size=8) # compile all buckets up front, not on the first requests
+"""
+
+import torch
+
+class DecodeStep:
+
+    def __init__(self, model, mode=None, backend="inductor"):
+        self.model = model
+        self.step = torch.compile(self._step, dynamic=False, mode=mode, backend=backend)
+
+    def _step(self, ids, kv_cache):
+        return self.model.forward(ids, kv_cache=kv_cache)[:, -1, :]
+
+    @staticmethod
+    def buckets(batch_size):
+        """The padded batch sizes for a KV cache of batch_size rows: powers of two, and batch_size itself."""
+        return sorted({1 << i for i in range(batch_size.bit_length()) if 1 << i < batch_size} | {batch_size})
+
+    def __call__(self, ids, kv_cache):
+        """Logits (n, vocab_size) of the next token after ids (n, 1), for the first n rows of kv_cache."""
+        n = ids.size(0)
+        bucket = next(b for b in self.buckets(kv_cache.batch_size) if b >= n)
+        if bucket > n:
+            ids = torch.cat([ids, ids.new_zeros(bucket - n, 1)])
+            positions = kv_cache.cache_seqlens[n:bucket].clone()
+        logits = self.step(ids, kv_cache.narrow(0, bucket))
+        if bucket > n:
+            kv_cache.cache_seqlens[n:bucket] = positions # the padding rows didn't really advance
+        return logits[:n].clone() # the next step may reuse the output memory (CUDA graphs)
@@ -11,42 +11,56 @@ Notes:
 The whole thing is made as efficient as possible.
 """
 
+import copy
+import time
+import queue
+import threading
 import torch
 import torch.nn.functional as F
-import signal
 import warnings
-from contextlib import contextmanager
-from collections import deque
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError, wait as futures_wait
 from nanochat.common import compute_init, autodetect_device_type
 from nanochat.checkpoint_manager import load_model
+from nanochat.session import model_fingerprint, restore_session, save_session
+from nanochat.decode_step import DecodeStep
+from nanochat.flash_attention import HAS_FA3
 from contextlib import nullcontext
 
 # -----------------------------------------------------------------------------
 # Calculator tool helpers
-@contextmanager
-def timeout(duration, formula):
-    def timeout_handler(signum, frame):
-        raise Exception(f"'{formula}': timed out after {duration} seconds")
+# Expressions are evaluated on a small thread pool with deadline based timeouts, which (unlike
+# signal.alarm) works from any thread and lets the decode loop carry on while a tool call runs.
+# Python can't kill a thread: an expression that runs past its deadline is abandoned, but keeps
+# its pool thread busy until it finishes.
 
-    signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(duration)
-    yield
-    signal.alarm(0)
+_calculator_pool = None
 
-def eval_with_timeout(formula, max_time=3):
+def calculator_pool():
+    global _calculator_pool
+    if _calculator_pool is None:
+        _calculator_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="calculator")
+    return _calculator_pool
+
+def eval_formula(formula):
     try:
-        with timeout(max_time, formula):
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore", SyntaxWarning)
-                return eval(formula, {"__builtins__": {}}, {})
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", SyntaxWarning)
+            return eval(formula, {"__builtins__": {}}, {})
     except Exception as e:
-        signal.alarm(0)
         # print(f"Warning: Failed to eval {formula}, exception: {e}") # it's ok ignore wrong calculator usage
         return None
 
-def use_calculator(expr):
+def eval_with_timeout(formula, max_time=3):
+    future = calculator_pool().submit(eval_formula, formula)
+    try:
+        return future.result(timeout=max_time)
+    except FuturesTimeoutError:
+        return None
+
+def calculator_formula(expr):
     """
-    Evaluate a Python expression safely.
+    Check that expr is something the calculator supports, returns the formula to evaluate (or None).
     Supports both math expressions and string operations like .count()
     """
     # Remove commas from numbers
@@ -56,7 +70,7 @@ def use_calculator(expr):
     if all([x in "0123456789*+-/.() " for x in expr]):
         if "**" in expr:  # disallow power operator
             return None
-        return eval_with_timeout(expr)
+        return expr
 
     # Check if it's a string operation we support
     # Allow: strings (single/double quotes), .count(), letters, numbers, spaces, parens
@@ -75,11 +89,93 @@ def use_calculator(expr):
     # Only allow .count() method for now (can expand later)
     if '.count(' not in expr:
         return None
+    return expr
+
+def use_calculator(expr):
+    """Evaluate a Python expression safely (blocking), None if it's not supported, fails or times out."""
+    formula = calculator_formula(expr)
+    return eval_with_timeout(formula) if formula is not None else None
+
+class ToolCall:
+    """
+    A calculator call running in the background. The row that made it waits for the result
+    (which becomes forced tokens), while the other rows keep decoding.
+    """
+    def __init__(self, expr, max_time=3):
+        self.formula = calculator_formula(expr)
+        self.future = calculator_pool().submit(eval_formula, self.formula) if self.formula is not None else None
+        self.deadline = time.monotonic() + max_time
+        self.timed_out = False
+
+    def done(self):
+        return self.future is None or self.future.done() or time.monotonic() >= self.deadline
+
+    def result(self):
+        """The result, None if the call failed or missed its deadline. Blocks until one or the other."""
+        if self.future is None:
+            return None
+        try:
+            return self.future.result(timeout=max(0.0, self.deadline - time.monotonic()))
+        except FuturesTimeoutError:
+            self.timed_out = True
+            return None
+
+class ToolCache:
+    """
+    Bounded LRU of calculator results: normalized formula -> token ids of the result (an empty
+    tuple if it has none). RL rollouts and evals make the same tool calls over and over, a hit
+    costs a dict lookup instead of an eval plus an encode. Thread-safe.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(formula):
+        # spaces only matter inside string literals, which pure math expressions don't have
+        return formula.replace(" ", "") if all(x in "0123456789*+-/.() " for x in formula) else formula.strip()
+
+    def get(self, formula):
+        """The cached result tokens of formula, None on a miss."""
+        key = self.key(formula)
+        with self.lock:
+            result_tokens = self.entries.get(key)
+            if result_tokens is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result_tokens
 
-    # Evaluate with timeout
-    return eval_with_timeout(expr)
+    def put(self, formula, result_tokens):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[self.key(formula)] = tuple(result_tokens)
+            self.entries.move_to_end(self.key(formula))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+def wait_tool_calls(calls):
+    """Block until one of the tool calls is done (has a result or ran out of time)."""
+    if any(call.done() for call in calls):
+        return
+    timeout = min(call.deadline for call in calls) - time.monotonic()
+    futures_wait([call.future for call in calls], timeout=max(0.0, timeout), return_when=FIRST_COMPLETED)
 
 # -----------------------------------------------------------------------------
+def kv_dtype(model):
+    """The dtype a model computes keys and values in: the autocast dtype if autocast is on, else that of its weights."""
+    device_type = model.get_device().type
+    if torch.is_autocast_enabled(device_type):
+        return torch.get_autocast_dtype(device_type)
+    # Keys and values come out of the attention projections (the embeddings may be stored in another dtype)
+    linears = [m for m in model.modules() if isinstance(m, torch.nn.Linear)] if isinstance(model, torch.nn.Module) else []
+    return linears[0].weight.dtype if linears else torch.float32
+
 class KVCache:
     """
     KV Cache designed for Flash Attention 3's flash_attn_with_kvcache API.
@@ -88,19 +184,38 @@ class KVCache:
     - Tensors are (B, T, H, D) not (B, H, T, D)
     - FA3 updates the cache in-place during flash_attn_with_kvcache
     - Position tracked per batch element via cache_seqlens tensor
+
+    With window_sizes (the left window of every layer, -1 = full context), the sliding window
+    layers whose window + 1 is shorter than seq_len only keep a ring buffer of window + 1 slots,
+    where position p lives in slot p % (window + 1). The layers then have different lengths, so
+    they are held in per-layer lists k_layers/v_layers instead of the 5D k_cache/v_cache.
+    Positions that fell out of a ring can't be read back (read_row), nor rolled back to.
+
+    With a capacity, only that many positions are allocated up front and the cache grows
+    geometrically (up to seq_len, the ring buffers up to their ring size) when callers reserve() more
+    room before running the model. Short requests then don't pay for the full context length (nor
+    the full windows) in memory and zero-fill time.
     """
 
-    def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers, device, dtype):
+    def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers, device, dtype, window_sizes=None, capacity=None):
         self.batch_size = batch_size
         self.max_seq_len = seq_len
         self.n_layers = num_layers
         self.n_heads = num_heads
         self.head_dim = head_dim
-        # Pre-allocate cache tensors: (n_layers, B, T, H, D)
-        self.k_cache = torch.zeros(num_layers, batch_size, seq_len, num_heads, head_dim, device=device, dtype=dtype)
-        self.v_cache = torch.zeros(num_layers, batch_size, seq_len, num_heads, head_dim, device=device, dtype=dtype)
+        self.device = device
+        self.dtype = dtype
+        # Per layer ring buffer size, None for layers that keep the full length
+        window_sizes = window_sizes if window_sizes is not None else [-1] * num_layers
+        self.ring_sizes = [window + 1 if 0 <= window and window + 1 < seq_len else None for window in window_sizes]
+        self.capacity = 0 # number of positions allocated for the full length layers
+        self.k_cache = self.v_cache = None
+        self.k_layers = self.v_layers = None
+        self._grow(min(capacity, seq_len) if capacity is not None else seq_len)
         # Current sequence length per batch element (FA3 needs int32)
         self.cache_seqlens = torch.zeros(batch_size, dtype=torch.int32, device=device)
+        # Contiguous cache: no page table (see PagedKVCache)
+        self.page_table = None
 
     def reset(self):
         """Reset cache to empty state."""
@@ -112,12 +227,53 @@ class KVCache:
 
     def get_layer_cache(self, layer_idx):
         """Return (k_cache, v_cache) views for a specific layer."""
-        return self.k_cache[layer_idx], self.v_cache[layer_idx]
+        return self.k_layers[layer_idx], self.v_layers[layer_idx]
+
+    def is_ring_layer(self, layer_idx):
+        # until it has grown to its ring size, a sliding window layer holds every position like a full length one
+        size = self.ring_sizes[layer_idx]
+        return size is not None and self.k_layers[layer_idx].size(1) == size
+
+    def _grow(self, capacity):
+        """(Re)allocate the full length layers for capacity positions, keeping their contents."""
+        old_capacity, self.capacity = self.capacity, capacity
+        shape = (self.batch_size, capacity, self.n_heads, self.head_dim)
+        new_tensor = lambda shape: torch.zeros(shape, device=self.device, dtype=self.dtype)
+        if all(size is None for size in self.ring_sizes):
+            # Uniform layers: cache tensors of shape (n_layers, B, T, H, D)
+            k_cache, v_cache = new_tensor((self.n_layers, *shape)), new_tensor((self.n_layers, *shape))
+            if self.k_cache is not None:
+                k_cache[:, :, :old_capacity] = self.k_cache
+                v_cache[:, :, :old_capacity] = self.v_cache
+            self.k_cache, self.v_cache = k_cache, v_cache
+            self.k_layers, self.v_layers = list(k_cache), list(v_cache)
+            return
+        # Per layer tensors: (B, T, H, D), the ring buffers grow too but stop at their ring size.
+        # Positions below the ring size sit in slot p % size = p either way, so nothing moves when a ring fills up.
+        if self.k_layers is None:
+            self.k_layers, self.v_layers = [None] * self.n_layers, [None] * self.n_layers
+        for layer_idx, size in enumerate(self.ring_sizes):
+            length = capacity if size is None else min(capacity, size)
+            for layers in (self.k_layers, self.v_layers):
+                old = layers[layer_idx]
+                if old is None or old.size(1) < length:
+                    tensor = new_tensor((self.batch_size, length, self.n_heads, self.head_dim))
+                    if old is not None:
+                        tensor[:, :old.size(1)] = old
+                    layers[layer_idx] = tensor
 
     def advance(self, num_tokens):
         """Advance the cache position by num_tokens."""
         self.cache_seqlens += num_tokens
 
+    def _slots(self, layer_idx, start, end):
+        """Where positions [start, end) of a layer are stored: a slice, or ring slot indices for the last ring size of them."""
+        size = self.ring_sizes[layer_idx]
+        if size is None:
+            return slice(start, end), 0
+        first = max(start, end - size) # earlier positions would be overwritten anyway
+        return torch.arange(first, end, device=self.cache_seqlens.device) % size, first - start
+
     def prefill(self, other):
         """
         Copy cached KV from another cache into this one.
@@ -126,189 +282,1262 @@ class KVCache:
         assert self.get_pos() == 0, "Cannot prefill a non-empty KV cache"
         assert self.n_layers == other.n_layers and self.n_heads == other.n_heads and self.head_dim == other.head_dim
         assert self.max_seq_len >= other.max_seq_len
+        assert not any(other.ring_sizes), "Can only prefill from a cache without ring buffers"
         other_pos = other.get_pos()
-        self.k_cache[:, :, :other_pos, :, :] = other.k_cache[:, :, :other_pos, :, :]
-        self.v_cache[:, :, :other_pos, :, :] = other.v_cache[:, :, :other_pos, :, :]
+        self.reserve(0, other_pos)
+        for layer_idx in range(self.n_layers):
+            slots, skip = self._slots(layer_idx, 0, other_pos)
+            self.k_layers[layer_idx][:, slots] = other.k_layers[layer_idx][:, skip:other_pos]
+            self.v_layers[layer_idx][:, slots] = other.v_layers[layer_idx][:, skip:other_pos]
         self.cache_seqlens.fill_(other_pos)
 
+    def narrow(self, start, length):
+        """
+        Return a view of rows [start, start + length) of this cache.
+        The view shares storage (and positions) with this cache, so running the model
+        on it reads and writes these rows in place. Used to run the model on a subset of rows.
+        """
+        view = copy.copy(self)
+        view.batch_size = length
+        if self.k_cache is not None:
+            view.k_cache = self.k_cache.narrow(1, start, length)
+            view.v_cache = self.v_cache.narrow(1, start, length)
+        view.k_layers = [k.narrow(0, start, length) for k in self.k_layers]
+        view.v_layers = [v.narrow(0, start, length) for v in self.v_layers]
+        view.cache_seqlens = self.cache_seqlens.narrow(0, start, length)
+        return view
+
+    def move_row(self, src, dst, length):
+        """Move the first `length` cached positions (and the position) of row src into row dst."""
+        if self.k_cache is not None:
+            self.k_cache[:, dst, :length] = self.k_cache[:, src, :length]
+            self.v_cache[:, dst, :length] = self.v_cache[:, src, :length]
+        else:
+            for layer_idx, size in enumerate(self.ring_sizes):
+                n = length if size is None else size # ring buffers move as a whole
+                self.k_layers[layer_idx][dst, :n] = self.k_layers[layer_idx][src, :n]
+                self.v_layers[layer_idx][dst, :n] = self.v_layers[layer_idx][src, :n]
+        self.cache_seqlens[dst] = self.cache_seqlens[src]
+
+    def copy_rows(self, src, dst, start, end):
+        """
+        Copy positions [start, end) (and the position) of rows src into rows dst (lists of row indices).
+        All source rows are read before any row is written, so src and dst may overlap (e.g. beams
+        taking over each other's rows). Ring buffers are copied as a whole.
+        """
+        src = torch.tensor(src, dtype=torch.long, device=self.cache_seqlens.device)
+        dst = torch.tensor(dst, dtype=torch.long, device=self.cache_seqlens.device)
+        for layer_idx, size in enumerate(self.ring_sizes):
+            positions = slice(start, end) if size is None else slice(None)
+            for layers in (self.k_layers, self.v_layers):
+                layers[layer_idx][dst, positions] = layers[layer_idx][src, positions]
+        self.cache_seqlens[dst] = self.cache_seqlens[src]
+
+    def read_row(self, row, start, end):
+        """Return the (k, v) of positions [start, end) of row, each of shape (n_layers, end - start, H, D)."""
+        if self.k_cache is not None:
+            return self.k_cache[:, row, start:end], self.v_cache[:, row, start:end]
+        oldest = self.cache_seqlens[row].item() - min(size for size in self.ring_sizes if size is not None)
+        assert start >= oldest, f"Position {start} has fallen out of the ring buffers"
+        ks, vs = [], []
+        for layer_idx in range(self.n_layers):
+            slots, _ = self._slots(layer_idx, start, end)
+            ks.append(self.k_layers[layer_idx][row, slots])
+            vs.append(self.v_layers[layer_idx][row, slots])
+        return torch.stack(ks), torch.stack(vs)
+
+    def write_row(self, row, start, k, v):
+        """Write k, v of shape (n_layers, T, H, D) into row starting at position start."""
+        if self.k_cache is not None:
+            self.k_cache[:, row, start:start + k.size(1)] = k
+            self.v_cache[:, row, start:start + v.size(1)] = v
+            return
+        for layer_idx in range(self.n_layers):
+            slots, skip = self._slots(layer_idx, start, start + k.size(1))
+            self.k_layers[layer_idx][row, slots] = k[layer_idx, skip:]
+            self.v_layers[layer_idx][row, slots] = v[layer_idx, skip:]
+
+    def reserve(self, row, length):
+        """
+        Make sure row can hold `length` positions, growing the cache if needed (all rows grow together,
+        at least doubling to amortize the copies). Always true for a contiguous cache.
+        Views made with narrow() before a growth don't see it, make them after reserving.
+        """
+        assert length <= self.max_seq_len, f"Row length {length} exceeds the KV cache length {self.max_seq_len}"
+        if length > self.capacity:
+            self._grow(min(self.max_seq_len, max(length, 2 * self.capacity)))
+        return True
+
+    def free_row(self, row):
+        """Mark row as empty."""
+        self.cache_seqlens[row] = 0
+
+
+class PagedKVCache:
+    """
+    KV Cache where the positions of each row live in fixed-size pages that are allocated
+    on demand from a pool shared by all rows, so memory scales with the number of tokens
+    actually in use and not with batch_size * seq_len. Rows can have any length.
+
+    Layout follows the paged variant of FA3's flash_attn_with_kvcache:
+    - k_cache/v_cache pools are (n_layers, num_pages, page_size, H, D)
+    - page_table is (B, max_pages_per_row) int32, mapping a row's i-th page to a physical page
+    - cache_seqlens is (B,) int32, the length of each row
+    Page bookkeeping happens on the host: callers reserve() room in a row before running the
+    model on it and free_row() when the row is done.
+    """
+
+    def __init__(self, batch_size, num_heads, seq_len, head_dim, num_layers, device, dtype, page_size=256, num_pages=None):
+        self.batch_size = batch_size
+        self.max_seq_len = seq_len
+        self.n_layers = num_layers
+        self.n_heads = num_heads
+        self.head_dim = head_dim
+        self.dtype = dtype
+        self.page_size = page_size
+        self.max_pages_per_row = -(-seq_len // page_size)
+        # By default the pool can hold every row at full length. Pass fewer pages to cap the memory.
+        self.num_pages = num_pages if num_pages is not None else batch_size * self.max_pages_per_row
+        self.k_cache = torch.zeros(num_layers, self.num_pages, page_size, num_heads, head_dim, device=device, dtype=dtype)
+        self.v_cache = torch.zeros(num_layers, self.num_pages, page_size, num_heads, head_dim, device=device, dtype=dtype)
+        self.page_table = torch.zeros(batch_size, self.max_pages_per_row, dtype=torch.int32, device=device)
+        self.cache_seqlens = torch.zeros(batch_size, dtype=torch.int32, device=device)
+        # Host side bookkeeping of the pool
+        self.free_pages = list(range(self.num_pages - 1, -1, -1)) # pop() hands out low page ids first
+        self.row_pages = [[] for _ in range(batch_size)] # physical pages owned by each row, in order
+
+    def reset(self):
+        """Reset cache to empty state, returning all pages to the pool."""
+        for row in range(self.batch_size):
+            self.free_row(row)
+
+    def get_pos(self):
+        """Get current position (assumes all batch elements at same position)."""
+        return self.cache_seqlens[0].item()
+
+    def get_layer_cache(self, layer_idx):
+        """Return (k_cache, v_cache) page pools for a specific layer."""
+        return self.k_cache[layer_idx], self.v_cache[layer_idx]
+
+    def is_ring_layer(self, layer_idx):
+        return False
+
+    def advance(self, num_tokens):
+        """Advance the cache position by num_tokens."""
+        self.cache_seqlens += num_tokens
+
+    def num_free_tokens(self):
+        """How many more tokens the pool can take."""
+        return len(self.free_pages) * self.page_size
+
+    def reserve(self, row, length):
+        """
+        Allocate pages so that row can hold `length` positions.
+        Returns False (allocating nothing) if the pool does not have enough free pages.
+        """
+        assert length <= self.max_seq_len, f"Row length {length} exceeds the KV cache length {self.max_seq_len}"
+        pages = self.row_pages[row]
+        num_needed = -(-length // self.page_size) - len(pages)
+        if num_needed <= 0:
+            return True
+        if num_needed > len(self.free_pages):
+            return False
+        new_pages = [self.free_pages.pop() for _ in range(num_needed)]
+        self.page_table[row, len(pages):len(pages) + num_needed] = torch.tensor(new_pages, dtype=torch.int32)
+        pages.extend(new_pages)
+        return True
+
+    def _row_slots(self, row, start, end):
+        """Physical (pages, offsets) of positions [start, end) of row."""
+        positions = torch.arange(start, end, device=self.page_table.device)
+        pages = self.page_table[row].long()[positions // self.page_size]
+        return pages, positions % self.page_size
+
+    def read_row(self, row, start, end):
+        """Return the (k, v) of positions [start, end) of row, each of shape (n_layers, end - start, H, D)."""
+        pages, offsets = self._row_slots(row, start, end)
+        return self.k_cache[:, pages, offsets], self.v_cache[:, pages, offsets]
+
+    def write_row(self, row, start, k, v):
+        """Write k, v of shape (n_layers, T, H, D) into row starting at position start (pages must be reserved)."""
+        pages, offsets = self._row_slots(row, start, start + k.size(1))
+        self.k_cache[:, pages, offsets] = k
+        self.v_cache[:, pages, offsets] = v
+
+    def free_row(self, row):
+        """Return the pages of row to the pool and mark it empty."""
+        self.free_pages.extend(reversed(self.row_pages[row]))
+        self.row_pages[row] = []
+        self.page_table[row].zero_()
+        self.cache_seqlens[row] = 0
+
+    def move_row(self, src, dst, length):
+        """Move row src into (empty) row dst. Only the page table moves, no KV data is copied."""
+        assert not self.row_pages[dst], "Can only move into an empty row"
+        self.row_pages[dst], self.row_pages[src] = self.row_pages[src], []
+        self.page_table[dst] = self.page_table[src]
+        self.page_table[src].zero_()
+        self.cache_seqlens[dst] = self.cache_seqlens[src]
+        self.cache_seqlens[src] = 0
+
+    def narrow(self, start, length):
+        """
+        Return a view of rows [start, start + length) of this cache to run the model on.
+        The page pools are shared, page bookkeeping (reserve/free_row) stays with the parent cache.
+        """
+        view = copy.copy(self)
+        view.batch_size = length
+        view.page_table = self.page_table.narrow(0, start, length)
+        view.cache_seqlens = self.cache_seqlens.narrow(0, start, length)
+        view.row_pages = None
+        view.free_pages = None
+        return view
+
 # -----------------------------------------------------------------------------
+# Sampling. All rows of a batch are sampled at once, on device, each with its own settings and seed.
+# Randomness comes from a counter-based hash of (row key, step, token id) instead of a stateful
+# torch.Generator, so the sample of a row never depends on its batch mates or on the batch size.
+
+_GOLDEN = -7046029254386353131 # 0x9E3779B97F4A7C15 as int64
+
+def _mix64(x):
+    """The splitmix64 finalizer on int64 tensors (multiplications wrap around, shifts are made logical)."""
+    x = x ^ ((x >> 30) & 0x3FFFFFFFF)
+    x = x * -4658895280553007687 # 0xbf58476d1ce4e5b9
+    x = x ^ ((x >> 27) & 0x1FFFFFFFFF)
+    x = x * -7723592293110705685 # 0x94d049bb133111eb
+    x = x ^ ((x >> 31) & 0x1FFFFFFFF)
+    return x
+
+def rng_keys(seeds, streams):
+    """Random keys (int64 tensor) for rows with the given seeds and stream ids (e.g. the sample index)."""
+    return _mix64(_mix64(seeds * _GOLDEN) + streams)
+
+def _uniform(keys, step, token_ids):
+    """
+    Uniform samples in (0, 1) for the token_ids ((V,) or (B, V)) of every row, of shape (B, V).
+    A pure function of the row key (B,), step (int or (B,)) and token id, so a token draws the same
+    sample whichever other tokens are drawn with it.
+    """
+    step = torch.as_tensor(step, dtype=torch.long, device=keys.device)
+    row_keys = _mix64(keys + (step + 1) * _GOLDEN)
+    bits = _mix64(row_keys.unsqueeze(1) + (token_ids + 1) * _GOLDEN)
+    # float32 (MPS has no float64) from the top 23 bits: x + 0.5 is still exact, so the samples never round to 0 or 1
+    return (((bits >> 41) & 0x7FFFFF).float() + 0.5) / (1 << 23)
+
+def filter_logits(logits, top_k=None, top_p=None, min_p=None):
+    """
+    Mask (to -inf) the logits (B, vocab_size) outside of the top_k / top_p (nucleus) / min_p set of each row.
+    Each setting is None (off for all rows) or a tensor (B,) of per-row values, where
+    top_k <= 0, top_p >= 1 and min_p <= 0 turn the filter off for that row.
+    The logits should already be divided by the temperature, top_p and min_p depend on it.
+    """
+    vocab_size = logits.size(-1)
+    if top_k is not None or top_p is not None:
+        sorted_logits = logits.sort(dim=-1, descending=True).values
+        num_keep = torch.full((logits.size(0),), vocab_size, dtype=torch.long, device=logits.device)
+        if top_k is not None:
+            num_keep = torch.where(top_k > 0, top_k.clamp(max=vocab_size), num_keep)
+        if top_p is not None:
+            ranks = torch.arange(vocab_size, device=logits.device)
+            probs = F.softmax(sorted_logits.masked_fill(ranks >= num_keep.unsqueeze(1), float("-inf")), dim=-1)
+            # keep the smallest prefix with probability mass >= top_p (the top token is always kept)
+            in_nucleus = (probs.cumsum(dim=-1) - probs < top_p.unsqueeze(1)) | (top_p >= 1).unsqueeze(1)
+            num_keep = torch.minimum(num_keep, in_nucleus.sum(dim=-1))
+        cutoff = sorted_logits.gather(1, (num_keep - 1).unsqueeze(1))
+        logits = logits.masked_fill(logits < cutoff, float("-inf"))
+    if min_p is not None:
+        # keep the tokens with at least min_p times the probability of the most likely token
+        probs = F.softmax(logits, dim=-1)
+        logits = logits.masked_fill(probs < min_p.unsqueeze(1) * probs.max(dim=-1, keepdim=True).values, float("-inf"))
+    return logits
+
 @torch.inference_mode()
-def sample_next_token(logits, rng, temperature=1.0, top_k=None):
-    """Sample a single next token from given logits of shape (B, vocab_size). Returns (B, 1)."""
-    assert temperature >= 0.0, "temperature must be non-negative"
+def sample_tokens(logits, keys, step, temperature, top_k=None, top_p=None, min_p=None, allowed=None, num_candidates=None):
+    """
+    Sample the next token of every row from logits (B, vocab_size). Returns (B,), no host sync.
+    keys: (B,) int64 rng keys of the rows (see rng_keys), step: int or (B,) index of the token being sampled.
+    temperature: (B,) float, rows with temperature 0 are greedy. top_k, top_p, min_p: see filter_logits.
+    allowed: optional (B, vocab_size) bool mask of the tokens each row may sample (constrained decoding).
+    num_candidates: when every row has a top_k, their largest one (see sampling_params). Only that many
+    candidates per row are then filtered and drawn noise for, instead of the whole vocabulary.
+    Sampling uses the Gumbel-max trick: argmax(logits / temperature + Gumbel noise).
+    """
+    logits = logits.float()
+    if allowed is not None:
+        logits = logits.masked_fill(~allowed, float("-inf"))
+    greedy = logits.argmax(dim=-1)
+    logits = logits / temperature.clamp(min=1e-5).unsqueeze(1)
+    if num_candidates is not None and num_candidates < logits.size(-1):
+        logits, token_ids = logits.topk(num_candidates, dim=-1) # (B, num_candidates), sorted
+    else:
+        token_ids = torch.arange(logits.size(-1), device=logits.device)
+    logits = filter_logits(logits, top_k, top_p, min_p)
+    gumbel = -torch.log(-torch.log(_uniform(keys, step, token_ids)))
+    sampled = (logits + gumbel).argmax(dim=-1)
+    if token_ids.dim() == 2:
+        sampled = token_ids.gather(1, sampled.unsqueeze(1)).squeeze(1) # back to vocab ids
+    return torch.where(temperature > 0, sampled, greedy)
+
+def sampling_params(device, temperature, top_k=None, top_p=None, min_p=None):
+    """Per-row sampling settings (lists or scalars, None = off) as the tensors sample_tokens takes."""
+    rows = max((len(x) for x in (temperature, top_k, top_p, min_p) if isinstance(x, list)), default=1)
+    def as_tensor(values, off, dtype):
+        values = values if isinstance(values, list) else [values] * rows
+        values = [off if v is None else v for v in values]
+        if all(v == off for v in values):
+            return None # off for every row, skip the work
+        return torch.tensor(values, dtype=dtype, device=device)
+    top_ks = top_k if isinstance(top_k, list) else [top_k] * rows
+    return dict(
+        temperature=torch.tensor(temperature if isinstance(temperature, list) else [temperature] * rows, dtype=torch.float32, device=device),
+        top_k=as_tensor(top_k, 0, torch.long),
+        top_p=as_tensor(top_p, 1.0, torch.float32),
+        min_p=as_tensor(min_p, 0.0, torch.float32),
+        num_candidates=max(top_ks) if all(k is not None and k > 0 for k in top_ks) else None,
+    )
+
+def logits_to_probs(logits, temperature=1.0, top_k=None, top_p=None, min_p=None):
+    """The distribution sample_tokens draws from (temperature > 0), for logits (..., vocab_size) that share the same settings."""
+    params = sampling_params(logits.device, temperature, top_k, top_p, min_p)
+    flat_logits = logits.float().reshape(-1, logits.size(-1)) / temperature
+    flat_logits = filter_logits(flat_logits, params["top_k"], params["top_p"], params["min_p"])
+    return F.softmax(flat_logits, dim=-1).view(logits.shape)
+
+def token_logprobs(logits, tokens, top_logprobs=0):
+    """
+    Log-probabilities under the model (temperature 1) of tokens (B,) given logits (B, vocab_size), together with
+    the top_logprobs most likely tokens of every row. Returns a (logprob, [(token, logprob), ...]) pair per row.
+    """
+    logprobs = F.log_softmax(logits.float(), dim=-1)
+    chosen = logprobs.gather(1, tokens.view(-1, 1)).squeeze(1).tolist()
+    if top_logprobs <= 0:
+        return [(logprob, []) for logprob in chosen]
+    top_values, top_ids = logprobs.topk(top_logprobs, dim=-1)
+    return [(logprob, list(zip(ids, values))) for logprob, ids, values in zip(chosen, top_ids.tolist(), top_values.tolist())]
+
+@torch.inference_mode()
+def speculative_sample(target_logits, draft_probs, draft_tokens, rng, temperature=1.0, top_k=None, top_p=None, min_p=None):
+    """
+    Verify k draft tokens against the target model (speculative sampling, Leviathan et al. 2023).
+    target_logits: (k+1, vocab_size) target logits at the positions of the k drafts and the one after.
+    draft_probs: (k, vocab_size) the draft distributions the drafts were sampled from (None for greedy).
+    Returns the list of emitted tokens: the accepted prefix of the drafts followed by one token
+    sampled from the target (the correction of the first rejected draft, or a bonus token if all
+    were accepted). The emitted tokens are distributed exactly as if sampled from the target.
+    """
+    k = len(draft_tokens)
+    device = target_logits.device
+    drafts = torch.tensor(draft_tokens, dtype=torch.long, device=device)
     if temperature == 0.0:
-        return torch.argmax(logits, dim=-1, keepdim=True)
-    if top_k is not None and top_k > 0:
-        k = min(top_k, logits.size(-1))
-        vals, idx = torch.topk(logits, k, dim=-1)
-        vals = vals / temperature
-        probs = F.softmax(vals, dim=-1)
-        choice = torch.multinomial(probs, num_samples=1, generator=rng)
-        return idx.gather(1, choice)
+        # Greedy: accept drafts as long as they match the argmax of the target
+        target_tokens = target_logits.argmax(dim=-1)
+        accepted = (target_tokens[:k] == drafts).long().cumprod(0).sum()
+        num_accepted, next_token = torch.stack([accepted, target_tokens[accepted]]).tolist()
+        return draft_tokens[:num_accepted] + [next_token]
+    p = logits_to_probs(target_logits, temperature, top_k, top_p, min_p) # (k+1, V)
+    q = draft_probs.float()
+    # Accept draft i with probability min(1, p(d_i) / q(d_i)), stop at the first rejection
+    idx = torch.arange(k, device=device)
+    ratio = p[idx, drafts] / q[idx, drafts]
+    r = torch.rand(k, generator=rng, device=device)
+    num_accepted = int((r < ratio).long().cumprod(0).sum().item())
+    if num_accepted == k:
+        dist = p[k] # all accepted: bonus token straight from the target
     else:
-        logits = logits / temperature
-        probs = F.softmax(logits, dim=-1)
-        return torch.multinomial(probs, num_samples=1, generator=rng)
+        dist = (p[num_accepted] - q[num_accepted]).clamp(min=0) # rejected: resample from the residual
+    next_token = torch.multinomial(dist, num_samples=1, generator=rng).item()
+    return draft_tokens[:num_accepted] + [next_token]
 
 # -----------------------------------------------------------------------------
 
 class RowState:
     # Per-row state tracking during generation
-    def __init__(self, current_tokens=None):
+    def __init__(self, current_tokens=None, stop=None, constraint=None):
         self.current_tokens = current_tokens or [] # Current token sequence for this row
+        self.prompt_length = len(self.current_tokens) # Number of prompt tokens at the start of current_tokens
+        self.stop = stop or () # Stop strings, the row completes once its generated text contains one
+        self.stop_tokens = max((len(stop.encode("utf-8")) for stop in self.stop), default=0) + 1 # tail that can hold one (every token is >= 1 byte)
+        self.constraint = constraint # Optional constraint on the generated text (see nanochat.constraints)
+        self.text = "" # The generated text (only tracked with a constraint)
         self.forced_tokens = deque() # Queue of tokens to force inject
         self.in_python_block = False # Whether we are inside a python block
         self.python_expr_tokens = [] # Tokens of the current python expression
+        self.tool_call = None # ToolCall in flight, the row waits for its result
         self.completed = False # Whether this row has completed generation
 
 class Engine:
 
-    def __init__(self, model, tokenizer):
+    def __init__(self, model, tokenizer, prefix_cache=None, draft_model=None, num_draft_tokens=4, prefill_chunk_size=None, tool_cache_size=4096, compile_decode=False, compile_mode=None, ring_kv_cache=None):
         self.model = model
         self.tokenizer = tokenizer # needed for tool use
+        self.tool_cache = ToolCache(tool_cache_size) # calculator results of recent tool calls
+        self.prefix_cache = prefix_cache # optional PrefixCache, reuses the KV of previously seen prompt prefixes
+        self.draft_model = draft_model # optional small model (same tokenizer) for speculative decoding
+        self.num_draft_tokens = num_draft_tokens # number of tokens drafted per target forward
+        self.prefill_chunk_size = prefill_chunk_size # max tokens per prefill forward (None = whole prompt at once)
+        if draft_model is not None:
+            assert draft_model.config.vocab_size == model.config.vocab_size, "draft model must share the vocab"
+        # optional torch.compile'd decode step with static shapes (see nanochat.decode_step and warmup)
+        self.decode_step = DecodeStep(model, mode=compile_mode) if compile_decode else None
+        # ring buffers for the sliding window layers (see KVCache) save memory but always attend with SDPA,
+        # so by default only without FA3, where they cost nothing in speed
+        self.ring_kv_cache = ring_kv_cache if ring_kv_cache is not None else not HAS_FA3
+        self._special_tokens = None
+
+    def get_special_tokens(self):
+        """The special tokens we need to coordinate the tool use state machine (looked up once)."""
+        if self._special_tokens is None:
+            get_special = lambda s: self.tokenizer.encode_special(s)
+            self._special_tokens = {
+                "python_start": get_special("<|python_start|>"),
+                "python_end": get_special("<|python_end|>"),
+                "output_start": get_special("<|output_start|>"),
+                "output_end": get_special("<|output_end|>"),
+                "assistant_end": get_special("<|assistant_end|>"), # if sampled, ends row
+                "bos": self.tokenizer.get_bos_token_id(), # if sampled, ends row
+            }
+        return self._special_tokens
+
+    def new_kv_cache(self, batch_size, seq_len, device, dtype, page_size=None, num_pages=None, model=None, window_sizes=None, capacity=None):
+        """
+        Create an empty KVCache shaped for this model (or the given one). With a page_size, create a PagedKVCache instead.
+        With window_sizes, sliding window layers get ring buffers, with a capacity it grows on demand (see KVCache),
+        unless the decode step is compiled: that needs static shapes, so the cache is allocated at full length.
+        """
+        m = (model or self.model).config
+        capacity = capacity if self.decode_step is None else None
+        kv_kwargs = dict(
+            batch_size=batch_size,
+            num_heads=m.n_kv_head,
+            seq_len=seq_len,
+            head_dim=m.n_embd // m.n_head,
+            num_layers=m.n_layer,
+            device=device,
+            dtype=dtype,
+        )
+        if page_size is not None:
+            return PagedKVCache(page_size=page_size, num_pages=num_pages, **kv_kwargs)
+        return KVCache(window_sizes=window_sizes, capacity=capacity, **kv_kwargs)
+
+    def kv_dtype(self, model=None):
+        """The dtype the model (default: self.model) computes keys and values in, see kv_dtype."""
+        return kv_dtype(model or self.model)
+
+    def context_len(self):
+        """The longest sequence the model runs (longer than trained on with rope scaling, see GPT.set_rope_scaling)."""
+        return getattr(self.model, "context_len", self.model.config.sequence_len)
+
+    def window_sizes(self):
+        """
+        The left attention window of every layer of the model (-1 = full context), for the KV caches of this
+        Engine to keep ring buffers for the sliding window layers. None if unknown or without ring_kv_cache.
+        """
+        window_sizes = getattr(self.model, "window_sizes", None)
+        return [left for left, _ in window_sizes] if window_sizes is not None and self.ring_kv_cache else None
+
+    def decode(self, ids, kv_cache):
+        """One decode step: the logits (n, vocab_size) of the next token after ids (n, 1), for the first n rows of kv_cache."""
+        if self.decode_step is None or isinstance(kv_cache, PagedKVCache):
+            return self.model.forward(ids, kv_cache=kv_cache.narrow(0, ids.size(0)))[:, -1, :]
+        return self.decode_step(ids, kv_cache)
+
+    @torch.inference_mode()
+    def warmup(self, batch_size=1, window_sizes=None):
+        """
+        Compile the decode step for every batch bucket of a KV cache of batch_size rows ahead of time, so the
+        first requests don't wait for the compilation. Call it in the autocast context generation will run in,
+        for the cache layout it will use: the Scheduler and Engine.generate with a prefix cache or a Session
+        have no ring buffers, Engine.generate otherwise has window_sizes=self.window_sizes() and batch_size=num_samples.
+        """
+        if self.decode_step is None:
+            return
+        device = self.model.get_device()
+        kv_cache = self.new_kv_cache(batch_size, self.context_len(), device, self.kv_dtype(), window_sizes=window_sizes)
+        for bucket in DecodeStep.buckets(batch_size):
+            self.decode_step(torch.zeros(bucket, 1, dtype=torch.long, device=device), kv_cache)
+
+    def prefill(self, tokens, kv_cache, model=None):
+        """Run tokens through the model (default: self.model) into kv_cache in chunks of prefill_chunk_size, returns the last logits (1, vocab_size)."""
+        model = model or self.model
+        chunk_size = self.prefill_chunk_size or len(tokens)
+        device = model.get_device()
+        for i in range(0, len(tokens), chunk_size):
+            ids = torch.tensor([tokens[i:i + chunk_size]], dtype=torch.long, device=device)
+            logits = model.forward(ids, kv_cache=kv_cache, positions=-1)
+        return logits[:, -1, :]
+
+    def advance_row(self, state, sampled_token):
+        """
+        Choose the next token of a row (a forced token if any are queued up, else the sampled one),
+        append it to the row and run the tool use state machine. Returns (token, mask) where
+        mask is 1 if the token was sampled and 0 if it was forced.
+        """
+        special = self.get_special_tokens()
+        # Select the next token in this row
+        is_forced = len(state.forced_tokens) > 0 # are there tokens waiting to be forced in deque?
+        mask = 0 if is_forced else 1 # mask is 0 if forced, 1 if sampled
+        next_token = state.forced_tokens.popleft() if is_forced else sampled_token
+        # Update the state of this row to include the next token
+        state.current_tokens.append(next_token)
+        # On <|assistant_end|> or <|bos|>, mark the row as completed
+        if next_token == special["assistant_end"] or next_token == special["bos"]:
+            state.completed = True
+        # Stop strings are looked for in the tail of the generated text that the new token could have completed
+        if state.stop:
+            tail = self.tokenizer.decode(state.current_tokens[max(state.prompt_length, len(state.current_tokens) - state.stop_tokens):])
+            if any(stop in tail for stop in state.stop):
+                state.completed = True
+        if state.constraint is not None:
+            state.text += self.tokenizer.decode([next_token]) # token by token, like the constraint sees the vocab
+        # Handle tool logic
+        if next_token == special["python_start"]:
+            state.in_python_block = True
+            state.python_expr_tokens = []
+        elif next_token == special["python_end"] and state.in_python_block:
+            state.in_python_block = False
+            formula = calculator_formula(self.tokenizer.decode(state.python_expr_tokens)) if state.python_expr_tokens else None
+            if formula is not None:
+                result_tokens = self.tool_cache.get(formula)
+                if result_tokens is not None:
+                    self.force_tool_output(state, result_tokens)
+                else:
+                    state.tool_call = ToolCall(formula) # runs in the background, see resolve_tool_call
+            state.python_expr_tokens = []
+        elif state.in_python_block:
+            state.python_expr_tokens.append(next_token)
+        return next_token, mask
+
+    def allowed_tokens(self, states, vocab_size, device):
+        """The (B, vocab_size) bool mask of the tokens the rows may sample, None if no row is constrained."""
+        if all(state.constraint is None for state in states):
+            return None
+        assistant_end = self.get_special_tokens()["assistant_end"]
+        allowed = torch.ones(len(states), vocab_size, dtype=torch.bool)
+        for i, state in enumerate(states):
+            if state.constraint is not None:
+                mask = state.constraint.allowed(state.text)
+                allowed[i, :mask.size(0)] = mask
+                allowed[i, mask.size(0):] = False
+                # the reply may end once it matches (or at a dead end, rather than sampling from nothing)
+                allowed[i, assistant_end] = state.constraint.is_complete(state.text) or not mask.any()
+        return allowed.to(device, non_blocking=True)
+
+    def resolve_tool_call(self, state, block=False):
+        """
+        If the row's tool call is done (or block), queue its result up as forced tokens.
+        Returns True if the row can go on, False while it still waits for its tool call.
+        """
+        call = state.tool_call
+        if call is None:
+            return True
+        if not block and not call.done():
+            return False
+        state.tool_call = None
+        result = call.result()
+        result_tokens = self.tokenizer.encode(str(result)) if result is not None else []
+        if not call.timed_out: # a timeout might not happen again
+            self.tool_cache.put(call.formula, result_tokens)
+        self.force_tool_output(state, result_tokens)
+        return True
+
+    def force_tool_output(self, state, result_tokens):
+        """Queue up the result of a tool call as forced tokens (nothing if it has no result)."""
+        if result_tokens:
+            special = self.get_special_tokens()
+            state.forced_tokens.append(special["output_start"])
+            state.forced_tokens.extend(result_tokens)
+            state.forced_tokens.append(special["output_end"])
 
     @torch.inference_mode()
-    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42):
-        """Same as generate, but does single prefill and then clones the KV cache."""
+    def generate(self, tokens, num_samples=1, max_tokens=None, temperature=1.0, top_k=None, seed=42, top_p=None, min_p=None, kv_cache=None, logprobs=False, top_logprobs=0, stop=None, constraint=None):
+        """
+        Same as generate, but does single prefill and then clones the KV cache.
+        Rows that finish are dropped from the decode batch, only the live rows keep running through
+        the model. Tool calls run in the background, the row that made one waits for its result
+        while the others keep decoding.
+        Every step yields (token_column, token_masks) with one entry per sample. A row without a new token
+        this step (finished, or waiting for its tool call) has token None and mask 0. Finished rows don't
+        repeat their terminal token. With num_samples=1 the single row always has a token.
+        With a kv_cache (batch 1, no ring buffers) holding the KV of a prefix of tokens (e.g. the earlier
+        turns of a conversation, see Session), only the rest gets prefilled and decoding continues in it.
+        With logprobs, a third column holds the (logprob, top) pair of every new token (see token_logprobs,
+        top_logprobs alternatives each), computed from the logits the tokens were sampled from.
+        A row also completes once its generated text contains one of the stop strings (which is kept in
+        the output). With a constraint (see nanochat.constraints), the generated text is kept to its matches.
+        """
         assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
         device = self.model.get_device()
-        # NOTE: setting the dtype here and in this way is an ugly hack.
-        # Currently the repo assumes that cuda -> bfloat16 and everything else -> float32.
-        # We need to know the dtype here to call __init__ on KVCache and pre-allocate its tensors.
-        # As a quick hack, we're making generate() function inherit and know about this repo-wise assumption.
-        # I think there has to be a bigger refactor to deal with device/dtype tracking across the codebase.
-        # In particular, the KVCache should allocate its tensors lazily
-        dtype = torch.bfloat16 if device.type == "cuda" else torch.float32
-        rng = torch.Generator(device=device)
-        rng.manual_seed(seed)
-
-        # Get the special tokens we need to coordinate the tool use state machine
-        get_special = lambda s: self.tokenizer.encode_special(s)
-        python_start = get_special("<|python_start|>")
-        python_end = get_special("<|python_end|>")
-        output_start = get_special("<|output_start|>")
-        output_end = get_special("<|output_end|>")
-        assistant_end = get_special("<|assistant_end|>") # if sampled, ends row
-        bos = self.tokenizer.get_bos_token_id() # if sampled, ends row
+        dtype = self.kv_dtype()
+        assert temperature >= 0.0, "temperature must be non-negative"
+        assert kv_cache is None or num_samples == 1, "a given KV cache holds a single row"
+        logprobs = logprobs or top_logprobs > 0
+        if self.draft_model is not None and num_samples == 1 and kv_cache is None and not logprobs and constraint is None:
+            rng = torch.Generator(device=device)
+            rng.manual_seed(seed)
+            yield from self._generate_speculative(tokens, max_tokens, temperature, top_k, top_p, min_p, rng, device, dtype, stop)
+            return
 
         # 1) Run a batch 1 prefill of the prompt tokens
-        m = self.model.config
-        kv_model_kwargs = {"num_heads": m.n_kv_head, "head_dim": m.n_embd // m.n_head, "num_layers": m.n_layer}
-        kv_cache_prefill = KVCache(
-            batch_size=1,
-            seq_len=len(tokens),
-            device=device,
-            dtype=dtype,
-            **kv_model_kwargs,
-        )
-        ids = torch.tensor([tokens], dtype=torch.long, device=device)
-        logits = self.model.forward(ids, kv_cache=kv_cache_prefill)
-        logits = logits[:, -1, :].expand(num_samples, -1)  # (num_samples, vocab_size)
-
-        # 2) Replicate the KV cache for each sample/row
-        kv_length_hint = (len(tokens) + max_tokens) if max_tokens is not None else self.model.config.sequence_len
-        kv_cache_decode = KVCache(
-            batch_size=num_samples,
-            seq_len=kv_length_hint,
-            device=device,
-            dtype=dtype,
-            **kv_model_kwargs,
-        )
-        kv_cache_decode.prefill(kv_cache_prefill)
-        del kv_cache_prefill # no need to keep this memory around
+        # With a prefix cache, the longest cached prefix is loaded and only the rest is prefilled.
+        # The last prompt token always runs through the model, we need its logits.
+        if kv_cache is not None:
+            # Continue in the given cache: its tokens are a prefix of the prompt, e.g. the conversation so far
+            num_cached = min(kv_cache.get_pos(), len(tokens) - 1)
+            kv_cache.cache_seqlens.fill_(num_cached)
+            kv_cache.reserve(0, len(tokens))
+            logits = self.prefill(tokens[num_cached:], kv_cache)
+            kv_cache_decode = kv_cache
+        else:
+            kv_cache_prefill = self.new_kv_cache(1, len(tokens), device, dtype)
+            num_cached = self.prefix_cache.load(tokens[:-1], kv_cache_prefill) if self.prefix_cache is not None else 0
+            logits = self.prefill(tokens[num_cached:], kv_cache_prefill)
+            logits = logits.expand(num_samples, -1)  # (num_samples, vocab_size)
+            if self.prefix_cache is not None:
+                self.prefix_cache.store(tokens, kv_cache_prefill)
 
-        # 3) Initialize states for each sample
-        row_states = [RowState(tokens.copy()) for _ in range(num_samples)]
+            # 2) Replicate the KV cache for each sample/row
+            # (the full context with a compiled decode step, which compiles once per cache shape)
+            kv_length_hint = (len(tokens) + max_tokens) if max_tokens is not None and self.decode_step is None else self.context_len()
+            # Sliding window layers only keep a ring buffer of their window, unless the prefix cache needs the full history
+            window_sizes = self.window_sizes() if self.prefix_cache is None else None
+            # Only the prompt is allocated up front, the cache grows as tokens get generated
+            kv_cache_decode = self.new_kv_cache(num_samples, kv_length_hint, device, dtype, window_sizes=window_sizes, capacity=len(tokens) + 1)
+            kv_cache_decode.prefill(kv_cache_prefill)
+            del kv_cache_prefill # no need to keep this memory around
+
+        # 3) Initialize states and sampling settings for each sample (each row samples its own random stream)
+        row_states = [RowState(tokens.copy(), stop, constraint) for _ in range(num_samples)]
+        keys = rng_keys(torch.full((num_samples,), seed, dtype=torch.long, device=device), torch.arange(num_samples, device=device))
+        sampling = sampling_params(device, [temperature] * num_samples, top_k, top_p, min_p)
 
         # 4) Main generation loop
+        # Live rows sit compacted in rows [0, len(alive)) of the KV cache, logits, keys and sampling settings.
+        # Every row samples its k-th token at step k of its random stream, whenever that happens.
+        alive = list(range(num_samples)) # original index of each live row
+        num_generated = lambda row: len(row_states[row].current_tokens) - len(tokens)
+        try:
+            while alive:
+                # Rows waiting for a tool call sit the step out, unless all of them are: then wait for one
+                ready = [self.resolve_tool_call(row_states[row]) for row in alive]
+                if not any(ready):
+                    wait_tool_calls([row_states[row].tool_call for row in alive])
+                    continue
+
+                # Sample the next token for each live row
+                steps = torch.tensor([num_generated(row) for row in alive], dtype=torch.long, device=device)
+                allowed = self.allowed_tokens([row_states[row] for row in alive], logits.size(-1), device)
+                next_ids = sample_tokens(logits, keys, steps, **sampling, allowed=allowed)  # (B,)
+                sampled_tokens = next_ids.tolist() # the only host sync of the step
+
+                # Process each row: choose the next token, update state, optional tool use
+                # Rows without a new token (finished, or waiting for a tool call) get None (mask 0)
+                token_column = [None] * num_samples # contains the next token id along each row
+                token_masks = [0] * num_samples # contains the mask (was it sampled (1) or forced (0)?) along each row
+                for i, row in enumerate(alive):
+                    if ready[i]:
+                        token_column[row], token_masks[row] = self.advance_row(row_states[row], sampled_tokens[i])
+
+                # Yield the token column
+                if logprobs:
+                    chosen = torch.tensor([token_column[row] or 0 for row in alive], dtype=torch.long, device=device)
+                    row_logprobs = token_logprobs(logits, chosen, top_logprobs)
+                    logprob_column = [None] * num_samples
+                    for i, row in enumerate(alive):
+                        if ready[i]:
+                            logprob_column[row] = row_logprobs[i]
+                    yield token_column, token_masks, logprob_column
+                else:
+                    yield token_column, token_masks
+
+                # Drop the rows that just finished, moving the survivors down (their order is kept)
+                is_finished = lambda row: row_states[row].completed or (max_tokens is not None and num_generated(row) >= max_tokens)
+                survivors = [i for i, row in enumerate(alive) if not is_finished(row)]
+                if not survivors:
+                    break
+                if len(survivors) < len(alive):
+                    for dst, src in enumerate(survivors):
+                        if dst != src:
+                            kv_cache_decode.move_row(src, dst, kv_cache_decode.cache_seqlens[src].item())
+                    index = torch.tensor(survivors, dtype=torch.long, device=device)
+                    keys = keys[index]
+                    sampling = {name: value[index] if torch.is_tensor(value) else value for name, value in sampling.items()}
+                    alive = [alive[i] for i in survivors]
+                    ready = [ready[i] for i in survivors]
+
+                # Prepare logits for next iteration
+                # A waiting row runs its last token again: same KV at the same position, so its logits stay put
+                for i, row_ready in enumerate(ready):
+                    if not row_ready:
+                        kv_cache_decode.cache_seqlens[i] -= 1
+                kv_cache_decode.reserve(0, len(tokens) + max(num_generated(row) for row in alive))
+                ids = torch.tensor([row_states[row].current_tokens[-1] for row in alive], dtype=torch.long, device=device).unsqueeze(1)
+                logits = self.decode(ids, kv_cache_decode)  # (B, vocab_size)
+        finally:
+            # Also cache the generated tokens (e.g. the assistant's reply becomes the prefix of the next turn).
+            # This runs even if the consumer stops early, only positions that made it into the KV cache count.
+            if self.prefix_cache is not None and num_samples == 1:
+                num_valid = kv_cache_decode.get_pos()
+                self.prefix_cache.store(row_states[0].current_tokens[:num_valid], kv_cache_decode)
+
+    def _generate_speculative(self, tokens, max_tokens, temperature, top_k, top_p, min_p, rng, device, dtype, stop=None):
+        """
+        Speculative decoding of a single row: the draft model proposes num_draft_tokens tokens one
+        at a time, then the target scores all of them in one forward pass and accepts a prefix
+        (see speculative_sample). Both KV caches are rolled back past the rejected drafts.
+        Yields the same ([token], [mask]) columns as generate, one token at a time.
+        """
+        k = self.num_draft_tokens
+        # Invariant: both caches hold at most seq[:-1], the last token of seq is always fed in the next forward
+        seq = list(tokens)
+        kv_length = (len(tokens) + max_tokens) if max_tokens is not None else self.context_len()
+        kv_length += k + 1 # room for the drafts of the last round
+        target_cache = self.new_kv_cache(1, kv_length, device, dtype, capacity=len(tokens) + k + 1)
+        draft_cache = self.new_kv_cache(1, kv_length, device, dtype, model=self.draft_model, capacity=len(tokens) + k + 1)
+        forward = lambda model, ids, kv_cache, positions=-1: model.forward(torch.tensor([ids], dtype=torch.long, device=device), kv_cache=kv_cache, positions=positions)
+        if len(tokens) > 1:
+            num_cached = self.prefix_cache.load(tokens[:-1], target_cache) if self.prefix_cache is not None else 0
+            if num_cached < len(tokens) - 1:
+                self.prefill(tokens[num_cached:-1], target_cache)
+            self.prefill(tokens[:-1], draft_cache, model=self.draft_model)
+        state = RowState(tokens.copy(), stop)
         num_generated = 0
-        while True:
-            # Stop condition: we've reached max tokens
-            if max_tokens is not None and num_generated >= max_tokens:
-                break
-            # Stop condition: all rows are completed
-            if all(state.completed for state in row_states):
-                break
+        try:
+            while not state.completed and (max_tokens is None or num_generated < max_tokens):
+                self.resolve_tool_call(state, block=True) # a single row, nothing else to decode in the meantime
+                # Forced tokens (tool outputs) are emitted right away, the caches catch up with them later
+                if state.forced_tokens:
+                    token, mask = self.advance_row(state, None)
+                    seq.append(token)
+                    yield [token], [mask]
+                    num_generated += 1
+                    continue
+                # 1) Draft k tokens with the small model
+                for kv_cache in (target_cache, draft_cache):
+                    kv_cache.reserve(0, len(seq) + k) # the most either cache will hold this round
+                draft_tokens, draft_probs = [], []
+                logits = forward(self.draft_model, seq[draft_cache.get_pos():], draft_cache)[0, -1]
+                for i in range(k):
+                    if temperature == 0.0:
+                        draft_tokens.append(logits.argmax().item())
+                    else:
+                        probs = logits_to_probs(logits, temperature, top_k, top_p, min_p)
+                        draft_tokens.append(torch.multinomial(probs, num_samples=1, generator=rng).item())
+                        draft_probs.append(probs)
+                    if i < k - 1:
+                        logits = forward(self.draft_model, draft_tokens[-1:], draft_cache)[0, -1]
+                # 2) Verify all drafts with one forward of the target
+                num_new = len(seq) - target_cache.get_pos()
+                positions = torch.arange(num_new - 1, num_new + k, device=device) # the last fed token and the drafts
+                logits = forward(self.model, seq[target_cache.get_pos():] + draft_tokens, target_cache, positions)[0]
+                draft_probs = torch.stack(draft_probs) if draft_probs else None
+                emitted = speculative_sample(logits, draft_probs, draft_tokens, rng, temperature, top_k, top_p, min_p)
+                # 3) Emit the tokens one by one, stop early if the row ends, a tool call kicks in or we hit max_tokens
+                for token in emitted:
+                    token, mask = self.advance_row(state, token)
+                    seq.append(token)
+                    yield [token], [mask]
+                    num_generated += 1
+                    if state.completed or state.tool_call or state.forced_tokens or (max_tokens is not None and num_generated >= max_tokens):
+                        break
+                # 4) Roll both caches back to the tokens that were kept (all but the last one, which is fed next)
+                for kv_cache in (target_cache, draft_cache):
+                    kv_cache.cache_seqlens.clamp_(max=len(seq) - 1)
+        finally:
+            if self.prefix_cache is not None:
+                self.prefix_cache.store(seq[:target_cache.get_pos()], target_cache)
 
-            # Sample the next token for each row
-            next_ids = sample_next_token(logits, rng, temperature, top_k)  # (B, 1)
-            sampled_tokens = next_ids[:, 0].tolist()
-
-            # Process each row: choose the next token, update state, optional tool use
-            token_column = [] # contains the next token id along each row
-            token_masks = [] # contains the mask (was it sampled (1) or forced (0)?) along each row
-            for i, state in enumerate(row_states):
-                # Select the next token in this row
-                is_forced = len(state.forced_tokens) > 0 # are there tokens waiting to be forced in deque?
-                token_masks.append(0 if is_forced else 1) # mask is 0 if forced, 1 if sampled
-                next_token = state.forced_tokens.popleft() if is_forced else sampled_tokens[i]
-                token_column.append(next_token)
-                # Update the state of this row to include the next token
-                state.current_tokens.append(next_token)
-                # On <|assistant_end|> or <|bos|>, mark the row as completed
-                if next_token == assistant_end or next_token == bos:
-                    state.completed = True
-                # Handle tool logic
-                if next_token == python_start:
-                    state.in_python_block = True
-                    state.python_expr_tokens = []
-                elif next_token == python_end and state.in_python_block:
-                    state.in_python_block = False
-                    if state.python_expr_tokens:
-                        expr = self.tokenizer.decode(state.python_expr_tokens)
-                        result = use_calculator(expr)
-                        if result is not None:
-                            result_tokens = self.tokenizer.encode(str(result))
-                            state.forced_tokens.append(output_start)
-                            state.forced_tokens.extend(result_tokens)
-                            state.forced_tokens.append(output_end)
-                    state.python_expr_tokens = []
-                elif state.in_python_block:
-                    state.python_expr_tokens.append(next_token)
-
-            # Yield the token column
-            yield token_column, token_masks
-            num_generated += 1
-
-            # Prepare logits for next iteration
-            ids = torch.tensor(token_column, dtype=torch.long, device=device).unsqueeze(1)
-            logits = self.model.forward(ids, kv_cache=kv_cache_decode)[:, -1, :]  # (B, vocab_size)
-
-    def generate_batch(self, tokens, num_samples=1, **kwargs):
+    def generate_batch(self, tokens, num_samples=1, batch_size=None, logprobs=False, **kwargs):
         """
         Non-streaming batch generation that just returns the final token sequences.
         Returns a list of token sequences (list of lists of ints).
         Terminal tokens (assistant_end, bos) are not included in the results.
+        With logprobs, also returns the log-probability of every token under the model, aligned
+        with the results (0.0 for the prompt tokens).
+
+        tokens can also be a list of prompts (of any lengths), which are then all generated together
+        on a Scheduler, at most batch_size rows at a time (default: all of them), each row at its own
+        position. Every prompt gets num_samples rows (or num_samples[i] for a list). Sample j of every
+        prompt uses random stream j, so each prompt gets the same samples as on its own.
+        Returns the results and masks per prompt.
         """
+        if isinstance(tokens[0], list):
+            return self._generate_prompts(tokens, num_samples, batch_size, logprobs=logprobs, **kwargs)
         assistant_end = self.tokenizer.encode_special("<|assistant_end|>")
         bos = self.tokenizer.get_bos_token_id()
         results = [tokens.copy() for _ in range(num_samples)]
         masks = [[0] * len(tokens) for _ in range(num_samples)]
+        all_logprobs = [[0.0] * len(tokens) for _ in range(num_samples)]
         completed = [False] * num_samples
-        for token_column, token_masks in self.generate(tokens, num_samples, **kwargs):
+        for columns in self.generate(tokens, num_samples, logprobs=logprobs, **kwargs):
+            token_column, token_masks = columns[:2]
             for i, (token, mask) in enumerate(zip(token_column, token_masks)):
-                if not completed[i]:
+                if token is not None and not completed[i]:
                     if token == assistant_end or token == bos:
                         completed[i] = True
                     else:
                         results[i].append(token)
                         masks[i].append(mask)
+                        if logprobs:
+                            all_logprobs[i].append(columns[2][i][0])
             # Stop if all rows are completed
             if all(completed):
                 break
-        return results, masks
+        return (results, masks, all_logprobs) if logprobs else (results, masks)
+
+    def _generate_prompts(self, prompts, num_samples, batch_size, max_tokens=None, temperature=1.0, top_k=None, seed=42, top_p=None, min_p=None, logprobs=False, stop=None, constraint=None):
+        """generate_batch for a list of prompts, see there."""
+        num_samples = num_samples if isinstance(num_samples, list) else [num_samples] * len(prompts)
+        assert len(num_samples) == len(prompts), "expecting one num_samples per prompt"
+        scheduler = Scheduler(self, batch_size=batch_size or sum(num_samples))
+        requests = [[scheduler.submit(prompt, max_tokens=max_tokens, temperature=temperature, top_k=top_k, seed=seed, top_p=top_p, min_p=min_p, stream=j, logprobs=logprobs, stop=stop, constraint=constraint)
+                     for j in range(n)] for prompt, n in zip(prompts, num_samples)]
+        while scheduler.has_work():
+            scheduler.step()
+        special = self.get_special_tokens()
+        all_results, all_masks, all_logprobs = [], [], []
+        for prompt, prompt_requests in zip(prompts, requests):
+            results, masks, prompt_logprobs = [], [], []
+            for request in prompt_requests:
+                items = [item for item in request if item[0] != special["assistant_end"] and item[0] != special["bos"]]
+                results.append(prompt + [item[0] for item in items])
+                masks.append([0] * len(prompt) + [item[1] for item in items])
+                prompt_logprobs.append([0.0] * len(prompt) + [item[2][0] for item in items] if logprobs else None)
+            all_results.append(results)
+            all_masks.append(masks)
+            all_logprobs.append(prompt_logprobs)
+        return (all_results, all_masks, all_logprobs) if logprobs else (all_results, all_masks)
+
+    @torch.inference_mode()
+    def beam_search(self, tokens, num_beams=4, max_tokens=None, length_penalty=1.0):
+        """
+        Beam search: keep the num_beams continuations with the highest cumulative log-probability at every step.
+        The prompt is prefilled once and replicated into one KV cache row per beam. When a beam continues
+        another beam's row, only the generated part of that row's KV is copied over (the prompt part is the
+        same in every row). Forced tokens (tool use) continue their beam at no cost. A beam ends on
+        assistant_end/bos or after max_tokens, the search once num_beams beams have ended.
+        Returns (results, masks, scores) of the num_beams best beams, best first, results and masks like
+        generate_batch. The score of a beam is its log-probability divided by its length ** length_penalty.
+        """
+        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        device = self.model.get_device()
+        dtype = self.kv_dtype()
+        max_length = self.context_len()
+        max_tokens = min(max_tokens, max_length - len(tokens)) if max_tokens is not None else max_length - len(tokens)
+
+        # Prefill the prompt once and replicate it for every beam
+        kv_cache_prefill = self.new_kv_cache(1, len(tokens), device, dtype)
+        num_cached = self.prefix_cache.load(tokens[:-1], kv_cache_prefill) if self.prefix_cache is not None else 0
+        logits = self.prefill(tokens[num_cached:], kv_cache_prefill)
+        if self.prefix_cache is not None:
+            self.prefix_cache.store(tokens, kv_cache_prefill)
+        kv_cache = self.new_kv_cache(num_beams, len(tokens) + max_tokens, device, dtype, window_sizes=self.window_sizes(), capacity=len(tokens) + 1)
+        kv_cache.prefill(kv_cache_prefill)
+        del kv_cache_prefill
+
+        # Beam i lives in row i of the KV cache and of the logits
+        beams = [RowState(tokens.copy())]
+        beam_masks = [[0] * len(tokens)]
+        beam_scores = [0.0]
+        finished = [] # (state, masks, score) of the beams that ended
+        for step in range(max_tokens):
+            logprobs = F.log_softmax(logits.float(), dim=-1) # (num_beams, vocab_size)
+            for i, state in enumerate(beams):
+                self.resolve_tool_call(state, block=True)
+                if state.forced_tokens:
+                    logprobs[i] = float("-inf")
+                    logprobs[i, state.forced_tokens[0]] = 0.0
+            candidates = (torch.tensor(beam_scores, device=device)[:, None] + logprobs).view(-1)
+            top_scores, top_ids = candidates.topk(min(2 * num_beams, candidates.numel())) # enough to fill the beams after some end
+            # Extend the best candidates, the ones that end are set aside
+            parents, next_beams, next_masks, next_scores = [], [], [], []
+            for score, index in zip(top_scores.tolist(), top_ids.tolist()):
+                if score == float("-inf") or len(next_beams) == num_beams:
+                    break
+                parent, token = divmod(index, logprobs.size(1))
+                state = copy.deepcopy(beams[parent])
+                _, mask = self.advance_row(state, token)
+                masks = beam_masks[parent] + [mask]
+                if state.completed or step == max_tokens - 1:
+                    finished.append((state, masks, score))
+                else:
+                    parents.append(parent)
+                    next_beams.append(state)
+                    next_masks.append(masks)
+                    next_scores.append(score)
+            if len(finished) >= num_beams or not next_beams:
+                break
+            beams, beam_masks, beam_scores = next_beams, next_masks, next_scores
+
+            # Rows that continue another beam take over the generated part of its KV
+            moved = [(parent, row) for row, parent in enumerate(parents) if parent != row]
+            pos = len(tokens) + step
+            if moved:
+                kv_cache.copy_rows([parent for parent, _ in moved], [row for _, row in moved], len(tokens), pos)
+            kv_cache.reserve(0, pos + 1)
+            ids = torch.tensor([[state.current_tokens[-1]] for state in beams], dtype=torch.long, device=device)
+            logits = self.model.forward(ids, kv_cache=kv_cache.narrow(0, len(beams)))[:, -1, :] # (num_beams, vocab_size)
+
+        # Rank the beams that ended by their length normalized score
+        special = self.get_special_tokens()
+        ranked = []
+        for state, masks, score in finished:
+            ends = state.current_tokens[-1] in (special["assistant_end"], special["bos"])
+            length = len(state.current_tokens) - len(tokens)
+            results = state.current_tokens[:-1] if ends else state.current_tokens
+            ranked.append((score / length ** length_penalty, results, masks[:len(results)]))
+        ranked.sort(key=lambda beam: beam[0], reverse=True)
+        ranked = ranked[:num_beams]
+        return [results for _, results, _ in ranked], [masks for _, _, masks in ranked], [score for score, _, _ in ranked]
+
+    @torch.inference_mode()
+    def score(self, tokens, completions):
+        """
+        The log-probabilities (temperature 1) of the tokens of every completion of the prompt tokens, a list of lists.
+        The prompt is prefilled once, then all completions run through the model together on top of it.
+        """
+        device = self.model.get_device()
+        dtype = self.kv_dtype()
+        max_length = max(len(completion) for completion in completions)
+        if max_length == 0:
+            return [[] for _ in completions]
+        # All but the last prompt token go into the shared KV cache, the last one predicts the first completion token
+        kv_cache_prefill = self.new_kv_cache(1, len(tokens), device, dtype)
+        num_cached = self.prefix_cache.load(tokens[:-1], kv_cache_prefill) if self.prefix_cache is not None else 0
+        if num_cached < len(tokens) - 1:
+            self.prefill(tokens[num_cached:-1], kv_cache_prefill)
+        kv_cache = self.new_kv_cache(len(completions), len(tokens) + max_length, device, dtype)
+        kv_cache.prefill(kv_cache_prefill)
+        del kv_cache_prefill
+        padded = [[tokens[-1]] + completion + [0] * (max_length - len(completion)) for completion in completions]
+        ids = torch.tensor(padded, dtype=torch.long, device=device) # padding at the end doesn't change the earlier positions
+        logits = self.model.forward(ids, kv_cache=kv_cache)[:, :-1] # (num_completions, max_length, vocab_size)
+        logprobs = F.log_softmax(logits.float(), dim=-1).gather(-1, ids[:, 1:, None]).squeeze(-1)
+        return [row[:len(completion)] for row, completion in zip(logprobs.tolist(), completions)]
+
+    def best_of_n(self, tokens, n, length_penalty=1.0, **kwargs):
+        """
+        Sample n completions (generate_batch kwargs) and rank them by their log-probability under the model,
+        the sampled tokens only (tool outputs are free), divided by their length ** length_penalty.
+        Returns (results, masks, scores) like beam_search, best first.
+        """
+        results, masks, logprobs = self.generate_batch(tokens, num_samples=n, logprobs=True, **kwargs)
+        scores = []
+        for result, row_logprobs, row_masks in zip(results, logprobs, masks):
+            logprob = sum(lp for lp, mask in zip(row_logprobs, row_masks) if mask)
+            scores.append(logprob / max(len(result) - len(tokens), 1) ** length_penalty)
+        order = sorted(range(n), key=lambda i: scores[i], reverse=True)
+        return [results[i] for i in order], [masks[i] for i in order], [scores[i] for i in order]
+
+# -----------------------------------------------------------------------------
+# Continuous batching: many independent requests share one decode loop
+
+class Request:
+    """
+    A single generation request handed to the Scheduler.
+    The Scheduler pushes (token, mask) pairs onto the queue as they are generated and a final None
+    when the request is done. With logprobs, the items are (token, mask, (logprob, top)) instead (see
+    token_logprobs, with top_logprobs alternatives). If generation fails, the exception is pushed before the None.
+    Iterating over the request streams its tokens (blocking), and raises that exception.
+    Alternatively, a callback gets called with every item instead (from the thread running the
+    Scheduler), e.g. to hand the tokens over to an asyncio event loop.
+    """
+    def __init__(self, tokens, max_tokens, temperature, top_k, top_p, min_p, seed, callback=None, stream=0, session_path=None, logprobs=False, top_logprobs=0, stop=None, constraint=None):
+        assert isinstance(tokens, list) and isinstance(tokens[0], int), "expecting list of ints"
+        assert temperature >= 0.0, "temperature must be non-negative"
+        self.state = RowState(tokens.copy(), stop, constraint)
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.seed = seed
+        # every request has its own random stream => reproducible regardless of batch mates
+        # (stream j of a seed is what row j of Engine.generate samples from)
+        self.rng_key = rng_keys(torch.tensor([seed]), torch.tensor([stream])).item()
+        self.num_generated = 0
+        self.queue = queue.Queue()
+        self.callback = callback
+        self.session_path = session_path # optional session file: its KV is restored on admission and saved when done
+        self.logprobs = logprobs or top_logprobs > 0
+        self.top_logprobs = top_logprobs
+        self.cancelled = False # set by the consumer (e.g. client disconnected), the row is retired at the next step
+
+    def put(self, item):
+        """Hand a (token, mask) pair, or None at the end, over to the consumer (an exception before the None if generation failed)."""
+        if self.callback is not None:
+            self.callback(item)
+        else:
+            self.queue.put(item)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+class Scheduler:
+    """
+    Continuous batching on top of an Engine.
+
+    A KV cache of batch_size rows is shared by all requests. Requests can be submitted
+    at any time (also from other threads) and are admitted into a free row at the start of
+    the next step: their prompt is prefilled straight into that row. Every step samples one token
+    for each active row and runs a single batched forward pass for all of them, with each row at
+    its own position. Finished rows are retired right away and the last row is moved into the
+    hole, so the active rows always occupy rows [0, n) and compute tracks live requests only.
+
+    With a page_size the KV cache is a PagedKVCache: rows grab pages from a shared pool of
+    num_pages as they grow, so the pool can be much smaller than batch_size * seq_len.
+    Requests wait until the pool has room for their prompt. If the pool runs dry mid-decode,
+    the row that can't grow is preempted: its pages are freed and it goes back to the front of
+    the line, to be prefilled again (prompt + tokens so far) once memory frees up.
+
+    With max_prefill_tokens, at most that many prompt tokens are prefilled per step. Long
+    prompts are then prefilled in chunks over several steps, interleaved with the decode steps
+    of the active rows, instead of stalling all of them for one big forward pass.
+
+    Usage:
+        scheduler = Scheduler(engine, batch_size=8)
+        request = scheduler.submit(tokens, max_tokens=256, temperature=0.8)
+        # drive the loop, typically from a dedicated thread
+        while scheduler.has_work():
+            scheduler.step()
+        for token, mask in request: ...
+    """
+
+    def __init__(self, engine, batch_size=8, seq_len=None, page_size=None, num_pages=None, max_prefill_tokens=None, max_sessions=None, max_session_bytes=None):
+        self.engine = engine
+        self.model = engine.model
+        self.batch_size = batch_size
+        # prompt tokens prefilled per step (None = whole prompts), bounds the stall of the decoding rows
+        self.max_prefill_tokens = max_prefill_tokens if max_prefill_tokens is not None else engine.prefill_chunk_size
+        self.seq_len = seq_len if seq_len is not None else engine.context_len()
+        self.device = self.model.get_device()
+        dtype = engine.kv_dtype() # create the Scheduler in the autocast context the model will run in
+        capacity = None if page_size is not None else min(self.seq_len, 256) # a contiguous cache grows as rows get longer
+        with torch.inference_mode(): # like the caches of Engine.generate (and Engine.warmup), only ever used in step()
+            self.kv_cache = engine.new_kv_cache(batch_size, self.seq_len, self.device, dtype, page_size=page_size, num_pages=num_pages, capacity=capacity)
+        self.pending = queue.Queue() # submitted requests waiting for a free row (thread-safe)
+        self.waiting = deque() # requests taken off the queue (or preempted) that wait for KV cache memory
+        self.active = [] # request i occupies row i of the KV cache
+        self.logits = [] # next token logits (1, vocab_size) for each active row
+        self.prefilling = None # request whose prompt is partially prefilled (in row len(self.active))
+        self.num_prefilled = 0 # number of its tokens already in the KV cache
+        # limits of the session store, enforced (least recently used first) whenever a session is saved
+        self.max_sessions = max_sessions
+        self.max_session_bytes = max_session_bytes
+
+    def submit(self, tokens, max_tokens=None, temperature=1.0, top_k=None, seed=42, top_p=None, min_p=None, callback=None, stream=0, session_path=None, logprobs=False, top_logprobs=0, stop=None, constraint=None):
+        """
+        Queue up a new request. Safe to call from any thread. Returns the Request to stream from.
+        With a session_path (see nanochat.session), the KV of the conversation saved there is reused
+        and the conversation including the reply is saved there when the request is done.
+        """
+        assert len(tokens) < self.seq_len, f"Prompt of {len(tokens)} tokens does not fit in the KV cache of {self.seq_len}"
+        request = Request(tokens, max_tokens, temperature, top_k, top_p, min_p, seed, callback, stream, session_path, logprobs, top_logprobs, stop, constraint)
+        self.pending.put(request)
+        return request
+
+    def has_work(self):
+        return len(self.active) > 0 or self.prefilling is not None or len(self.waiting) > 0 or not self.pending.empty()
+
+    @torch.inference_mode()
+    def abort(self, error):
+        """
+        Recover from a step that raised: the requests it had started (active, being prefilled or waiting)
+        get the error and then None, and the KV cache is emptied. Requests still pending are admitted as usual.
+        """
+        requests = self.active + ([self.prefilling] if self.prefilling is not None else []) + list(self.waiting)
+        self.active, self.logits, self.prefilling, self.num_prefilled = [], [], None, 0
+        self.waiting.clear()
+        self.kv_cache.reset()
+        for request in requests:
+            request.put(error)
+            request.put(None)
+
+    def _next_request(self):
+        """Pop the next request to admit (preempted/waiting ones first), None if there is none."""
+        while True:
+            if self.waiting:
+                request = self.waiting.popleft()
+            else:
+                try:
+                    request = self.pending.get_nowait()
+                except queue.Empty:
+                    return None
+            if not request.cancelled:
+                return request
+            request.put(None)
+
+    def _admit(self):
+        """
+        Prefill waiting requests into free rows of the KV cache, at most max_prefill_tokens prompt
+        tokens per step. The request being prefilled sits in the row right after the active ones;
+        a prompt that doesn't fit in the budget is continued in the next step.
+        """
+        budget = self.max_prefill_tokens or float("inf")
+        while budget > 0:
+            row = len(self.active)
+            if self.prefilling is None:
+                if row >= self.batch_size:
+                    break
+                request = self._next_request()
+                if request is None:
+                    break
+                # + 1 leaves room for the first sampled token
+                if not self.kv_cache.reserve(row, len(request.state.current_tokens) + 1):
+                    assert self.active, "KV cache pool is too small to hold a single prompt"
+                    self.waiting.appendleft(request) # try again once other requests have freed up memory
+                    break
+                self.prefilling, self.num_prefilled = request, 0
+                prefix_cache = self.engine.prefix_cache
+                self.kv_cache.narrow(row, 1).cache_seqlens.zero_()
+                tokens = request.state.current_tokens
+                if request.session_path is not None:
+                    self.num_prefilled = restore_session(request.session_path, tokens[:-1], self.kv_cache, row, fingerprint=model_fingerprint(self.model))
+                if self.num_prefilled == 0 and prefix_cache is not None:
+                    self.num_prefilled = prefix_cache.load(tokens[:-1], self.kv_cache, row)
+            request = self.prefilling
+            if request.cancelled:
+                request.put(None)
+                self.kv_cache.free_row(row)
+                self.prefilling = None
+                continue
+            tokens = request.state.current_tokens
+            end = min(len(tokens), self.num_prefilled + budget)
+            ids = torch.tensor([tokens[self.num_prefilled:end]], dtype=torch.long, device=self.device)
+            logits = self.model.forward(ids, kv_cache=self.kv_cache.narrow(row, 1), positions=-1)
+            budget -= end - self.num_prefilled
+            self.num_prefilled = end
+            if end < len(tokens):
+                break # out of budget, continue next step
+            if self.engine.prefix_cache is not None:
+                self.engine.prefix_cache.store(tokens, self.kv_cache, row)
+            self.active.append(request)
+            self.logits.append(logits[:, -1, :]) # (1, vocab_size)
+            self.prefilling = None
+
+    def _is_finished(self, request):
+        if request.cancelled or request.state.completed:
+            return True
+        if request.max_tokens is not None and request.num_generated >= request.max_tokens:
+            return True
+        return len(request.state.current_tokens) >= self.seq_len # the KV cache row is full
+
+    def _retire(self, row, preempt=False):
+        """Retire the request in row, moving the last active row into its place."""
+        request = self.active[row]
+        if preempt:
+            self.waiting.appendleft(request) # keeps its state, will be prefilled again
+        else:
+            request.put(None)
+        # everything but the last sampled token has its KV in the cache
+        if self.engine.prefix_cache is not None:
+            self.engine.prefix_cache.store(request.state.current_tokens[:-1], self.kv_cache, row)
+        if request.session_path is not None and not preempt:
+            # written in the background, the decode loop doesn't wait for the disk
+            save_session(request.session_path, request.state.current_tokens, self.kv_cache, row, fingerprint=model_fingerprint(self.model),
+                         background=True, max_sessions=self.max_sessions, max_bytes=self.max_session_bytes)
+        self.kv_cache.free_row(row)
+        last = len(self.active) - 1
+        if row != last:
+            moved = self.active[last]
+            self.kv_cache.move_row(last, row, len(moved.state.current_tokens))
+            self.active[row] = moved
+        self.active.pop()
+        if self.prefilling is not None:
+            # the partially prefilled row follows the active ones
+            self.kv_cache.move_row(last + 1, last, self.num_prefilled)
+
+    @torch.inference_mode()
+    def step(self):
+        """Admit waiting requests, then generate one token for every active row. Returns the number of active rows."""
+        self._admit()
+        if not self.active:
+            return 0
+        # Rows waiting for a tool call sit the step out. If all of them wait, block until one can go on
+        # (unless there are requests to admit, which might as well get prefilled in the meantime).
+        ready = [self.engine.resolve_tool_call(request.state) for request in self.active]
+        if not any(ready) and self.prefilling is None and self.pending.empty() and not self.waiting:
+            wait_tool_calls([request.state.tool_call for request in self.active])
+            ready = [self.engine.resolve_tool_call(request.state) for request in self.active]
+
+        # Sample the next token for all rows at once, every request with its own settings and random stream
+        column = lambda name: [getattr(request, name) for request in self.active]
+        sampling = sampling_params(self.device, column("temperature"), column("top_k"), column("top_p"), column("min_p"))
+        keys = torch.tensor(column("rng_key"), dtype=torch.long, device=self.device)
+        steps = torch.tensor(column("num_generated"), dtype=torch.long, device=self.device)
+        logits = torch.cat(self.logits)
+        allowed = self.engine.allowed_tokens([request.state for request in self.active], logits.size(-1), self.device)
+        next_ids = sample_tokens(logits, keys, steps, **sampling, allowed=allowed) # (n,)
+        sampled_tokens = next_ids.tolist() # the only host sync of the step (unless logprobs are asked for)
+
+        # Log-probabilities of the tokens the rows are about to take (forced ones included), if any request wants them
+        row_logprobs = None
+        if any(request.logprobs for request in self.active):
+            forced = [request.state.forced_tokens[0] if request.state.forced_tokens else token for request, token in zip(self.active, sampled_tokens)]
+            top_logprobs = max(request.top_logprobs for request in self.active)
+            row_logprobs = token_logprobs(logits, torch.tensor(forced, dtype=torch.long, device=self.device), top_logprobs)
+
+        # Advance every row and stream its token to its consumer
+        retired = [] # (row, preempt)
+        waiting = [request for row, request in enumerate(self.active) if not ready[row]]
+        for row, request in enumerate(self.active):
+            if not ready[row]:
+                if request.cancelled:
+                    retired.append((row, False))
+                continue
+            token, mask = self.engine.advance_row(request.state, sampled_tokens[row])
+            request.num_generated += 1
+            if request.logprobs:
+                logprob, top = row_logprobs[row]
+                request.put((token, mask, (logprob, top[:request.top_logprobs])))
+            else:
+                request.put((token, mask))
+            if self._is_finished(request):
+                retired.append((row, False))
+            elif not self.kv_cache.reserve(row, len(request.state.current_tokens)):
+                # no room in the pool for the new token, which is written into the cache next
+                retired.append((row, True))
+
+        # Retire rows, highest first so that the moved (last) row is always a live one
+        for row, preempt in reversed(retired):
+            self._retire(row, preempt)
+        if not self.active:
+            self.logits = []
+            return 0
+
+        # One batched forward pass over the live rows, each at its own position in the cache
+        # A waiting row runs its last token again: same KV at the same position, so its logits stay put
+        n = len(self.active)
+        for row, request in enumerate(self.active):
+            if any(request is other for other in waiting):
+                self.kv_cache.cache_seqlens[row] -= 1
+        ids = torch.tensor([[request.state.current_tokens[-1]] for request in self.active], dtype=torch.long, device=self.device)
+        logits = self.engine.decode(ids, self.kv_cache) # (n, vocab_size)
+        self.logits = list(logits.split(1))
+        return n
 
 
 if __name__ == "__main__":
     """
-    Quick inline test to make sure that the naive/slow model.generate function
-    is equivalent to the faster Engine.generate function here.
+    Quick inline test to make sure that the naive (quadratic, re-forwards the whole sequence
+    every step), the KV cached model.generate and the Engine.generate all produce the same tokens,
+    and how long each of them takes.
     """
     import time
     # init compute
     device_type = autodetect_device_type()
     ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
     autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=torch.bfloat16) if device_type == "cuda" else nullcontext()
+    synchronize = torch.cuda.synchronize if device_type == "cuda" else lambda: None
 
     # load the model and tokenizer
     model, tokenizer, meta = load_model("base", device, phase="eval")
@@ -317,40 +1546,36 @@ if __name__ == "__main__":
     kwargs = dict(max_tokens=64, temperature=0.0)
     # set the starting prompt
     prompt_tokens = tokenizer.encode("The chemical formula of water is", prepend=bos_token_id)
-    # generate the reference sequence using the model.generate() function
-    generated_tokens = []
-    torch.cuda.synchronize()
-    t0 = time.time()
-    stream = model.generate(prompt_tokens, **kwargs)
-    with autocast_ctx:
-        for token in stream:
-            generated_tokens.append(token)
-            chunk = tokenizer.decode([token])
-            print(chunk, end="", flush=True)
-    print()
-    torch.cuda.synchronize()
-    t1 = time.time()
-    print(f"Reference time: {t1 - t0:.2f}s")
-    reference_ids = generated_tokens
-    # generate tokens with Engine
-    generated_tokens = []
+
+    @torch.inference_mode()
+    def naive_generate(tokens, max_tokens, temperature):
+        ids = torch.tensor([tokens], dtype=torch.long, device=device)
+        for _ in range(max_tokens):
+            next_ids = model.forward(ids)[:, -1, :].argmax(dim=-1, keepdim=True)
+            ids = torch.cat((ids, next_ids), dim=1)
+            yield next_ids.item()
+
+    def timed(name, stream):
+        generated_tokens = []
+        synchronize()
+        t0 = time.time()
+        with autocast_ctx:
+            for token in stream:
+                generated_tokens.append(token)
+                print(tokenizer.decode([token]), end="", flush=True)
+        print()
+        synchronize()
+        t1 = time.time()
+        print(f"{name} time: {t1 - t0:.2f}s ({len(generated_tokens) / (t1 - t0):.1f} tok/s)")
+        return generated_tokens
+
+    reference_ids = timed("Naive", naive_generate(prompt_tokens, **kwargs))
+    cached_ids = timed("model.generate", model.generate(prompt_tokens, **kwargs))
     engine = Engine(model, tokenizer)
-    stream = engine.generate(prompt_tokens, num_samples=1, **kwargs) # note: runs in fp32
-    torch.cuda.synchronize()
-    t0 = time.time()
-    with autocast_ctx:
-        for token_column, token_masks in stream:
-            token = token_column[0] # only print out the first row
-            generated_tokens.append(token)
-            chunk = tokenizer.decode([token])
-            print(chunk, end="", flush=True)
-    print()
-    torch.cuda.synchronize()
-    t1 = time.time()
-    print(f"Engine time: {t1 - t0:.2f}s")
-    # compare the two sequences
-    for i in range(len(reference_ids)):
-        if reference_ids[i] != generated_tokens[i]:
-            print(f"Mismatch at {i}: {reference_ids[i]} != {generated_tokens[i]}")
-            break
-    print(f"Match: {reference_ids == generated_tokens}")
+    engine_ids = timed("Engine", (token_column[0] for token_column, _ in engine.generate(prompt_tokens, num_samples=1, **kwargs)))
+    # compare the sequences (the Engine stops at <|assistant_end|> / <|bos|>)
+    for name, ids in [("model.generate", cached_ids), ("Engine", engine_ids)]:
+        mismatch = next((i for i in range(len(ids)) if ids[i] != reference_ids[i]), None)
+        if mismatch is not None:
+            print(f"{name} mismatch at {mismatch}: {reference_ids[mismatch]} != {ids[mismatch]}")
+        print(f"{name} match: {mismatch is None}")
@@ -93,6 +93,22 @@ def _sdpa_attention(q, k, v, window_size, enable_gqa):
     
     return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, enable_gqa=enable_gqa)
 
+
+def _sdpa_attention_ragged(q, k, v, positions, window_size, enable_gqa):
+    """
+    SDPA attention for a batch whose rows sit at different positions in the KV cache.
+    q is (B, H, Tq, D), k, v are (B, H, Tk, D) and positions is (B, Tq): the absolute
+    position of every query. Keys past a row's own position are masked out.
+    """
+    window = window_size[0]
+    col_idx = torch.arange(k.size(2), device=q.device).view(1, 1, -1) # (1, 1, Tk)
+    row_idx = positions.unsqueeze(-1) # (B, Tq, 1)
+    mask = col_idx <= row_idx
+    # sliding window (left)
+    if window >= 0:
+        mask = mask & ((row_idx - col_idx) <= window)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=mask.unsqueeze(1), enable_gqa=enable_gqa)
+
 # =============================================================================
 # Public API: Same interface as FA3
 # =============================================================================
@@ -121,7 +137,7 @@ def flash_attn_func(q, k, v, causal=False, window_size=(-1, -1)):
 
 
 def flash_attn_with_kvcache(q, k_cache, v_cache, k=None, v=None, cache_seqlens=None,
-                            causal=False, window_size=(-1, -1)):
+                            causal=False, window_size=(-1, -1), page_table=None):
     """
     Flash Attention with KV cache for inference.
 
@@ -129,11 +145,13 @@ def flash_attn_with_kvcache(q, k_cache, v_cache, k=None, v=None, cache_seqlens=N
 
     Args:
         q: Queries, shape (B, T_new, H, D)
-        k_cache, v_cache: Pre-allocated cache tensors, shape (B, T_max, H_kv, D)
+        k_cache, v_cache: Pre-allocated cache tensors, shape (B, T_max, H_kv, D),
+            or page pools of shape (num_pages, page_size, H_kv, D) if page_table is given
         k, v: New keys/values to insert, shape (B, T_new, H_kv, D)
         cache_seqlens: Current position in cache, shape (B,) int32
         causal: Whether to use causal masking
         window_size: (left, right) sliding window. -1 means unlimited.
+        page_table: Optional (B, max_pages_per_row) int32 page indices into the page pools
 
     Returns:
         Output tensor of shape (B, T_new, H, D)
@@ -141,12 +159,25 @@ def flash_attn_with_kvcache(q, k_cache, v_cache, k=None, v=None, cache_seqlens=N
     if _use_fa3():
         return _fa3.flash_attn_with_kvcache(
             q, k_cache, v_cache, k=k, v=v, cache_seqlens=cache_seqlens,
-            causal=causal, window_size=window_size
+            causal=causal, window_size=window_size, page_table=page_table
         )
 
+    if page_table is not None:
+        return _flash_attn_with_kvcache_paged(q, k_cache, v_cache, k, v, cache_seqlens, page_table, window_size)
+
     # SDPA fallback: manually manage KV cache
     B, T_new, H, D = q.shape
-    pos = cache_seqlens[0].item()  # assume uniform position across batch
+    if torch.compiler.is_compiling():
+        # compiled (static shapes, no host sync): attend over the whole cache, masked by the position of every row
+        return _flash_attn_with_kvcache_ragged(q, k_cache, v_cache, k, v, cache_seqlens, k_cache.size(1) - T_new, window_size)
+    if B == 1:
+        pos_min = pos_max = cache_seqlens[0].item() # a single row is always uniform
+    else:
+        pos_min, pos_max = torch.stack(cache_seqlens.aminmax()).tolist()
+    if pos_min != pos_max:
+        # rows are at different positions (e.g. continuous batching), take the slower ragged path
+        return _flash_attn_with_kvcache_ragged(q, k_cache, v_cache, k, v, cache_seqlens, pos_max, window_size)
+    pos = pos_min  # uniform position across batch
 
     # Insert new k, v into cache (in-place, matching FA3 behavior)
     if k is not None and v is not None:
@@ -169,6 +200,116 @@ def flash_attn_with_kvcache(q, k_cache, v_cache, k=None, v=None, cache_seqlens=N
     return y_sdpa.transpose(1, 2)  # back to (B, T, H, D)
 
 
+def _flash_attn_with_kvcache_ragged(q, k_cache, v_cache, k, v, cache_seqlens, pos_max, window_size):
+    """SDPA fallback of flash_attn_with_kvcache where every row has its own cache position."""
+    B, T_new, H, D = q.shape
+    rows = torch.arange(B, device=q.device).unsqueeze(1) # (B, 1)
+    positions = cache_seqlens.unsqueeze(1).long() + torch.arange(T_new, device=q.device) # (B, T_new)
+
+    # Insert new k, v into cache at each row's own position (in-place, matching FA3 behavior)
+    if k is not None and v is not None:
+        k_cache[rows, positions] = k
+        v_cache[rows, positions] = v
+
+    # Attend over the cache up to the furthest row, shorter rows are masked
+    end_pos = pos_max + T_new
+    q_sdpa = q.transpose(1, 2)
+    k_sdpa = k_cache[:, :end_pos].transpose(1, 2)
+    v_sdpa = v_cache[:, :end_pos].transpose(1, 2)
+    enable_gqa = q_sdpa.size(1) != k_sdpa.size(1)
+    y_sdpa = _sdpa_attention_ragged(q_sdpa, k_sdpa, v_sdpa, positions, window_size, enable_gqa)
+    return y_sdpa.transpose(1, 2)  # back to (B, T, H, D)
+
+
+def _flash_attn_with_kvcache_paged(q, k_pages, v_pages, k, v, cache_seqlens, page_table, window_size):
+    """SDPA fallback of flash_attn_with_kvcache for a paged KV cache: gathers each row's pages."""
+    B, T_new, H, D = q.shape
+    page_size = k_pages.size(1)
+    page_table = page_table.long()
+    positions = cache_seqlens.unsqueeze(1).long() + torch.arange(T_new, device=q.device) # (B, T_new)
+
+    # Insert new k, v into the pages holding these positions (in-place, matching FA3 behavior)
+    if k is not None and v is not None:
+        pages = page_table.gather(1, positions // page_size)
+        offsets = positions % page_size
+        k_pages[pages, offsets] = k
+        v_pages[pages, offsets] = v
+
+    # Gather the pages of every row into contiguous (B, T, H, D) tensors, up to the furthest row
+    # (all of them when compiled: static shapes, no host sync)
+    end_pos = page_table.size(1) * page_size if torch.compiler.is_compiling() else cache_seqlens.max().item() + T_new
+    num_pages = -(-end_pos // page_size)
+    k_rows = k_pages[page_table[:, :num_pages]].flatten(1, 2)
+    v_rows = v_pages[page_table[:, :num_pages]].flatten(1, 2)
+
+    q_sdpa = q.transpose(1, 2)
+    k_sdpa = k_rows.transpose(1, 2)
+    v_sdpa = v_rows.transpose(1, 2)
+    enable_gqa = q_sdpa.size(1) != k_sdpa.size(1)
+    y_sdpa = _sdpa_attention_ragged(q_sdpa, k_sdpa, v_sdpa, positions, window_size, enable_gqa)
+    return y_sdpa.transpose(1, 2)  # back to (B, T, H, D)
+
+
+def flash_attn_with_ring_kvcache(q, k_ring, v_ring, k, v, cache_seqlens, window_size):
+    """
+    Causal sliding window attention with a ring buffer KV cache (FA3 has no kernel for this, always SDPA,
+    which is why the Engine only uses ring buffers when FA3 is unavailable, see Engine.window_sizes).
+
+    A layer with a window only ever looks back window_size[0] positions, so its cache can be a
+    ring buffer of S > window slots where absolute position p lives in slot p % S.
+    Same semantics as flash_attn_with_kvcache(causal=True): new k, v are written into the ring in-place.
+    A single new token (decode) is written first and attends over the ring in place: the slot it takes
+    held position p - S, which is out of its window anyway. Longer chunks attend over the ring and themselves.
+
+    Args:
+        q: Queries, shape (B, T_new, H, D)
+        k_ring, v_ring: Ring buffers, shape (B, S, H_kv, D)
+        k, v: New keys/values, shape (B, T_new, H_kv, D)
+        cache_seqlens: Position of every row, shape (B,) int32 (rows may differ)
+        window_size: (left, right) sliding window, 0 <= left < S
+
+    Returns:
+        Output tensor of shape (B, T_new, H, D)
+    """
+    B, T_new, H, D = q.shape
+    S = k_ring.size(1)
+    window = window_size[0]
+    assert 0 <= window < S, f"Ring buffer of {S} slots is too small for a window of {window}"
+    pos = cache_seqlens.long().unsqueeze(1) # (B, 1)
+    new_positions = pos + torch.arange(T_new, device=q.device) # (B, T_new)
+    rows = torch.arange(B, device=q.device).unsqueeze(1)
+    slot_ids = torch.arange(S, device=q.device)
+    if T_new == 1:
+        # Decode: write the new token into the ring, then attend over the ring as is (no copy of it)
+        k_ring[rows, pos % S] = k
+        v_ring[rows, pos % S] = v
+        # the absolute position held by each slot: the last position up to pos that maps to it (< 0: never written)
+        key_positions = (pos - (pos - slot_ids) % S).unsqueeze(1) # (B, 1, S)
+        k_keys, v_keys = k_ring, v_ring
+    else:
+        # Attend over the old ring contents and the new tokens (the chunk may overwrite slots it still needs)
+        old_positions = pos - 1 - (pos - 1 - slot_ids) % S # (B, S)
+        key_positions = torch.cat([old_positions, new_positions], dim=1).unsqueeze(1) # (B, 1, S + T_new)
+        k_keys, v_keys = torch.cat([k_ring, k], dim=1), torch.cat([v_ring, v], dim=1)
+
+    # masked by absolute position
+    query_positions = new_positions.unsqueeze(-1) # (B, T_new, 1)
+    mask = (key_positions >= 0) & (key_positions <= query_positions) & (query_positions - key_positions <= window)
+    q_sdpa = q.transpose(1, 2)
+    k_sdpa = k_keys.transpose(1, 2)
+    v_sdpa = v_keys.transpose(1, 2)
+    enable_gqa = q_sdpa.size(1) != k_sdpa.size(1)
+    y_sdpa = F.scaled_dot_product_attention(q_sdpa, k_sdpa, v_sdpa, attn_mask=mask.unsqueeze(1), enable_gqa=enable_gqa)
+
+    if T_new > 1:
+        # Write the new tokens into the ring (in-place), only the last S of them survive
+        n = min(T_new, S)
+        slots = new_positions[:, -n:] % S
+        k_ring[rows, slots] = k[:, -n:]
+        v_ring[rows, slots] = v[:, -n:]
+    return y_sdpa.transpose(1, 2)  # back to (B, T, H, D)
+
+
 # =============================================================================
 # Export: flash_attn module interface (drop-in replacement for FA3)
 # =============================================================================
@@ -176,4 +317,5 @@ from types import SimpleNamespace
 flash_attn = SimpleNamespace(
     flash_attn_func=flash_attn_func,
     flash_attn_with_kvcache=flash_attn_with_kvcache,
+    flash_attn_with_ring_kvcache=flash_attn_with_ring_kvcache,
 )
@@ -12,18 +12,21 @@ Notable features:
 - Flash Attention 3 integration
 """
 
+import math
+import threading
 from functools import partial
 from dataclasses import dataclass
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from nanochat.common import get_dist_info, print0
 from nanochat.optim import MuonAdamW, DistMuonAdamW
 
 # Our custom Flash Attention module that automatically uses FA3 on Hopper+ and SDPA fallback elsewhere
-from nanochat.flash_attention import flash_attn
+from nanochat.flash_attention import flash_attn, HAS_FA3
 
 @dataclass
 class GPTConfig:
@@ -48,6 +51,53 @@ def has_ve(layer_idx, n_layer):
     """Returns True if GPT layer should have Value Embedding (alternating, last layer always included)."""
     return layer_idx % 2 == (n_layer - 1) % 2
 
+# Rotary embedding tables, shared by all the models of the process (e.g. the replicas of chat_web) and
+# grown on demand: (head_dim, base, scaling, device) -> (cos, sin, attn_scale), cos/sin of shape (1, seq_len, 1, head_dim/2)
+_rotary_tables = {}
+_rotary_tables_lock = threading.Lock() # chat_web workers look them up from their own threads
+
+def rotary_inv_freq(head_dim, base=10000, scaling=None):
+    """
+    The rotation frequency of every channel pair (head_dim/2,) and the attention scale.
+    scaling = (mode, factor, original_seq_len) stretches the context by factor beyond the one trained on:
+    - "ntk": raise the base, so the low frequencies get interpolated and the high ones are kept (NTK-aware)
+    - "yarn": interpolate only the channels that rotate less than once per original_seq_len, keep the ones
+      that rotate often, ramp in between, and sharpen the attention a bit (https://arxiv.org/abs/2309.00071)
+    """
+    channel_range = torch.arange(0, head_dim, 2, dtype=torch.float32)
+    if scaling is None:
+        return 1.0 / (base ** (channel_range / head_dim)), 1.0
+    mode, factor, original_seq_len = scaling
+    if mode == "ntk":
+        base = base * factor ** (head_dim / (head_dim - 2))
+        return 1.0 / (base ** (channel_range / head_dim)), 1.0
+    assert mode == "yarn", f"Unknown rope scaling: {mode}"
+    inv_freq = 1.0 / (base ** (channel_range / head_dim))
+    # the channel index at which a channel makes num_rotations full turns within original_seq_len
+    correction_dim = lambda num_rotations: head_dim * math.log(original_seq_len / (num_rotations * 2 * math.pi)) / (2 * math.log(base))
+    low = max(math.floor(correction_dim(32)), 0) # beta_fast = 32 rotations: keep (extrapolate) below
+    high = min(math.ceil(correction_dim(1)), head_dim // 2 - 1) # beta_slow = 1 rotation: interpolate above
+    ramp = ((torch.arange(head_dim // 2, dtype=torch.float32) - low) / max(high - low, 1e-3)).clamp(0, 1)
+    inv_freq = inv_freq / factor * ramp + inv_freq * (1 - ramp)
+    return inv_freq, 0.1 * math.log(factor) + 1.0
+
+def rotary_embeddings(seq_len, head_dim, device, base=10000, scaling=None):
+    """The shared rotary embeddings (cos, sin, attn_scale) for at least seq_len positions, in bfloat16."""
+    device = torch.device(device)
+    if device.type != "cpu" and device.index is None:
+        device = torch.device(device.type, torch.cuda.current_device() if device.type == "cuda" else 0) # "cuda" and "cuda:0" share a table
+    key = (head_dim, base, scaling, device)
+    with _rotary_tables_lock:
+        tables = _rotary_tables.get(key)
+        if tables is None or tables[0].size(1) < seq_len:
+            seq_len = 1 << max(seq_len - 1, 1).bit_length() # grow by powers of two, so rarely
+            inv_freq, attn_scale = rotary_inv_freq(head_dim, base, scaling)
+            # stride the time steps, calculate the rotation frequencies at each (time, channel) pair
+            freqs = torch.outer(torch.arange(seq_len, dtype=torch.float32, device=device), inv_freq.to(device))
+            cos, sin = freqs.cos().bfloat16(), freqs.sin().bfloat16() # keep them in bfloat16
+            tables = _rotary_tables[key] = (cos[None, :, None, :], sin[None, :, None, :], attn_scale) # add batch and head dims for later broadcasting
+    return tables
+
 def apply_rotary_emb(x, cos, sin):
     assert x.ndim == 4  # multihead attention
     d = x.shape[3] // 2
@@ -56,6 +106,21 @@ def apply_rotary_emb(x, cos, sin):
     y2 = x1 * (-sin) + x2 * cos
     return torch.cat([y1, y2], 3)
 
+def _split_qkv_state(module, state_dict, prefix, local_metadata):
+    # state dict hook of a fused attention layer: c_qkv.* -> c_q.*, c_k.*, c_v.* as in the unfused model
+    for key in [key for key in state_dict if key.startswith(prefix + "c_qkv.")]:
+        name = key[len(prefix + "c_qkv."):]
+        for part, tensor in zip(("c_q", "c_k", "c_v"), state_dict.pop(key).split(module.qkv_sizes)):
+            state_dict[f"{prefix}{part}.{name}"] = tensor
+
+def _merge_qkv_state(module, state_dict, prefix, *args):
+    # load hook of a fused attention layer: c_q.*, c_k.*, c_v.* -> c_qkv.*
+    if module.c_qkv is None:
+        return
+    for key in [key for key in state_dict if key.startswith(prefix + "c_q.")]:
+        name = key[len(prefix + "c_q."):]
+        state_dict[f"{prefix}c_qkv.{name}"] = torch.cat([state_dict.pop(f"{prefix}{part}.{name}") for part in ("c_q", "c_k", "c_v")])
+
 class CausalSelfAttention(nn.Module):
     def __init__(self, config, layer_idx):
         super().__init__()
@@ -72,15 +137,42 @@ class CausalSelfAttention(nn.Module):
         self.c_proj = nn.Linear(self.n_embd, self.n_embd, bias=False)
         self.ve_gate_channels = 32
         self.ve_gate = nn.Linear(self.ve_gate_channels, self.n_kv_head, bias=False) if has_ve(layer_idx, config.n_layer) else None
-
-    def forward(self, x, ve, cos_sin, window_size, kv_cache):
+        # Inference: c_q, c_k, c_v fused into one layer (see fuse_qkv), the state dict keeps the unfused layout
+        self.c_qkv = None
+        self.qkv_sizes = [self.n_head * self.head_dim, self.n_kv_head * self.head_dim, self.n_kv_head * self.head_dim]
+        self.register_state_dict_post_hook(_split_qkv_state)
+        self.register_load_state_dict_pre_hook(_merge_qkv_state)
+
+    def fuse_qkv(self):
+        """Replace c_q, c_k, c_v (regular or quantized linear layers) with a single c_qkv layer, one matmul instead of three."""
+        if self.c_qkv is not None:
+            return
+        layers = (self.c_q, self.c_k, self.c_v)
+        weight = self.c_q.weight
+        if isinstance(self.c_q, nn.Linear):
+            fused = nn.Linear(self.n_embd, sum(self.qkv_sizes), bias=False, device=weight.device, dtype=weight.dtype)
+        else: # QuantizedLinear, all its state is per output channel
+            fused = type(self.c_q)(self.n_embd, sum(self.qkv_sizes), self.c_q.bits, self.c_q.group_size, device=weight.device)
+        with torch.no_grad():
+            fused.load_state_dict({name: torch.cat([layer.state_dict()[name] for layer in layers]) for name in self.c_q.state_dict()})
+        fused.requires_grad_(False)
+        del self.c_q, self.c_k, self.c_v
+        self.c_qkv = fused
+
+    def forward(self, x, ve, rotary, window_size, kv_cache):
         B, T, C = x.size()
 
         # Project the input to get queries, keys, and values
         # Shape: (B, T, H, D) - FA3's native layout, no transpose needed!
-        q = self.c_q(x).view(B, T, self.n_head, self.head_dim)
-        k = self.c_k(x).view(B, T, self.n_kv_head, self.head_dim)
-        v = self.c_v(x).view(B, T, self.n_kv_head, self.head_dim)
+        if self.c_qkv is not None:
+            q, k, v = self.c_qkv(x).split(self.qkv_sizes, dim=-1) # GQA: fewer kv heads than query heads
+            q = q.view(B, T, self.n_head, self.head_dim)
+            k = k.view(B, T, self.n_kv_head, self.head_dim)
+            v = v.view(B, T, self.n_kv_head, self.head_dim)
+        else:
+            q = self.c_q(x).view(B, T, self.n_head, self.head_dim)
+            k = self.c_k(x).view(B, T, self.n_kv_head, self.head_dim)
+            v = self.c_v(x).view(B, T, self.n_kv_head, self.head_dim)
 
         # Value residual (ResFormer): mix in value embedding with input-dependent gate per head
         if ve is not None:
@@ -89,9 +181,11 @@ class CausalSelfAttention(nn.Module):
             v = v + gate.unsqueeze(-1) * ve
 
         # Apply Rotary Embeddings to queries and keys to get relative positional encoding
-        cos, sin = cos_sin
+        cos, sin, attn_scale = rotary
         q, k = apply_rotary_emb(q, cos, sin), apply_rotary_emb(k, cos, sin)
         q, k = norm(q), norm(k) # QK norm
+        if attn_scale != 1.0:
+            q = q * attn_scale**2 # YaRN: sharper attention over the longer context (the QK norm would undo scaling the rotations)
 
         # Flash Attention (FA3 on Hopper+, PyTorch SDPA fallback elsewhere)
         # window_size is (left, right) tuple: (N, 0) for causal, (-1, 0) for full context
@@ -101,13 +195,18 @@ class CausalSelfAttention(nn.Module):
         else:
             # Inference: use flash_attn_with_kvcache which handles cache management
             k_cache, v_cache = kv_cache.get_layer_cache(self.layer_idx)
-            y = flash_attn.flash_attn_with_kvcache(
-                q, k_cache, v_cache,
-                k=k, v=v,
-                cache_seqlens=kv_cache.cache_seqlens,
-                causal=True,
-                window_size=window_size,
-            )
+            if kv_cache.is_ring_layer(self.layer_idx):
+                # sliding window layer with a ring buffer cache of just over window_size slots
+                y = flash_attn.flash_attn_with_ring_kvcache(q, k_cache, v_cache, k, v, kv_cache.cache_seqlens, window_size)
+            else:
+                y = flash_attn.flash_attn_with_kvcache(
+                    q, k_cache, v_cache,
+                    k=k, v=v,
+                    cache_seqlens=kv_cache.cache_seqlens,
+                    causal=True,
+                    window_size=window_size,
+                    page_table=kv_cache.page_table,
+                )
             # Advance position after last layer processes
             if self.layer_idx == kv_cache.n_layers - 1:
                 kv_cache.advance(T)
@@ -137,8 +236,8 @@ class Block(nn.Module):
         self.attn = CausalSelfAttention(config, layer_idx)
         self.mlp = MLP(config)
 
-    def forward(self, x, ve, cos_sin, window_size, kv_cache):
-        x = x + self.attn(norm(x), ve, cos_sin, window_size, kv_cache)
+    def forward(self, x, ve, rotary, window_size, kv_cache):
+        x = x + self.attn(norm(x), ve, rotary, window_size, kv_cache)
         x = x + self.mlp(norm(x))
         return x
 
@@ -175,15 +274,13 @@ class GPT(nn.Module):
         head_dim = config.n_embd // config.n_head
         kv_dim = config.n_kv_head * head_dim
         self.value_embeds = nn.ModuleDict({str(i): nn.Embedding(padded_vocab_size, kv_dim) for i in range(config.n_layer) if has_ve(i, config.n_layer)})
-        # To support meta device initialization, we init the rotary embeddings here, but it's just "fake" meta tensors only.
-        # As for rotary_seq_len, these rotary embeddings are pretty small/cheap in memory,
-        # so let's just over-compute them by 10X, but assert fail if we ever reach that amount.
-        # In the future we can dynamically grow the cache, for now it's fine.
-        self.rotary_seq_len = config.sequence_len * 10 # 10X over-compute should be enough, TODO make nicer?
-        head_dim = config.n_embd // config.n_head
-        cos, sin = self._precompute_rotary_embeddings(self.rotary_seq_len, head_dim)
-        self.register_buffer("cos", cos, persistent=False) # persistent=False means it's not saved to the checkpoint
-        self.register_buffer("sin", sin, persistent=False)
+        # The rotary embeddings are not buffers: the tables are shared by all the models of the process
+        # and grow on demand (see rotary_embeddings), they are looked up in init_weights() and forward().
+        self.cos = self.sin = self.attn_scale = self._rotary_scaling = None
+        self.rope_scaling = None # (mode, factor) to run longer contexts than trained on, see set_rope_scaling()
+        self.context_len = config.sequence_len # the longest sequence to run at inference
+        # If set, the training loss is computed in chunks of this many tokens (see _chunked_cross_entropy)
+        self.loss_chunk_size = None
 
     @torch.no_grad()
     def init_weights(self):
@@ -230,9 +327,7 @@ class GPT(nn.Module):
                 torch.nn.init.zeros_(block.attn.ve_gate.weight)
 
         # Rotary embeddings
-        head_dim = self.config.n_embd // self.config.n_head
-        cos, sin = self._precompute_rotary_embeddings(self.rotary_seq_len, head_dim)
-        self.cos, self.sin = cos, sin
+        self._rotary_embeddings(self.config.sequence_len, self.get_device())
 
         # Cast embeddings to bf16: optimizer can tolerate it and it saves memory
         if self.transformer.wte.weight.device.type == "cuda":
@@ -240,24 +335,31 @@ class GPT(nn.Module):
             for ve in self.value_embeds.values():
                 ve.to(dtype=torch.bfloat16)
 
-    def _precompute_rotary_embeddings(self, seq_len, head_dim, base=10000, device=None):
-        # TODO: bump base theta more? e.g. 100K is more common more recently
-        # autodetect the device from model embeddings
-        if device is None:
-            device = self.transformer.wte.weight.device
-        # stride the channels
-        channel_range = torch.arange(0, head_dim, 2, dtype=torch.float32, device=device)
-        inv_freq = 1.0 / (base ** (channel_range / head_dim))
-        # stride the time steps
-        t = torch.arange(seq_len, dtype=torch.float32, device=device)
-        # calculate the rotation frequencies at each (time, channel) pair
-        freqs = torch.outer(t, inv_freq)
-        cos, sin = freqs.cos(), freqs.sin()
-        cos, sin = cos.bfloat16(), sin.bfloat16() # keep them in bfloat16
-        cos, sin = cos[None, :, None, :], sin[None, :, None, :] # add batch and head dims for later broadcasting
-        return cos, sin
-
-    def _compute_window_sizes(self, config):
+    def _rotary_embeddings(self, seq_len, device):
+        """(cos, sin, attn_scale) for at least seq_len positions on device, from the shared tables."""
+        scaling = (*self.rope_scaling, self.config.sequence_len) if self.rope_scaling is not None else None
+        if self.cos is None or self.cos.size(1) < seq_len or self.cos.device != device or self._rotary_scaling != scaling:
+            head_dim = self.config.n_embd // self.config.n_head
+            self.cos, self.sin, self.attn_scale = rotary_embeddings(max(seq_len, self.config.sequence_len), head_dim, device, scaling=scaling)
+            self._rotary_scaling = scaling
+        return self.cos, self.sin, self.attn_scale
+
+    def set_rope_scaling(self, mode, factor):
+        """
+        Inference-time setting: run contexts of up to factor x the trained sequence_len, with "ntk" or "yarn"
+        scaled rotary embeddings (see rotary_inv_freq). The attention windows stretch along. mode None resets.
+        """
+        if mode is None:
+            self.rope_scaling, factor = None, 1
+        else:
+            assert mode in ("ntk", "yarn") and factor >= 1, f"Invalid rope scaling: {mode} x{factor}"
+            self.rope_scaling = (mode, float(factor))
+        self.context_len = int(self.config.sequence_len * factor)
+        self.window_sizes = self._compute_window_sizes(self.config, self.context_len)
+        self._rotary_embeddings(self.context_len, self.get_device()) # up front, not in the middle of a (compiled) forward
+        return self
+
+    def _compute_window_sizes(self, config, context_len=None):
         """
         Compute per-layer window sizes for sliding window attention.
 
@@ -271,7 +373,7 @@ class GPT(nn.Module):
         pattern = config.window_pattern.upper()
         assert all(c in "SL" for c in pattern), f"Invalid window_pattern: {pattern}. Use only S and L."
         # Map characters to window sizes
-        long_window = config.sequence_len
+        long_window = context_len or config.sequence_len
         short_window = long_window // 2
         char_to_window = {
             "L": (long_window, 0),
@@ -289,6 +391,16 @@ class GPT(nn.Module):
     def get_device(self):
         return self.transformer.wte.weight.device
 
+    def fuse_qkv(self):
+        """
+        Inference-time transform (after load_model, e.g. also after quantization): fuse the q, k, v
+        projections of every layer into one matmul. state_dict() and load_state_dict() keep the
+        layout of the unfused model, so checkpoints stay compatible with training.
+        """
+        for block in self.transformer.h:
+            block.attn.fuse_qkv()
+        return self
+
     def estimate_flops(self):
         """
         Return the estimated FLOPs per token for the model (forward + backward).
@@ -385,16 +497,26 @@ class GPT(nn.Module):
             group["initial_lr"] = group["lr"]
         return optimizer
 
-    def forward(self, idx, targets=None, kv_cache=None, loss_reduction='mean'):
+    def forward(self, idx, targets=None, kv_cache=None, loss_reduction='mean', positions=None):
+        """
+        Returns the loss if targets are given, else the logits (B, T, vocab_size).
+        At inference, positions selects the positions to compute logits for (the lm_head is by far the
+        largest matmul of a prefill): an int (e.g. -1 for the last position only) gives (B, 1, vocab_size),
+        a tensor of shape (B,) or (B, K) gives the logits of those positions for every row, (B, 1 or K, vocab_size).
+        """
         B, T = idx.size()
 
-        # Grab the rotary embeddings for the current sequence length (they are of shape (1, seq_len, 1, head_dim/2))
-        assert T <= self.cos.size(1), f"Sequence length grew beyond the rotary embeddings cache: {T} > {self.cos.size(1)}"
-        assert idx.device == self.cos.device, f"Rotary embeddings and idx are on different devices: {idx.device} != {self.cos.device}"
-        assert self.cos.dtype == torch.bfloat16, "Rotary embeddings must be in bfloat16"
-        # if kv cache exists, we need to offset the rotary embeddings to the current position in the cache
-        T0 = 0 if kv_cache is None else kv_cache.get_pos()
-        cos_sin = self.cos[:, T0:T0+T], self.sin[:, T0:T0+T] # truncate cache to current sequence length
+        # Grab the rotary embeddings for the current sequence length (they are of shape (1, seq_len, 1, head_dim/2)),
+        # the shared tables grow if they are too short
+        cos, sin, attn_scale = self._rotary_embeddings(T if kv_cache is None else max(T, kv_cache.max_seq_len), idx.device)
+        if kv_cache is None:
+            rotary = cos[:, :T], sin[:, :T], attn_scale # truncate cache to current sequence length
+        else:
+            # if kv cache exists, we need to offset the rotary embeddings to the current position in the cache.
+            # every row continues from its own position (rows of a batch can be at different positions),
+            # so we gather per row on device instead of slicing, which would need a host sync of the position.
+            pos = kv_cache.cache_seqlens.unsqueeze(1) + torch.arange(T, device=idx.device) # (B, T)
+            rotary = cos[0, pos], sin[0, pos], attn_scale # (B, T, 1, head_dim/2)
 
         # Forward the trunk of the Transformer
         x = self.transformer.wte(idx) # embed current token
@@ -403,42 +525,92 @@ class GPT(nn.Module):
         for i, block in enumerate(self.transformer.h):
             x = self.resid_lambdas[i] * x + self.x0_lambdas[i] * x0
             ve = self.value_embeds[str(i)](idx) if str(i) in self.value_embeds else None
-            x = block(x, ve, cos_sin, self.window_sizes[i], kv_cache)
+            x = block(x, ve, rotary, self.window_sizes[i], kv_cache)
         x = norm(x)
 
+        # Only keep the positions we need logits for
+        if positions is not None:
+            assert targets is None, "positions is only supported at inference"
+            if isinstance(positions, int):
+                x = x.narrow(1, positions % T, 1)
+            else:
+                positions = positions.view(B, -1)
+                x = x.gather(1, positions.unsqueeze(-1).expand(-1, -1, x.size(-1)))
+
+        if targets is not None and self.loss_chunk_size:
+            # training with a chunked loss: the full logits are never materialized
+            return self._chunked_cross_entropy(x, targets, loss_reduction)
+
         # Forward the lm_head (compute logits)
-        softcap = 15 # smoothly cap the logits to the range [-softcap, softcap]
-        logits = self.lm_head(x) # (B, T, padded_vocab_size) <- very big tensor, large amount of memory
-        logits = logits[..., :self.config.vocab_size] # slice to remove padding
-        logits = logits.float() # switch to fp32 for logit softcap and loss computation
-        logits = softcap * torch.tanh(logits / softcap) # squash the logits
+        logits = self._logits(x) # (B, T, vocab_size) <- very big tensor, large amount of memory (unless positions is used)
 
         if targets is not None:
             # training: given the targets, compute and return the loss
-            # TODO experiment with chunked cross-entropy?
             loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1, reduction=loss_reduction)
             return loss
         else:
             # inference: just return the logits directly
             return logits
 
+    def _logits(self, x):
+        """The lm_head: final hidden states (..., n_embd) -> softcapped fp32 logits (..., vocab_size)."""
+        softcap = 15 # smoothly cap the logits to the range [-softcap, softcap]
+        logits = self.lm_head(x) # (..., padded_vocab_size)
+        logits = logits[..., :self.config.vocab_size] # slice to remove padding
+        logits = logits.float() # switch to fp32 for logit softcap and loss computation
+        logits = softcap * torch.tanh(logits / softcap) # squash the logits
+        return logits
+
+    def _chunk_loss(self, x, targets, reduction):
+        return F.cross_entropy(self._logits(x), targets, ignore_index=-1, reduction=reduction)
+
+    def _chunked_cross_entropy(self, x, targets, loss_reduction):
+        """
+        Same loss as the regular path, but the lm_head + softcap + cross-entropy run over chunks of
+        loss_chunk_size tokens. Each chunk is checkpointed, so only one chunk of fp32 logits is
+        alive at a time in forward and the logits are recomputed chunk by chunk in backward.
+        """
+        x = x.view(-1, x.size(-1)) # (B*T, n_embd)
+        targets = targets.view(-1)
+        reduction = 'none' if loss_reduction == 'none' else 'sum'
+        losses = []
+        for start in range(0, x.size(0), self.loss_chunk_size):
+            end = start + self.loss_chunk_size
+            losses.append(checkpoint(self._chunk_loss, x[start:end], targets[start:end], reduction, use_reentrant=False))
+        if loss_reduction == 'none':
+            return torch.cat(losses)
+        loss = torch.stack(losses).sum()
+        if loss_reduction == 'mean':
+            loss = loss / (targets != -1).sum() # like F.cross_entropy, the mean is over the non-ignored targets
+        return loss
+
     @torch.inference_mode()
     def generate(self, tokens, max_tokens, temperature=1.0, top_k=None, seed=42):
         """
-        Naive autoregressive streaming inference.
+        Simple autoregressive streaming inference.
         To make it super simple, let's assume:
         - batch size is 1
         - ids and the yielded tokens are simple Python lists and ints
+        The prompt is forwarded once into a KV cache, then every step only forwards the new token.
+        (The Engine does batching, tool use and more sampling options on top of the same KV cache.)
         """
+        from nanochat.engine import KVCache, kv_dtype # lazy: the engine imports this module (via checkpoint_manager)
         assert isinstance(tokens, list)
         device = self.get_device()
         rng = None
         if temperature > 0:
             rng = torch.Generator(device=device)
             rng.manual_seed(seed)
-        ids = torch.tensor([tokens], dtype=torch.long, device=device) # add batch dim
+        m = self.config
+        kv_cache = KVCache(
+            batch_size=1, num_heads=m.n_kv_head, seq_len=len(tokens) + max_tokens, head_dim=m.n_embd // m.n_head,
+            num_layers=m.n_layer, device=device, dtype=kv_dtype(self),
+            # without FA3, sliding window layers only keep a ring buffer (FA3 has no ring kernel, see Engine.ring_kv_cache)
+            window_sizes=[left for left, _ in self.window_sizes] if not HAS_FA3 else None,
+        )
+        ids = torch.tensor([tokens], dtype=torch.long, device=device) # add batch dim, the whole prompt goes in first
         for _ in range(max_tokens):
-            logits = self.forward(ids) # (B, T, vocab_size)
+            logits = self.forward(ids, kv_cache=kv_cache, positions=-1) # (B, 1, vocab_size)
             logits = logits[:, -1, :] # (B, vocab_size)
             if top_k is not None and top_k > 0:
                 v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
@@ -449,6 +621,6 @@ class GPT(nn.Module):
                 next_ids = torch.multinomial(probs, num_samples=1, generator=rng)
             else:
                 next_ids = torch.argmax(logits, dim=-1, keepdim=True)
-            ids = torch.cat((ids, next_ids), dim=1)
+            ids = next_ids # (B, 1), only the new token runs through the model next
             token = next_ids.item()
             yield token
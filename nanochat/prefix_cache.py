@@ -0,0 +1,111 @@
+"""
+Prefix cache: reuse the KV cache of token prefixes across requests and chat turns.
+
+A radix tree over token id sequences. Every node holds a segment of tokens together with
+the keys/values of that segment for all layers, so walking down the tree along a prompt
+collects the KV of its longest cached prefix. Shared system prompts, few-shot prefixes
+and the earlier turns of a conversation then only get prefilled once.
+
+Notes:
+- KV of a position only depends on the tokens up to it, so any cached prefix is exact.
+- Segments are stored as (n_layers, num_tokens, H, D) tensors on the device of the model.
+- The cache holds at most max_tokens tokens. Least recently used leaves are evicted first.
+"""
+
+class Node:
+    # A node of the radix tree: the tokens of its edge and their KV, shape (n_layers, len(tokens), H, D)
+    def __init__(self, tokens=(), k=None, v=None, parent=None):
+        self.tokens = tokens
+        self.k = k
+        self.v = v
+        self.parent = parent
+        self.children = {} # first token of the child's edge -> child
+        self.last_access = 0
+
+class PrefixCache:
+
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+        self.root = Node()
+        self.num_tokens = 0 # total number of tokens held by the tree
+        self.clock = 0 # logical time for LRU
+        self.hits = 0 # number of tokens served from the cache
+        self.misses = 0 # number of tokens that had to be prefilled
+
+    def _match(self, tokens):
+        """Walk down the tree along tokens. Returns the list of (node, num_tokens_used) and the match length."""
+        self.clock += 1
+        path, node, pos = [], self.root, 0
+        while pos < len(tokens) and tokens[pos] in node.children:
+            child = node.children[tokens[pos]]
+            n = 0
+            while n < len(child.tokens) and pos + n < len(tokens) and child.tokens[n] == tokens[pos + n]:
+                n += 1
+            child.last_access = self.clock
+            path.append((child, n))
+            pos += n
+            if n < len(child.tokens):
+                break
+            node = child
+        return path, pos
+
+    def _split(self, node, n):
+        """Split node after its first n tokens, returns the new parent holding those n tokens."""
+        head = Node(node.tokens[:n], node.k[:, :n], node.v[:, :n], node.parent)
+        head.last_access = node.last_access
+        node.parent.children[node.tokens[0]] = head
+        node.tokens, node.k, node.v, node.parent = node.tokens[n:], node.k[:, n:], node.v[:, n:], head
+        head.children[node.tokens[0]] = node
+        return head
+
+    def _evict(self):
+        """Drop least recently used leaves until the tree fits in the budget."""
+        while self.num_tokens > self.max_tokens:
+            leaves, stack = [], [self.root]
+            while stack:
+                node = stack.pop()
+                stack.extend(node.children.values())
+                if not node.children and node is not self.root:
+                    leaves.append(node)
+            leaf = min(leaves, key=lambda node: node.last_access)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.num_tokens -= len(leaf.tokens)
+
+    def load(self, tokens, kv_cache, row=0):
+        """
+        Copy the KV of the longest cached prefix of tokens into (empty) row of kv_cache and
+        set the row's position to its length. Returns the number of tokens loaded.
+        """
+        path, num_matched = self._match(tokens)
+        pos = 0
+        for node, n in path:
+            kv_cache.write_row(row, pos, node.k[:, :n], node.v[:, :n])
+            pos += n
+        kv_cache.cache_seqlens[row] = num_matched
+        self.hits += num_matched
+        self.misses += len(tokens) - num_matched
+        return num_matched
+
+    def store(self, tokens, kv_cache, row=0):
+        """Insert tokens into the tree, reading the KV of the part that isn't cached yet from row of kv_cache."""
+        if self.max_tokens <= 0 or len(tokens) == 0:
+            return
+        tokens = tuple(tokens)
+        path, num_matched = self._match(tokens)
+        node = self.root
+        if path:
+            node, n = path[-1]
+            if n < len(node.tokens):
+                node = self._split(node, n)
+        if num_matched == len(tokens):
+            return
+        k, v = kv_cache.read_row(row, num_matched, len(tokens))
+        leaf = Node(tokens[num_matched:], k.clone(), v.clone(), node)
+        leaf.last_access = self.clock
+        node.children[leaf.tokens[0]] = leaf
+        self.num_tokens += len(leaf.tokens)
+        self._evict()
+
+    def clear(self):
+        self.root = Node()
+        self.num_tokens = 0
@@ -0,0 +1,163 @@
+"""
+Weight-only quantization for inference (mostly for serving on CPU).
+
+Decoding is bound by reading the weights from memory, so storing them in fewer bits makes
+it faster and smaller. The activations stay in floating point, the weights are dequantized
+inside the matmul (with the fused CPU kernels of PyTorch where available, else explicitly).
+
+- int8: symmetric, one scale per output channel.
+- int4: asymmetric, a scale and a zero point per group of group_size input channels,
+  two weights packed per byte.
+
+Only the big matrices (c_q, c_k, c_v or a fused c_qkv, c_proj, c_fc, lm_head) are quantized, the embeddings
+and the small gates stay as they are. Quantized models are for inference only.
+
+Quantize a checkpoint once (saved next to it for instant reloads) and compare its bpb to fp32:
+python -m nanochat.quantize --source sft --quantize int4
+then load it with load_model(..., quantize="int4"), e.g. chat_cli/chat_web --quantize int4.
+CORE can be compared with base_eval --quantize.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+QUANTIZE_MODES = {"int8": (8, None), "int4": (4, 128)} # mode -> (bits, group_size)
+QUANTIZED_LAYERS = ("c_q", "c_k", "c_v", "c_qkv", "c_proj", "c_fc", "lm_head")
+
+def has_cpu_int4_kernel():
+    return hasattr(torch.ops.aten, "_weight_int4pack_mm_for_cpu") and hasattr(torch.ops.aten, "_convert_weight_to_int4pack_for_cpu")
+
+class QuantizedLinear(nn.Module):
+    """
+    Drop-in replacement of a bias-free nn.Linear with int8 or int4 weights.
+    int8: weight (out, in) int8, scale (out,)
+    int4: weight (out, in // 2) uint8 (even input channels in the low nibbles), scale and zero (out, in // group_size)
+    with the weights dequantized as (q - 8) * scale + zero.
+    """
+
+    def __init__(self, in_features, out_features, bits=8, group_size=None, device=None):
+        super().__init__()
+        assert bits in (4, 8), f"Unsupported number of bits: {bits}"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        if bits == 8:
+            self.group_size = in_features
+            self.register_buffer("weight", torch.empty(out_features, in_features, dtype=torch.int8, device=device))
+            self.register_buffer("scale", torch.empty(out_features, device=device))
+            self.zero = None
+        else:
+            assert in_features % 2 == 0, "int4 needs an even number of input channels"
+            # fall back to one group per row if group_size doesn't divide the input channels
+            self.group_size = group_size if group_size is not None and in_features % group_size == 0 else in_features
+            num_groups = in_features // self.group_size
+            self.register_buffer("weight", torch.empty(out_features, in_features // 2, dtype=torch.uint8, device=device))
+            self.register_buffer("scale", torch.empty(out_features, num_groups, device=device))
+            self.register_buffer("zero", torch.empty(out_features, num_groups, device=device))
+        self._int4pack = None # weights in the layout of the CPU int4 kernel, made on first use
+
+    @classmethod
+    def from_linear(cls, linear, bits=8, group_size=None):
+        assert linear.bias is None, "Only bias-free linear layers are quantized"
+        w = linear.weight.detach().float()
+        module = cls(linear.in_features, linear.out_features, bits, group_size, device=w.device)
+        if bits == 8:
+            scale = w.abs().amax(dim=1).clamp(min=1e-8) / 127
+            module.weight.copy_(torch.round(w / scale[:, None]).clamp(-127, 127).to(torch.int8))
+            module.scale.copy_(scale)
+        else:
+            groups = w.view(module.out_features, -1, module.group_size) # (out, num_groups, group_size)
+            w_min, w_max = groups.amin(dim=2), groups.amax(dim=2)
+            scale = (w_max - w_min).clamp(min=1e-8) / 15
+            q = torch.round((groups - w_min[..., None]) / scale[..., None]).clamp(0, 15).to(torch.uint8)
+            q = q.view(module.out_features, -1)
+            module.weight.copy_(q[:, 0::2] | (q[:, 1::2] << 4))
+            module.scale.copy_(scale)
+            module.zero.copy_(w_min + 8 * scale)
+        return module
+
+    def dequantize(self, dtype=torch.float32):
+        """The weights as a regular (out, in) matrix."""
+        if self.bits == 8:
+            return self.weight.to(dtype) * self.scale[:, None].to(dtype)
+        q = torch.stack([self.weight & 0xF, self.weight >> 4], dim=2).view(self.out_features, -1, self.group_size)
+        w = (q.float() - 8) * self.scale[..., None] + self.zero[..., None]
+        return w.view(self.out_features, self.in_features).to(dtype)
+
+    def forward(self, x):
+        if x.device.type == "cpu":
+            x2d = x.reshape(-1, self.in_features)
+            if self.bits == 8 and hasattr(torch, "_weight_int8pack_mm"):
+                y = torch._weight_int8pack_mm(x2d, self.weight, self.scale.to(x.dtype))
+                return y.view(*x.shape[:-1], self.out_features)
+            if self.bits == 4 and has_cpu_int4_kernel() and self.out_features % 16 == 0:
+                if self._int4pack is None:
+                    q = torch.stack([self.weight & 0xF, self.weight >> 4], dim=2).view(self.out_features, -1)
+                    packed = torch.ops.aten._convert_weight_to_int4pack_for_cpu(q.to(torch.int32), 1)
+                    scale_and_zero = torch.stack([self.scale.t(), self.zero.t()], dim=2).contiguous() # (num_groups, out, 2)
+                    self._int4pack = (packed, scale_and_zero)
+                packed, scale_and_zero = self._int4pack
+                y = torch.ops.aten._weight_int4pack_mm_for_cpu(x2d, packed, self.group_size, scale_and_zero.to(x.dtype))
+                return y.view(*x.shape[:-1], self.out_features)
+        return F.linear(x, self.dequantize(x.dtype))
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, group_size={self.group_size}"
+
+def quantize_model(model, quantize, empty=False):
+    """
+    Swap the big nn.Linear layers of model for QuantizedLinear in place, quantize is "int8" or "int4".
+    With empty, the modules are only allocated (e.g. to load a quantized state dict into).
+    """
+    assert quantize in QUANTIZE_MODES, f"Unknown quantization mode: {quantize}"
+    bits, group_size = QUANTIZE_MODES[quantize]
+    targets = [(name, module) for name, module in model.named_modules() if isinstance(module, nn.Linear) and name.split(".")[-1] in QUANTIZED_LAYERS]
+    for name, linear in targets:
+        parent_name, _, attr_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        if empty:
+            quantized = QuantizedLinear(linear.in_features, linear.out_features, bits, group_size, device=linear.weight.device)
+        else:
+            quantized = QuantizedLinear.from_linear(linear, bits, group_size)
+        setattr(parent, attr_name, quantized)
+    return model
+
+
+if __name__ == "__main__":
+    """Quantize a checkpoint, save it next to the original and compare its val bpb with the unquantized model."""
+    import argparse
+    from contextlib import nullcontext
+    from nanochat.common import compute_init, autodetect_device_type, print0
+    from nanochat.checkpoint_manager import load_model, save_quantized_model
+    from nanochat.tokenizer import get_token_bytes
+    from nanochat.dataloader import tokenizing_distributed_data_loader_bos_bestfit
+    from nanochat.loss_eval import evaluate_bpb
+
+    parser = argparse.ArgumentParser(description="Quantize a model checkpoint for inference")
+    parser.add_argument("-i", "--source", type=str, default="sft", help="Source of the model: base|sft|rl")
+    parser.add_argument("-q", "--quantize", type=str, default="int8", choices=list(QUANTIZE_MODES), help="Quantization mode")
+    parser.add_argument("-g", "--model-tag", type=str, default=None, help="Model tag to load")
+    parser.add_argument("-s", "--step", type=int, default=None, help="Step to load")
+    parser.add_argument("--eval-batches", type=int, default=8, help="Number of val batches for the bpb check (0 = skip)")
+    parser.add_argument("--device-batch-size", type=int, default=4, help="Batch size for the bpb check")
+    parser.add_argument("--device-type", type=str, default="", help="cuda|cpu|mps (empty = autodetect)")
+    args = parser.parse_args()
+
+    device_type = autodetect_device_type() if args.device_type == "" else args.device_type
+    ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
+    autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=torch.bfloat16) if device_type == "cuda" else nullcontext()
+    model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step)
+    sequence_len = meta["model_config"]["sequence_len"]
+
+    def val_bpb():
+        loader = tokenizing_distributed_data_loader_bos_bestfit(tokenizer, args.device_batch_size, sequence_len, "val", device=device)
+        with autocast_ctx:
+            return evaluate_bpb(model, loader, args.eval_batches, get_token_bytes(device=device))
+
+    reference_bpb = val_bpb() if args.eval_batches > 0 else None
+    quantize_model(model, args.quantize)
+    save_quantized_model(model, args.source, args.quantize, model_tag=args.model_tag, step=meta["step"])
+    if reference_bpb is not None:
+        bpb = val_bpb()
+        print0(f"val bpb: {reference_bpb:.6f} (unquantized) -> {bpb:.6f} ({args.quantize}), {bpb - reference_bpb:+.6f}")
@@ -0,0 +1,202 @@
+"""
+Chat sessions: keep the KV cache of a conversation across turns, and on disk.
+
+A Session owns a single row KV cache and the tokens of its conversation. Every turn only
+the new tokens (the user message, plus the last token of the previous reply) get prefilled,
+so the latency of a turn doesn't grow with the length of the conversation.
+
+Sessions are saved to <base_dir>/sessions/<session_id>.pt as the conversation tokens together
+with the keys/values of those in the KV cache, shape (n_layers, num_cached, H, D). They are loaded memory-mapped, and
+only the part that matches the conversation is copied into the KV cache. chat_cli resumes
+sessions with --session, and chat_web with the session_id of a request (see Scheduler.submit).
+
+A session also records the model that computed its KV (see model_fingerprint) and the layout of the
+KV cache. If either differs on restore (e.g. another checkpoint, quantization or rope scaling),
+the session's KV is not used and the conversation gets prefilled from scratch.
+
+Sessions saved by the Scheduler are written by a background thread (so decoding doesn't wait for
+the disk), and the directory is pruned to at most max_sessions files / max_bytes, least recently
+used first. Restoring a session waits for its pending write, if any.
+"""
+
+import os
+import re
+import uuid
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+from nanochat.common import get_base_dir
+
+def is_valid_session_id(session_id):
+    # session ids end up in file names
+    return re.fullmatch(r"[A-Za-z0-9_-]{1,128}", session_id) is not None
+
+def session_path(session_id):
+    assert is_valid_session_id(session_id), f"Invalid session id: {session_id}"
+    return os.path.join(get_base_dir(), "sessions", f"{session_id}.pt")
+
+def model_fingerprint(model):
+    """
+    A string that identifies the KV a model computes: its config, rope scaling and weights (names, shapes,
+    dtypes and checksums, so quantization counts too). The weights part is computed once per model,
+    an inference model's weights don't change.
+    """
+    if getattr(model, "_weights_fingerprint", None) is None:
+        state = model.state_dict()
+        checksums = torch.stack([tensor.float().sum() for tensor in state.values()]).tolist() # one host sync
+        weights = repr([(name, tuple(tensor.shape), str(tensor.dtype), checksum) for (name, tensor), checksum in zip(state.items(), checksums)])
+        model._weights_fingerprint = hashlib.sha256(weights.encode()).hexdigest()
+    return f"{model.config}|{model.rope_scaling}|{model._weights_fingerprint}"
+
+def _kv_layout(kv_cache):
+    return (kv_cache.n_layers, kv_cache.n_heads, kv_cache.head_dim, str(kv_cache.dtype))
+
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-writer") # one at a time, in order
+_pending_writes = {} # path -> Future of its latest background write
+_pending_lock = threading.Lock()
+
+def prune_sessions(directory, max_sessions=None, max_bytes=None):
+    """Delete the least recently used session files of directory until at most max_sessions / max_bytes are left."""
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(".pt"):
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort() # oldest first
+    total_bytes = sum(size for _, size, _ in entries)
+    while entries and ((max_sessions is not None and len(entries) > max_sessions) or (max_bytes is not None and total_bytes > max_bytes)):
+        _, size, name = entries.pop(0)
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+def _write_session(path, tokens, k, v, fingerprint, layout, max_sessions, max_bytes):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp") # unique, concurrent saves of one session don't clash
+    try:
+        with os.fdopen(fd, "wb") as f:
+            torch.save({"tokens": torch.tensor(tokens, dtype=torch.long), "k": k.cpu(), "v": v.cpu(), "fingerprint": fingerprint, "layout": layout}, f)
+        os.replace(tmp_path, path) # never leave a half written session behind
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    if max_sessions is not None or max_bytes is not None:
+        prune_sessions(directory, max_sessions, max_bytes)
+
+def save_session(path, tokens, kv_cache, row=0, fingerprint=None, background=False, max_sessions=None, max_bytes=None):
+    """
+    Save tokens together with the KV of those of them that row of kv_cache holds (a prefix).
+    fingerprint: of the model that computed the KV (see model_fingerprint), checked by restore_session.
+    With background, the KV is snapshotted on its device and written by the writer thread (returns its Future).
+    With max_sessions / max_bytes, the directory is pruned afterwards (see prune_sessions).
+    """
+    num_cached = min(kv_cache.cache_seqlens[row].item(), len(tokens))
+    # copy the KV out (on device, no sync): the row gets reused right away, and a view would save the whole cache
+    k, v = (x.clone() for x in kv_cache.read_row(row, 0, num_cached))
+    args = (path, list(tokens), k, v, fingerprint, _kv_layout(kv_cache), max_sessions, max_bytes)
+    if not background:
+        _write_session(*args)
+        return None
+    with _pending_lock:
+        future = _pending_writes[path] = _writer.submit(_write_session, *args)
+    future.add_done_callback(lambda f: _forget_write(path, f))
+    return future
+
+def _forget_write(path, future):
+    with _pending_lock:
+        if _pending_writes.get(path) is future:
+            del _pending_writes[path]
+
+def restore_session(path, tokens, kv_cache, row=0, fingerprint=None):
+    """
+    Copy the KV of the longest common prefix of tokens and the saved session into (empty, reserved)
+    row of kv_cache and set the row's position to its length. Returns the number of tokens restored,
+    0 if the session was saved by another model (fingerprint) or from a KV cache of another layout.
+    """
+    with _pending_lock:
+        pending = _pending_writes.get(path)
+    if pending is not None:
+        pending.exception() # the previous turn is still being written, wait for it (a failed write just isn't there)
+    if not os.path.exists(path):
+        return 0
+    data = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    os.utime(path) # recently used, see prune_sessions
+    n = 0
+    if data.get("fingerprint") != fingerprint or data.get("layout") != _kv_layout(kv_cache):
+        kv_cache.cache_seqlens[row] = n # stale KV, the conversation gets prefilled from scratch
+        return n
+    saved_tokens = data["tokens"].tolist()[:data["k"].size(1)]
+    while n < min(len(tokens), len(saved_tokens)) and tokens[n] == saved_tokens[n]:
+        n += 1
+    if n > 0:
+        device = kv_cache.cache_seqlens.device
+        kv_cache.write_row(row, 0, data["k"][:, :n].to(device), data["v"][:, :n].to(device))
+    kv_cache.cache_seqlens[row] = n
+    return n
+
+class Session:
+    """
+    A conversation with its own KV cache. Append the tokens of a turn to session.tokens, generate
+    the reply and append that too. The tokens must only ever be appended to (or reset()):
+
+    session = Session(engine, tokens=[bos])
+    session.tokens.extend([user_start, *tokenizer.encode("Hi"), user_end, assistant_start])
+    for token_column, token_masks in session.generate(max_tokens=256):
+        session.tokens.append(token_column[0])
+    session.save()
+    """
+
+    def __init__(self, engine, session_id=None, tokens=None):
+        self.engine = engine
+        self.session_id = session_id or uuid.uuid4().hex
+        self.tokens = tokens if tokens is not None else [] # the conversation, the KV cache holds a prefix of it
+        self.kv_cache = None
+
+    def _kv_cache(self):
+        if self.kv_cache is None:
+            # grows with the conversation, without ring buffers so it can be saved.
+            # an inference tensor like the Engine's own caches (same compiled decode step, see Engine.warmup)
+            with torch.inference_mode():
+                self.kv_cache = self.engine.new_kv_cache(1, self.engine.context_len(), self.engine.model.get_device(), self.engine.kv_dtype(), capacity=256)
+        return self.kv_cache
+
+    def generate(self, **kwargs):
+        """Generate the next reply to the conversation (Engine.generate kwargs, single sample)."""
+        yield from self.engine.generate(list(self.tokens), kv_cache=self._kv_cache(), **kwargs)
+
+    def num_cached(self):
+        return self.kv_cache.get_pos() if self.kv_cache is not None else 0
+
+    @torch.inference_mode()
+    def reset(self):
+        self.tokens.clear()
+        if self.kv_cache is not None:
+            self.kv_cache.reset()
+
+    def save(self, path=None):
+        """Save the conversation and its KV (default: under the session id)."""
+        path = path or session_path(self.session_id)
+        save_session(path, self.tokens, self._kv_cache(), fingerprint=model_fingerprint(self.engine.model))
+        return path
+
+    @torch.inference_mode()
+    def load(self, path=None):
+        """Restore a saved conversation (default: by the session id). Returns the number of tokens restored."""
+        path = path or session_path(self.session_id)
+        if not os.path.exists(path):
+            return 0
+        saved_tokens = torch.load(path, map_location="cpu", mmap=True, weights_only=True)["tokens"].tolist()
+        kv_cache = self._kv_cache()
+        kv_cache.reset()
+        kv_cache.reserve(0, len(saved_tokens))
+        self.tokens[:] = saved_tokens
+        return restore_session(path, saved_tokens, kv_cache, fingerprint=model_fingerprint(self.engine.model))
@@ -8,6 +8,7 @@ Two implementations are available:
 
 import os
 import copy
+import codecs
 from functools import lru_cache
 
 SPECIAL_TOKENS = [
@@ -255,6 +256,10 @@ class RustBPETokenizer:
     def decode(self, ids):
         return self.enc.decode(ids)
 
+    def stream_decoder(self):
+        """A StreamDecoder to turn a stream of generated token ids into text, one token at a time."""
+        return StreamDecoder(self.enc.decode_single_token_bytes)
+
     def save(self, tokenizer_dir):
         # save the encoding object to disk
         os.makedirs(tokenizer_dir, exist_ok=True)
@@ -384,6 +389,33 @@ class RustBPETokenizer:
         ids.append(assistant_start)
         return ids
 
+# -----------------------------------------------------------------------------
+# Incremental decoding for streaming
+
+class StreamDecoder:
+    """
+    Decodes a stream of token ids into text in constant time per token.
+    A multi-byte UTF-8 character can be split across tokens, so the bytes of an incomplete
+    character are held back until the token that completes it arrives.
+    Usage:
+        decoder = tokenizer.stream_decoder()
+        for token in tokens:
+            print(decoder.step(token), end="")
+        print(decoder.flush())
+    """
+
+    def __init__(self, token_to_bytes):
+        self.token_to_bytes = token_to_bytes # token id -> bytes
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def step(self, token):
+        """Add a token, returns the new complete text (possibly empty)."""
+        return self.decoder.decode(self.token_to_bytes(token))
+
+    def flush(self):
+        """End of the stream, returns the remaining text (an incomplete character becomes a replacement character)."""
+        return self.decoder.decode(b"", final=True)
+
 # -----------------------------------------------------------------------------
 # nanochat-specific convenience functions
 
@@ -18,6 +18,9 @@ Examples:
 
     # Quick/approximate evaluation using a single GPU
     python -m scripts.base_eval --model-tag d24 --device-batch-size=16 --max-per-task=100 --split-tokens=524288
+
+    # Check the accuracy of the int8 weight-only quantized model on CPU (compare with a run without --quantize)
+    python -m scripts.base_eval --model-tag d24 --device-type cpu --quantize int8 --eval core,bpb
 """
 import os
 import csv
@@ -187,6 +190,7 @@ def main():
     parser.add_argument('--device-batch-size', type=int, default=32, help='Per-device batch size for BPB evaluation')
     parser.add_argument('--split-tokens', type=int, default=40*524288, help='Number of tokens to evaluate per split for BPB')
     parser.add_argument('--device-type', type=str, default='', help='cuda|cpu|mps (empty = autodetect)')
+    parser.add_argument('--quantize', type=str, default=None, choices=['int8', 'int4'], help='Evaluate the model with quantized weights (to compare with the unquantized model)')
     args = parser.parse_args()
 
     # Parse evaluation modes
@@ -210,11 +214,11 @@ def main():
         model_name = args.hf_path
         model_slug = args.hf_path.replace("/", "-")
     else:
-        model, tokenizer, meta = load_model("base", device, phase="eval", model_tag=args.model_tag, step=args.step)
+        model, tokenizer, meta = load_model("base", device, phase="eval", model_tag=args.model_tag, step=args.step, quantize=args.quantize)
         sequence_len = meta["model_config"]["sequence_len"]
         token_bytes = get_token_bytes(device=device)
-        model_name = f"base_model (step {meta['step']})"
-        model_slug = f"base_model_{meta['step']:06d}"
+        model_name = f"base_model (step {meta['step']})" + (f" {args.quantize}" if args.quantize else "")
+        model_slug = f"base_model_{meta['step']:06d}" + (f"_{args.quantize}" if args.quantize else "")
 
     print0(f"Evaluating model: {model_name}")
     print0(f"Eval modes: {', '.join(sorted(eval_modes))}")
@@ -58,6 +58,7 @@ parser.add_argument("--target-param-data-ratio", type=float, default=10.5, help=
 # Optimization
 parser.add_argument("--device-batch-size", type=int, default=32, help="per-device batch size. good number to reduce to 16,8,4,... if you OOM on VRAM.")
 parser.add_argument("--total-batch-size", type=int, default=-1, help="total batch size in tokens. decent numbers are e.g. 524288. (-1 = auto-compute optimal)")
+parser.add_argument("--loss-chunk-size", type=int, default=-1, help="compute lm_head + loss in chunks of this many tokens, never materializing the full logits (-1 = disable)")
 parser.add_argument("--embedding-lr", type=float, default=0.3, help="learning rate for embedding parameters (Adam)")
 parser.add_argument("--unembedding-lr", type=float, default=0.004, help="learning rate for unembedding parameters (Adam)")
 parser.add_argument("--weight-decay", type=float, default=0.2, help="cautious weight decay for the Muon optimizer (for weights)")
@@ -233,6 +234,8 @@ def disable_fp8(model):
 # -----------------------------------------------------------------------------
 # Compile the model
 
+if args.loss_chunk_size > 0:
+    model.loss_chunk_size = args.loss_chunk_size
 orig_model = model # original, uncompiled model, for saving raw model state_dict and for inference/evaluation (because the shapes may change shape)
 model = torch.compile(model, dynamic=False) # the inputs to model will never change shape so dynamic=False is safe
 
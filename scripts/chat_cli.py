@@ -3,12 +3,17 @@ New and upgraded chat mode because a lot of the code has changed since the last
 
 Intended to be run single GPU only atm:
 python -m scripts.chat_cli
+
+With --session <id>, the conversation and its KV cache are saved after every turn and resumed
+on the next run with the same id, without prefilling the history again.
 """
 import argparse
 import torch
 from nanochat.common import compute_init, autodetect_device_type
 from contextlib import nullcontext
 from nanochat.engine import Engine
+from nanochat.prefix_cache import PrefixCache
+from nanochat.session import Session
 from nanochat.checkpoint_manager import load_model
 
 parser = argparse.ArgumentParser(description='Chat with the model')
@@ -18,8 +23,19 @@ parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
 parser.add_argument('-p', '--prompt', type=str, default='', help='Prompt the model, get a single response back')
 parser.add_argument('-t', '--temperature', type=float, default=0.6, help='Temperature for generation')
 parser.add_argument('-k', '--top-k', type=int, default=50, help='Top-k sampling parameter')
+parser.add_argument('--top-p', type=float, default=None, help='Top-p (nucleus) sampling parameter')
+parser.add_argument('--min-p', type=float, default=None, help='Min-p sampling parameter')
 parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
 parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
+parser.add_argument('--prefix-cache-tokens', type=int, default=4096, help='Max tokens kept in the prefix KV cache, so earlier turns are not prefilled again (0 = disable)')
+parser.add_argument('--draft-model-tag', type=str, default=None, help='Model tag of a small draft model (same source) for speculative decoding')
+parser.add_argument('--num-draft-tokens', type=int, default=4, help='Number of tokens drafted per step in speculative decoding')
+parser.add_argument('--prefill-chunk-size', type=int, default=512, help='Max prompt tokens per prefill forward pass (0 = whole prompt at once)')
+parser.add_argument('--quantize', type=str, default=None, choices=['int8', 'int4'], help='Weight-only quantization of the model for inference: int8|int4 (see nanochat/quantize.py)')
+parser.add_argument('--compile-decode', action='store_true', help='torch.compile the decode step (static shapes, compiled at startup)')
+parser.add_argument('--rope-scaling', type=str, default=None, choices=['ntk', 'yarn'], help='Scale the rotary embeddings to run contexts longer than trained on: ntk|yarn')
+parser.add_argument('--context-factor', type=float, default=2.0, help='With --rope-scaling, the max context as a multiple of the trained sequence length')
+parser.add_argument('--session', type=str, default=None, help='Session id: resume the conversation saved under it and save it after every turn (no speculative decoding)')
 args = parser.parse_args()
 
 # Init the model and tokenizer
@@ -28,7 +44,13 @@ device_type = autodetect_device_type() if args.device_type == "" else args.devic
 ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
 ptdtype = torch.float32 if args.dtype == 'float32' else torch.bfloat16
 autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
-model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step)
+model, tokenizer, meta = load_model(args.source, device, phase="eval", model_tag=args.model_tag, step=args.step, quantize=args.quantize)
+model.fuse_qkv() # one matmul for q, k, v
+draft_model = load_model(args.source, device, phase="eval", model_tag=args.draft_model_tag, quantize=args.quantize)[0].fuse_qkv() if args.draft_model_tag else None
+if args.rope_scaling is not None:
+    for m in (model, draft_model):
+        if m is not None:
+            m.set_rope_scaling(args.rope_scaling, args.context_factor)
 
 # Special tokens for the chat state machine
 bos = tokenizer.get_bos_token_id()
@@ -36,7 +58,10 @@ user_start, user_end = tokenizer.encode_special("<|user_start|>"), tokenizer.enc
 assistant_start, assistant_end = tokenizer.encode_special("<|assistant_start|>"), tokenizer.encode_special("<|assistant_end|>")
 
 # Create Engine for efficient generation
-engine = Engine(model, tokenizer)
+prefix_cache = PrefixCache(max_tokens=args.prefix_cache_tokens) if args.prefix_cache_tokens > 0 else None
+engine = Engine(model, tokenizer, prefix_cache=prefix_cache, draft_model=draft_model, num_draft_tokens=args.num_draft_tokens, prefill_chunk_size=args.prefill_chunk_size or None, compile_decode=args.compile_decode)
+with autocast_ctx: # compile the decode step (if enabled) for the KV cache layout of a single sample
+    engine.warmup(1, engine.window_sizes() if prefix_cache is None and not args.session else None) # sessions have no rings
 
 print("\nNanoChat Interactive Mode")
 print("-" * 50)
@@ -45,6 +70,13 @@ print("Type 'clear' to start a new conversation")
 print("-" * 50)
 
 conversation_tokens = [bos]
+# A session keeps the KV cache of the conversation across turns (and runs), appending to conversation_tokens
+session = Session(engine, args.session, conversation_tokens) if args.session else None
+if session is not None:
+    with autocast_ctx: # the KV cache is allocated in the dtype the model will compute in
+        num_restored = session.load()
+    if num_restored > 0:
+        print(f"Resumed session {args.session} ({len(conversation_tokens)} tokens)")
 
 while True:
 
@@ -65,7 +97,9 @@ while True:
         break
 
     if user_input.lower() == 'clear':
-        conversation_tokens = [bos]
+        if session is not None:
+            session.reset()
+        conversation_tokens[:] = [bos]
         print("Conversation cleared.")
         continue
 
@@ -84,21 +118,26 @@ while True:
         "max_tokens": 256,
         "temperature": args.temperature,
         "top_k": args.top_k,
+        "top_p": args.top_p,
+        "min_p": args.min_p,
     }
     response_tokens = []
+    decoder = tokenizer.stream_decoder() # holds back partial multi-byte characters
     print("\nAssistant: ", end="", flush=True)
     with autocast_ctx:
-        for token_column, token_masks in engine.generate(conversation_tokens, **generate_kwargs):
+        stream = session.generate(**generate_kwargs) if session is not None else engine.generate(conversation_tokens, **generate_kwargs)
+        for token_column, token_masks in stream:
             token = token_column[0] # pop the batch dimension (num_samples=1)
             response_tokens.append(token)
-            token_text = tokenizer.decode([token])
-            print(token_text, end="", flush=True)
-    print()
+            print(decoder.step(token), end="", flush=True)
+    print(decoder.flush())
     # we have to ensure that the assistant end token is the last token
     # so even if generation ends due to max tokens, we have to append it to the end
     if response_tokens[-1] != assistant_end:
         response_tokens.append(assistant_end)
     conversation_tokens.extend(response_tokens)
+    if session is not None:
+        session.save()
 
     # In the prompt mode, we only want a single response and exit
     if args.prompt:
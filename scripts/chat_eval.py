@@ -26,40 +26,47 @@ from tasks.gsm8k import GSM8K
 from tasks.spellingbee import SpellingBee
 
 # -----------------------------------------------------------------------------
-# Generative evaluation loop (we go one problem at a time, sample, evaluate)
+# Generative evaluation loop (we go batch_size problems at a time, sample, evaluate)
 
-def run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=None):
+def run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, batch_size=1, max_problems=None, num_beams=1):
 
     ddp, ddp_rank, ddp_local_rank, ddp_world_size = get_dist_info()
     device = model.get_device()
 
     num_problems = len(task_object) if max_problems is None else min(len(task_object), max_problems)
+    rank_problems = list(range(ddp_rank, num_problems, ddp_world_size))
 
     # Run the evaluation
     num_passed, total = 0, 0
-    for i in range(ddp_rank, num_problems, ddp_world_size):
-        conversation = task_object[i]
-
-        # Tokenize the prompt
-        encoded_prompt = tokenizer.render_for_completion(conversation)
-        # Get the completions
-        results, _ = engine.generate_batch(
-            encoded_prompt,
-            num_samples=num_samples,
-            max_tokens=max_new_tokens,
-            temperature=temperature,
-            top_k=top_k,
-        )
-        # Decode the completions as text
-        prefix_length = len(encoded_prompt)
-        completions = [tokenizer.decode(result_tokens[prefix_length:]) for result_tokens in results]
-        # Evaluate success criteria
-        outcomes = [task_object.evaluate(conversation, completion) for completion in completions]
-        passed = any(outcomes)
-
-        # Keep stats
-        total += 1
-        num_passed += int(passed)
+    for i0 in range(0, len(rank_problems), batch_size):
+        conversations = [task_object[i] for i in rank_problems[i0:i0 + batch_size]]
+
+        # Tokenize the prompts
+        encoded_prompts = [tokenizer.render_for_completion(conversation) for conversation in conversations]
+        if num_beams > 1:
+            # Deterministic: the most likely completion found by beam search, one problem at a time
+            batch_results = [engine.beam_search(prompt, num_beams=num_beams, max_tokens=max_new_tokens)[0][:1] for prompt in encoded_prompts]
+        else:
+            # Get the completions, the prompts of the batch are decoded together (num_samples rows each)
+            batch_results, _ = engine.generate_batch(
+                encoded_prompts,
+                num_samples=num_samples,
+                batch_size=batch_size * num_samples,
+                max_tokens=max_new_tokens,
+                temperature=temperature,
+                top_k=top_k,
+            )
+        for conversation, encoded_prompt, results in zip(conversations, encoded_prompts, batch_results):
+            # Decode the completions as text
+            prefix_length = len(encoded_prompt)
+            completions = [tokenizer.decode(result_tokens[prefix_length:]) for result_tokens in results]
+            # Evaluate success criteria
+            outcomes = [task_object.evaluate(conversation, completion) for completion in completions]
+            passed = any(outcomes)
+
+            # Keep stats
+            total += 1
+            num_passed += int(passed)
 
         # Logging (overwrite the same line in the console)
         print(f"\r\033[KRank {ddp_rank} | {num_passed}/{total} ({100*num_passed/total:.2f}%)", end='', flush=True)
@@ -113,8 +120,10 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
         prompt_ids = torch.tensor(padded_prompt_ids, dtype=torch.long, device=device)
 
         # Get the logits for the whole batch of conversations in parallel (efficiency win here)
+        # Only the answer position of each row goes through the lm_head
         with torch.no_grad():
-            logits = model(prompt_ids) # (B, T, V)
+            positions = torch.tensor(answer_time_positions, dtype=torch.long, device=device)
+            logits = model(prompt_ids, positions=positions) # (B, 1, V)
 
         # Focus on the available answer on just the letters corresponding to choices
         # Note that this helps the evaluation a lot because it specifically narrows the focus to only the available letters
@@ -131,8 +140,7 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
                     letter_to_id_cache[letter] = encoded_letter[0]
                 letter_ids.append(letter_to_id_cache[letter])
             # focus logits just down to the answer position and the available letters of the answer
-            answer_pos = answer_time_positions[idx]
-            focus_logits = logits[idx, answer_pos, letter_ids]
+            focus_logits = logits[idx, 0, letter_ids]
             # get the argmax letter (the predicted answer)
             argmax_letter_id = focus_logits.argmax(dim=-1).item()
             predicted_letter = letters[argmax_letter_id]
@@ -158,7 +166,7 @@ def run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems
 
 def run_chat_eval(task_name, model, tokenizer, engine,
                    batch_size=1, num_samples=1, max_new_tokens=512, temperature=0.0, top_k=50,
-                   max_problems=None):
+                   max_problems=None, num_beams=1):
     # Create the evaluation object
     task_module = {
         'HumanEval': HumanEval,
@@ -171,7 +179,7 @@ def run_chat_eval(task_name, model, tokenizer, engine,
     task_object = task_module()
     # Run the evaluation
     if task_object.eval_type == 'generative':
-        acc = run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, max_problems=max_problems)
+        acc = run_generative_eval(task_object, tokenizer, model, engine, num_samples, max_new_tokens, temperature, top_k, batch_size=batch_size, max_problems=max_problems, num_beams=num_beams)
     elif task_object.eval_type == 'categorical':
         acc = run_categorical_eval(task_object, tokenizer, model, batch_size, max_problems=max_problems)
     else:
@@ -190,7 +198,8 @@ if __name__ == "__main__":
     parser.add_argument('-m', '--max-new-tokens', type=int, default=512)
     parser.add_argument('-n', '--num-samples', type=int, default=1)
     parser.add_argument('-k', '--top-k', type=int, default=50)
-    parser.add_argument('-b', '--batch-size', type=int, default=8, help='Batch size for categorical evaluation')
+    parser.add_argument('--num-beams', type=int, default=1, help='Beam search with this many beams for generative tasks (1 = sample)')
+    parser.add_argument('-b', '--batch-size', type=int, default=8, help='Problems per batch (generative evaluations decode all their samples together)')
     parser.add_argument('-g', '--model-tag', type=str, default=None, help='Model tag to load')
     parser.add_argument('-s', '--step', type=int, default=None, help='Step to load')
     parser.add_argument('-x', '--max-problems', type=int, default=None, help='Max problems to evaluate')
@@ -230,6 +239,7 @@ if __name__ == "__main__":
                 temperature=args.temperature,
                 top_k=args.top_k,
                 max_problems=args.max_problems,
+                num_beams=args.num_beams,
             )
             results[task_name] = acc
             print0(f"{task_name} accuracy: {100 * acc:.2f}%")
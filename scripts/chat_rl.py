@@ -105,20 +105,23 @@ def get_batch():
         model.eval() # ensure the model is in eval mode
         generated_token_sequences = []
         masks = []
+        sampling_logprobs = [] # log-probs of the tokens as the Engine sampled them
         num_sampling_steps = args.num_samples // args.device_batch_size # go sequentially to prevent OOMs
         for sampling_step in range(num_sampling_steps):
             seed = hash((step, example_idx, sampling_step)) & 0x7FFFFFFF # positive half of int32
             with autocast_ctx:
-                generated_token_sequences_batch, masks_batch = engine.generate_batch(
+                generated_token_sequences_batch, masks_batch, logprobs_batch = engine.generate_batch(
                     tokens,
                     num_samples=args.device_batch_size,
                     max_tokens=args.max_new_tokens,
                     temperature=args.temperature,
                     top_k=args.top_k,
                     seed=seed, # must make sure to change the seed for each sampling step
+                    logprobs=True,
                 )
             generated_token_sequences.extend(generated_token_sequences_batch)
             masks.extend(masks_batch)
+            sampling_logprobs.extend(logprobs_batch)
 
         # Calculate the rewards for each sample
         rewards = []
@@ -135,9 +138,11 @@ def get_batch():
         max_length = max(len(seq) for seq in generated_token_sequences)
         padded_generated_token_sequences = [seq + [assistant_end] * (max_length - len(seq)) for seq in generated_token_sequences]
         padded_masks = [mask + [0] * (max_length - len(mask)) for mask in masks]
+        padded_logprobs = [logprobs + [0.0] * (max_length - len(logprobs)) for logprobs in sampling_logprobs]
         # Stack up the sequences and masks into PyTorch tensors
         ids = torch.tensor(padded_generated_token_sequences, dtype=torch.long, device=device)
         mask_ids = torch.tensor(padded_masks, dtype=torch.long, device=device)
+        sampling_logp = torch.tensor(padded_logprobs, dtype=torch.float, device=device)[:, 1:] # aligned with targets
         # Generate autoregressive inputs and targets to the Transformer
         inputs = ids[:, :-1]
         targets = ids[:, 1:].clone() # clone to avoid in-place modification:
@@ -148,8 +153,8 @@ def get_batch():
         # Calculate the advantages by simply subtracting the mean (instead of z-score (x-mu)/sigma)
         mu = rewards.mean()
         advantages = rewards - mu
-        # yield inputs/targets as (B, T) of ids and rewards as (B,) of floats
-        yield generated_token_sequences, inputs, targets, rewards, advantages
+        # yield inputs/targets as (B, T) of ids, rewards as (B,) of floats and the sampling log-probs as (B, T)
+        yield generated_token_sequences, inputs, targets, rewards, advantages, sampling_logp
 
 # -----------------------------------------------------------------------------
 # Simple evaluation loop for GSM8K pass@k
@@ -167,34 +172,39 @@ def run_gsm8k_eval(task, tokenizer, engine,
     Because the evaluation can take a while, this function will yield records one by one.
     """
     max_examples = min(max_examples, len(task)) if max_examples is not None else len(task)
-    for idx in range(ddp_rank, max_examples, ddp_world_size):
-        conversation = task[idx]
-        tokens = tokenizer.render_for_completion(conversation)
-        prefix_length = len(tokens)
-        # Generate k samples using batched generation inside the Engine
-        assert num_samples <= args.device_batch_size # usually this is true. we can add a loop if not...
-        generated_token_sequences, masks = engine.generate_batch(
-            tokens,
+    rank_indices = list(range(ddp_rank, max_examples, ddp_world_size))
+    # Several examples at a time, their k samples each are all decoded together inside the Engine
+    assert num_samples <= args.device_batch_size # usually this is true. we can add a loop if not...
+    examples_per_batch = args.device_batch_size // num_samples
+    for i0 in range(0, len(rank_indices), examples_per_batch):
+        indices = rank_indices[i0:i0 + examples_per_batch]
+        conversations = [task[idx] for idx in indices]
+        prompts = [tokenizer.render_for_completion(conversation) for conversation in conversations]
+        batch_sequences, _ = engine.generate_batch(
+            prompts,
             num_samples=num_samples,
+            batch_size=args.device_batch_size,
             max_tokens=max_completion_tokens,
             temperature=temperature,
             top_k=top_k
         )
-        # Check each sample for correctness
-        outcomes = []
-        for sample_tokens in generated_token_sequences:
-            generated_tokens = sample_tokens[prefix_length:]
-            generated_text = tokenizer.decode(generated_tokens)
-            is_correct = task.evaluate(conversation, generated_text)
-            outcomes.append({
-                "is_correct": is_correct
-            })
-        # A bit bloated because I wanted to do more complex logging at one point.
-        record = {
-            "idx": idx,
-            "outcomes": outcomes,
-        }
-        yield record
+        for idx, conversation, tokens, generated_token_sequences in zip(indices, conversations, prompts, batch_sequences):
+            prefix_length = len(tokens)
+            # Check each sample for correctness
+            outcomes = []
+            for sample_tokens in generated_token_sequences:
+                generated_tokens = sample_tokens[prefix_length:]
+                generated_text = tokenizer.decode(generated_tokens)
+                is_correct = task.evaluate(conversation, generated_text)
+                outcomes.append({
+                    "is_correct": is_correct
+                })
+            # A bit bloated because I wanted to do more complex logging at one point.
+            record = {
+                "idx": idx,
+                "outcomes": outcomes,
+            }
+            yield record
 
 # -----------------------------------------------------------------------------
 # Training loop
@@ -244,17 +254,21 @@ for step in range(num_steps):
         print_passk = [f"Pass@{k}: {passk[k - 1].item():.4f}" for k in range(1, args.device_batch_size + 1)]
         print0(f"Step {step} | {', '.join(print_passk)}")
         log_passk = {f"pass@{k}": passk[k - 1].item() for k in range(1, args.device_batch_size + 1)}
+        tool_cache = engine.tool_cache
+        tool_cache_hit_rate = tool_cache.hits / max(1, tool_cache.hits + tool_cache.misses)
         wandb_run.log({
             "step": step,
+            "tool_cache_hit_rate": tool_cache_hit_rate,
             **log_passk,
         })
 
     # Forward/Backward on rollouts over multiple examples in the dataset
     rewards_list = []
     sequence_lengths = []
+    logprob_mismatches = []
     for example_step in range(examples_per_rank):
         # Get one batch corresponding to one example in the training dataset
-        sequences_all, inputs_all, targets_all, rewards_all, advantages_all = next(batch_iterator)
+        sequences_all, inputs_all, targets_all, rewards_all, advantages_all, sampling_logp_all = next(batch_iterator)
         # Evaluate the loss and gradients
         model.train() # ensure the model is in train mode
         # We need one more loop because we can never exceed the device_batch_size
@@ -267,6 +281,7 @@ for step in range(num_steps):
             targets = targets_all[b0:b1]
             rewards = rewards_all[b0:b1]
             advantages = advantages_all[b0:b1]
+            sampling_logp = sampling_logp_all[b0:b1]
             # Calculate log probabilities. Note that the loss calculates NLL = -logp, so we negate
             with autocast_ctx:
                 logp = -model(inputs, targets, loss_reduction='none').view_as(inputs) # (B, T)
@@ -275,7 +290,9 @@ for step in range(num_steps):
             # normalize by the number of valid tokens, number of passes, and examples_per_rank
             num_valid = (targets >= 0).sum().clamp(min=1)
             pg_obj = pg_obj / (num_valid * num_passes * examples_per_rank)
-            # Note, there is no need to add PPO ratio+clip because we are on policy
+            # Note, there is no need to add PPO ratio+clip because we are on policy. The forward above is still needed
+            # for the gradient, the log-probs the Engine sampled with only serve to check that we really are on policy
+            logprob_mismatches.append((((logp.detach() - sampling_logp).abs() * (targets >= 0)).sum() / num_valid).item())
             # Finally, formulate the loss that we want to minimize (instead of objective we wish to maximize)
             loss = -pg_obj
             loss.backward()
@@ -299,6 +316,7 @@ for step in range(num_steps):
         "step": step,
         "reward": mean_reward,
         "sequence_length": mean_sequence_length,
+        "logprob_mismatch": sum(logprob_mismatches) / len(logprob_mismatches), # mean |train - sampling| log-prob per token
     })
 
     # Update the model parameters
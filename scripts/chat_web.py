@@ -3,7 +3,9 @@
 Unified web chat server - serves both UI and API from a single FastAPI instance.
 
 Uses data parallelism to distribute requests across multiple GPUs. Each GPU loads
-a full copy of the model, and incoming requests are distributed to available workers.
+a full copy of the model, and incoming requests go to the least busy worker.
+Every worker decodes its requests together (continuous batching) on a dedicated
+thread, so the event loop never blocks on a forward pass.
 
 Launch examples:
 
@@ -21,6 +23,13 @@ Endpoints:
   GET  /health     - Health check with worker pool status
   GET  /stats      - Worker pool statistics and GPU utilization
 
+Sessions (opt-in with --sessions, not with --draft-model-tag): a request with a session_id resumes the KV cache saved under that id
+(on the local disk) and saves the conversation including the reply there, so the next turn only prefills
+the new messages. The store is capped by --max-sessions and --max-session-gb, least recently used go first.
+
+Log-probabilities: with logprobs (or top_logprobs > 0), the streamed chunks also carry the log-probability
+of every token under the model, with its top_logprobs most likely alternatives.
+
 Abuse Prevention:
   - Maximum 500 messages per request
   - Maximum 8000 characters per message
@@ -28,6 +37,7 @@ Abuse Prevention:
   - Temperature clamped to 0.0-2.0
   - Top-k clamped to 0-200 (0 disables top-k filtering, using full vocabulary)
   - Max tokens clamped to 1-4096
+  - At most 4 stop strings of at most 64 characters
 """
 
 import argparse
@@ -36,18 +46,21 @@ import os
 import torch
 import asyncio
 import logging
+import queue
 import random
+import threading
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, HTMLResponse, FileResponse
 from pydantic import BaseModel
 from typing import List, Optional, AsyncGenerator
-from dataclasses import dataclass
 from contextlib import nullcontext
 from nanochat.common import compute_init, autodetect_device_type
 from nanochat.checkpoint_manager import load_model
-from nanochat.engine import Engine
+from nanochat.engine import Engine, Scheduler, Request
+from nanochat.prefix_cache import PrefixCache
+from nanochat.session import is_valid_session_id, session_path
 
 # Abuse prevention limits
 MAX_MESSAGES_PER_REQUEST = 500
@@ -57,8 +70,14 @@ MIN_TEMPERATURE = 0.0
 MAX_TEMPERATURE = 2.0
 MIN_TOP_K = 0 # 0 disables top-k filtering, using full vocabulary
 MAX_TOP_K = 200
+# top_p (nucleus) and min_p filtering, 1.0 / 0.0 disable them
+MIN_TOP_P, MAX_TOP_P = 0.0, 1.0
+MIN_MIN_P, MAX_MIN_P = 0.0, 1.0
 MIN_MAX_TOKENS = 1
 MAX_MAX_TOKENS = 4096
+MAX_TOP_LOGPROBS = 20
+MAX_STOP_STRINGS = 4
+MAX_STOP_LENGTH = 64
 
 parser = argparse.ArgumentParser(description='NanoChat Web Server')
 parser.add_argument('-n', '--num-gpus', type=int, default=1, help='Number of GPUs to use (default: 1)')
@@ -72,7 +91,21 @@ parser.add_argument('-p', '--port', type=int, default=8000, help='Port to run th
 parser.add_argument('-d', '--dtype', type=str, default='bfloat16', choices=['float32', 'bfloat16'])
 parser.add_argument('--device-type', type=str, default='', choices=['cuda', 'cpu', 'mps'], help='Device type for evaluation: cuda|cpu|mps. empty => autodetect')
 parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to bind the server to')
+parser.add_argument('--prefix-cache-tokens', type=int, default=8192, help='Max tokens kept in the prefix KV cache of each worker (0 = disable)')
+parser.add_argument('--draft-model-tag', type=str, default=None, help='Model tag of a small draft model (same source) for speculative decoding')
+parser.add_argument('--num-draft-tokens', type=int, default=4, help='Number of tokens drafted per step in speculative decoding')
+parser.add_argument('--batch-size', type=int, default=8, help='Max number of requests decoded together on each worker')
+parser.add_argument('--prefill-chunk-size', type=int, default=512, help='Max prompt tokens per prefill forward pass (0 = whole prompt at once)')
+parser.add_argument('--quantize', type=str, default=None, choices=['int8', 'int4'], help='Weight-only quantization of the model for inference: int8|int4 (see nanochat/quantize.py)')
+parser.add_argument('--sessions', action='store_true', help='Allow requests to resume and save sessions (KV caches on the local disk) by session_id')
+parser.add_argument('--max-sessions', type=int, default=256, help='Max number of sessions kept on disk (least recently used are deleted)')
+parser.add_argument('--max-session-gb', type=float, default=4.0, help='Max total size of the sessions kept on disk, in GB')
+parser.add_argument('--compile-decode', action='store_true', help='torch.compile the decode step (static shapes, compiled for every batch bucket at startup)')
+parser.add_argument('--rope-scaling', type=str, default=None, choices=['ntk', 'yarn'], help='Scale the rotary embeddings to serve contexts longer than trained on: ntk|yarn')
+parser.add_argument('--context-factor', type=float, default=2.0, help='With --rope-scaling, the max context as a multiple of the trained sequence length')
 args = parser.parse_args()
+if args.sessions and args.draft_model_tag:
+    parser.error("--sessions is not supported with speculative decoding (--draft-model-tag)")
 
 # Configure logging for conversation traffic
 logging.basicConfig(
@@ -86,14 +119,83 @@ device_type = autodetect_device_type() if args.device_type == "" else args.devic
 ddp, ddp_rank, ddp_local_rank, ddp_world_size, device = compute_init(device_type)
 ptdtype = torch.float32 if args.dtype == 'float32' else torch.bfloat16
 
-@dataclass
 class Worker:
-    """A worker with a model loaded on a specific GPU."""
-    gpu_id: int
-    device: torch.device
-    engine: Engine
-    tokenizer: object
-    autocast_ctx: torch.amp.autocast
+    """
+    A model replica on one device with its own generation thread.
+    Requests are submitted from the event loop and decoded by a Scheduler (continuous batching)
+    on the worker thread. Tokens are handed back to the event loop through the request callback.
+    With a draft model (speculative decoding is batch size 1), requests are decoded one at a time.
+    """
+
+    def __init__(self, gpu_id: int, device: torch.device, engine: Engine, tokenizer, autocast_ctx, batch_size: int):
+        self.gpu_id = gpu_id
+        self.device = device
+        self.engine = engine
+        self.tokenizer = tokenizer
+        self.autocast_ctx = autocast_ctx
+        self.max_seq_len = engine.context_len()
+        with autocast_ctx: # the KV cache is allocated in the dtype the model will compute in
+            self.scheduler = Scheduler(engine, batch_size=batch_size, max_sessions=args.max_sessions, max_session_bytes=int(args.max_session_gb * 1024**3)) if engine.draft_model is None else None
+            if self.scheduler is not None:
+                engine.warmup(batch_size) # compile the decode step (--compile-decode) before taking requests
+        self.speculative_requests = queue.Queue()
+        self.num_requests = 0 # requests in flight, only touched from the event loop
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name=f"worker-{gpu_id}", daemon=True)
+        self.thread.start()
+
+    def submit(self, tokens, callback, max_tokens, temperature, top_k, top_p, min_p, seed, session_id=None, logprobs=False, top_logprobs=0, stop=None) -> Request:
+        """Queue up a request (from any thread), callback gets called with its (token, mask[, logprobs]) items and a final None."""
+        if self.scheduler is not None:
+            path = session_path(session_id) if session_id is not None else None
+            request = self.scheduler.submit(tokens, max_tokens=max_tokens, temperature=temperature, top_k=top_k, seed=seed, top_p=top_p, min_p=min_p,
+                                            callback=callback, session_path=path, logprobs=logprobs, top_logprobs=top_logprobs, stop=stop)
+        else:
+            assert session_id is None, "Sessions are not supported with speculative decoding" # see the --sessions check at startup
+            request = Request(tokens, max_tokens, temperature, top_k, top_p, min_p, seed, callback, logprobs=logprobs, top_logprobs=top_logprobs, stop=stop)
+            self.speculative_requests.put(request)
+        self.wakeup.set()
+        return request
+
+    def _loop(self):
+        # autocast is thread local, so it is entered on the generation thread
+        with self.autocast_ctx:
+            while True:
+                self.wakeup.wait()
+                self.wakeup.clear() # anything submitted from here on sets it again
+                if self.scheduler is not None:
+                    try:
+                        while self.scheduler.has_work():
+                            self.scheduler.step()
+                    except Exception as e:
+                        logger.exception(f"Generation failed on worker {self.gpu_id}")
+                        self.scheduler.abort(e) # ends the streams of its requests, the next ones start on an empty KV cache
+                        self.wakeup.set() # serve whatever is still pending
+                while not self.speculative_requests.empty():
+                    self._generate(self.speculative_requests.get())
+
+    def _generate(self, request: Request):
+        try:
+            for columns in self.engine.generate(
+                request.state.current_tokens,
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                top_k=request.top_k,
+                top_p=request.top_p,
+                min_p=request.min_p,
+                seed=request.seed,
+                logprobs=request.logprobs,
+                top_logprobs=request.top_logprobs,
+                stop=request.state.stop,
+            ):
+                if request.cancelled:
+                    break
+                request.put(tuple(column[0] for column in columns))
+        except Exception as e:
+            logger.exception(f"Generation failed on worker {self.gpu_id}")
+            request.put(e)
+        finally:
+            request.put(None)
 
 class WorkerPool:
     """Pool of workers, each with a model replica on a different GPU."""
@@ -106,7 +208,6 @@ class WorkerPool:
                 num_gpus = 1 # e.g. cpu|mps
         self.num_gpus = num_gpus
         self.workers: List[Worker] = []
-        self.available_workers: asyncio.Queue = asyncio.Queue()
 
     async def initialize(self, source: str, model_tag: Optional[str] = None, step: Optional[int] = None):
         """Load model on each GPU."""
@@ -123,8 +224,15 @@ class WorkerPool:
                 device = torch.device(device_type) # e.g. cpu|mps
                 print(f"Loading model on {device_type}...")
 
-            model, tokenizer, _ = load_model(source, device, phase="eval", model_tag=model_tag, step=step)
-            engine = Engine(model, tokenizer)
+            model, tokenizer, _ = load_model(source, device, phase="eval", model_tag=model_tag, step=step, quantize=args.quantize)
+            model.fuse_qkv() # one matmul for q, k, v
+            draft_model = load_model(source, device, phase="eval", model_tag=args.draft_model_tag, quantize=args.quantize)[0].fuse_qkv() if args.draft_model_tag else None
+            if args.rope_scaling is not None:
+                for m in (model, draft_model):
+                    if m is not None:
+                        m.set_rope_scaling(args.rope_scaling, args.context_factor)
+            prefix_cache = PrefixCache(max_tokens=args.prefix_cache_tokens) if args.prefix_cache_tokens > 0 else None
+            engine = Engine(model, tokenizer, prefix_cache=prefix_cache, draft_model=draft_model, num_draft_tokens=args.num_draft_tokens, prefill_chunk_size=args.prefill_chunk_size or None, compile_decode=args.compile_decode)
             autocast_ctx = torch.amp.autocast(device_type=device_type, dtype=ptdtype) if device_type == "cuda" else nullcontext()
 
             worker = Worker(
@@ -132,20 +240,19 @@ class WorkerPool:
                 device=device,
                 engine=engine,
                 tokenizer=tokenizer,
-                autocast_ctx=autocast_ctx
+                autocast_ctx=autocast_ctx,
+                batch_size=args.batch_size,
             )
             self.workers.append(worker)
-            await self.available_workers.put(worker)
 
         print(f"All {self.num_gpus} workers initialized!")
 
-    async def acquire_worker(self) -> Worker:
-        """Get an available worker from the pool."""
-        return await self.available_workers.get()
+    def pick_worker(self) -> Worker:
+        """The worker with the fewest requests in flight."""
+        return min(self.workers, key=lambda worker: worker.num_requests)
 
-    async def release_worker(self, worker: Worker):
-        """Return a worker to the pool."""
-        await self.available_workers.put(worker)
+    def num_idle_workers(self) -> int:
+        return sum(worker.num_requests == 0 for worker in self.workers)
 
 class ChatMessage(BaseModel):
     role: str
@@ -156,6 +263,12 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = None
     max_tokens: Optional[int] = None
     top_k: Optional[int] = None
+    top_p: Optional[float] = None
+    min_p: Optional[float] = None
+    session_id: Optional[str] = None
+    logprobs: Optional[bool] = None
+    top_logprobs: Optional[int] = None
+    stop: Optional[List[str]] = None
 
 def validate_chat_request(request: ChatRequest):
     """Validate chat request to prevent abuse."""
@@ -212,6 +325,38 @@ def validate_chat_request(request: ChatRequest):
                 detail=f"top_k must be between {MIN_TOP_K} and {MAX_TOP_K}"
             )
 
+    # Validate top_logprobs
+    if request.top_logprobs is not None and not (0 <= request.top_logprobs <= MAX_TOP_LOGPROBS):
+        raise HTTPException(status_code=400, detail=f"top_logprobs must be between 0 and {MAX_TOP_LOGPROBS}")
+
+    # Validate stop strings
+    if request.stop is not None:
+        if len(request.stop) > MAX_STOP_STRINGS:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_STOP_STRINGS} stop strings allowed")
+        if any(not (1 <= len(stop) <= MAX_STOP_LENGTH) for stop in request.stop):
+            raise HTTPException(status_code=400, detail=f"Stop strings must be 1-{MAX_STOP_LENGTH} characters long")
+
+    # Validate session id
+    if request.session_id is not None:
+        if not args.sessions:
+            raise HTTPException(status_code=400, detail="Sessions are disabled on this server (start it with --sessions)")
+        if not is_valid_session_id(request.session_id):
+            raise HTTPException(status_code=400, detail="session_id must be 1-128 letters, digits, '-' or '_'")
+
+    # Validate top_p and min_p
+    if request.top_p is not None:
+        if not (MIN_TOP_P < request.top_p <= MAX_TOP_P):
+            raise HTTPException(
+                status_code=400,
+                detail=f"top_p must be greater than {MIN_TOP_P} and at most {MAX_TOP_P}"
+            )
+    if request.min_p is not None:
+        if not (MIN_MIN_P <= request.min_p <= MAX_MIN_P):
+            raise HTTPException(
+                status_code=400,
+                detail=f"min_p must be between {MIN_MIN_P} and {MAX_MIN_P}"
+            )
+
     # Validate max_tokens
     if request.max_tokens is not None:
         if not (MIN_MAX_TOKENS <= request.max_tokens <= MAX_MAX_TOKENS):
@@ -264,7 +409,13 @@ async def generate_stream(
     tokens,
     temperature=None,
     max_new_tokens=None,
-    top_k=None
+    top_k=None,
+    top_p=None,
+    min_p=None,
+    session_id=None,
+    logprobs=False,
+    top_logprobs=0,
+    stop=None
 ) -> AsyncGenerator[str, None]:
     """Generate assistant response with streaming."""
     temperature = temperature if temperature is not None else args.temperature
@@ -274,39 +425,60 @@ async def generate_stream(
     assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
     bos = worker.tokenizer.get_bos_token_id()
 
-    # Accumulate tokens to properly handle multi-byte UTF-8 characters (like emojis)
-    accumulated_tokens = []
-    # Track the last complete UTF-8 string (without replacement characters)
-    last_clean_text = ""
-
-    with worker.autocast_ctx:
-        for token_column, token_masks in worker.engine.generate(
-            tokens,
-            num_samples=1,
-            max_tokens=max_new_tokens,
-            temperature=temperature,
-            top_k=top_k,
-            seed=random.randint(0, 2**31 - 1)
-        ):
-            token = token_column[0]
+    # Decode incrementally, multi-byte UTF-8 characters (like emojis) split across tokens are held back until complete
+    decoder = worker.tokenizer.stream_decoder()
+
+    # The worker thread hands the tokens over to this event loop through an asyncio queue
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    request = worker.submit(
+        tokens,
+        callback=lambda item: loop.call_soon_threadsafe(items.put_nowait, item),
+        max_tokens=max_new_tokens,
+        temperature=temperature,
+        top_k=top_k,
+        top_p=top_p,
+        min_p=min_p,
+        seed=random.randint(0, 2**31 - 1),
+        session_id=session_id,
+        logprobs=logprobs,
+        top_logprobs=top_logprobs,
+        stop=stop
+    )
+    decode = lambda token: worker.tokenizer.decode([token])
+    logprob_entries = [] # of the tokens since the last chunk, sent along with the next one
+    try:
+        while (item := await items.get()) is not None:
+            if isinstance(item, Exception): # generation failed, the worker has already logged it
+                yield f"data: {json.dumps({'error': 'Generation failed'})}\n\n"
+                continue # up to the None that follows
+            token = item[0]
 
             # Stopping criteria
             if token == assistant_end or token == bos:
                 break
 
-            # Append the token to sequence
-            accumulated_tokens.append(token)
-            # Decode all accumulated tokens to get proper UTF-8 handling
-            # Note that decode is a quite efficient operation, basically table lookup and string concat
-            current_text = worker.tokenizer.decode(accumulated_tokens)
-            # Only emit text if it doesn't end with a replacement character
-            # This ensures we don't emit incomplete UTF-8 sequences
-            if not current_text.endswith('�'):
-                # Extract only the new text since last clean decode
-                new_text = current_text[len(last_clean_text):]
-                if new_text:  # Only yield if there's new content
-                    yield f"data: {json.dumps({'token': new_text, 'gpu': worker.gpu_id}, ensure_ascii=False)}\n\n"
-                    last_clean_text = current_text
+            if len(item) == 3:
+                logprob, top = item[2]
+                logprob_entries.append({
+                    "id": token, "token": decode(token), "logprob": logprob,
+                    "top_logprobs": [{"id": t, "token": decode(t), "logprob": lp} for t, lp in top],
+                })
+            new_text = decoder.step(token)
+            if new_text:  # Only yield if there's new content
+                data = {'token': new_text, 'gpu': worker.gpu_id}
+                if logprob_entries:
+                    data['logprobs'], logprob_entries = logprob_entries, []
+                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    finally:
+        request.cancel() # no-op if it's done, frees its row right away if the client went away
+
+    new_text = decoder.flush()
+    if new_text or logprob_entries:
+        data = {'token': new_text, 'gpu': worker.gpu_id}
+        if logprob_entries:
+            data['logprobs'] = logprob_entries
+        yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
     yield f"data: {json.dumps({'done': True})}\n\n"
 
@@ -323,63 +495,70 @@ async def chat_completions(request: ChatRequest):
         logger.info(f"[{message.role.upper()}]: {message.content}")
     logger.info("-"*20)
 
-    # Acquire a worker from the pool (will wait if all are busy)
+    # Pick the least busy worker, requests on a worker are decoded together
     worker_pool = app.state.worker_pool
-    worker = await worker_pool.acquire_worker()
+    worker = worker_pool.pick_worker()
+    worker.num_requests += 1 # right away, so that a burst of requests spreads over the workers
 
-    try:
-        # Build conversation tokens
-        bos = worker.tokenizer.get_bos_token_id()
-        user_start = worker.tokenizer.encode_special("<|user_start|>")
-        user_end = worker.tokenizer.encode_special("<|user_end|>")
-        assistant_start = worker.tokenizer.encode_special("<|assistant_start|>")
-        assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
-
-        conversation_tokens = [bos]
-        for message in request.messages:
-            if message.role == "user":
-                conversation_tokens.append(user_start)
-                conversation_tokens.extend(worker.tokenizer.encode(message.content))
-                conversation_tokens.append(user_end)
-            elif message.role == "assistant":
-                conversation_tokens.append(assistant_start)
-                conversation_tokens.extend(worker.tokenizer.encode(message.content))
-                conversation_tokens.append(assistant_end)
-
-        conversation_tokens.append(assistant_start)
-
-        # Streaming response with worker release after completion
-        response_tokens = []
-        async def stream_and_release():
-            try:
-                async for chunk in generate_stream(
-                    worker,
-                    conversation_tokens,
-                    temperature=request.temperature,
-                    max_new_tokens=request.max_tokens,
-                    top_k=request.top_k
-                ):
-                    # Accumulate response for logging
-                    chunk_data = json.loads(chunk.replace("data: ", "").strip())
-                    if "token" in chunk_data:
-                        response_tokens.append(chunk_data["token"])
-                    yield chunk
-            finally:
-                # Log the assistant response to console
-                full_response = "".join(response_tokens)
-                logger.info(f"[ASSISTANT] (GPU {worker.gpu_id}): {full_response}")
-                logger.info("="*20)
-                # Release worker back to pool after streaming is done
-                await worker_pool.release_worker(worker)
-
-        return StreamingResponse(
-            stream_and_release(),
-            media_type="text/event-stream"
+    # Build conversation tokens
+    bos = worker.tokenizer.get_bos_token_id()
+    user_start = worker.tokenizer.encode_special("<|user_start|>")
+    user_end = worker.tokenizer.encode_special("<|user_end|>")
+    assistant_start = worker.tokenizer.encode_special("<|assistant_start|>")
+    assistant_end = worker.tokenizer.encode_special("<|assistant_end|>")
+
+    conversation_tokens = [bos]
+    for message in request.messages:
+        if message.role == "user":
+            conversation_tokens.append(user_start)
+            conversation_tokens.extend(worker.tokenizer.encode(message.content))
+            conversation_tokens.append(user_end)
+        elif message.role == "assistant":
+            conversation_tokens.append(assistant_start)
+            conversation_tokens.extend(worker.tokenizer.encode(message.content))
+            conversation_tokens.append(assistant_end)
+
+    conversation_tokens.append(assistant_start)
+    if len(conversation_tokens) >= worker.max_seq_len:
+        worker.num_requests -= 1
+        raise HTTPException(
+            status_code=400,
+            detail=f"Conversation is too long. Maximum {worker.max_seq_len} tokens allowed"
         )
-    except Exception as e:
-        # Make sure to release worker even on error
-        await worker_pool.release_worker(worker)
-        raise e
+
+    # Streaming response, logged once it is done
+    response_tokens = []
+    async def stream_and_log():
+        try:
+            async for chunk in generate_stream(
+                worker,
+                conversation_tokens,
+                temperature=request.temperature,
+                max_new_tokens=request.max_tokens,
+                top_k=request.top_k,
+                top_p=request.top_p,
+                min_p=request.min_p,
+                session_id=request.session_id,
+                logprobs=bool(request.logprobs),
+                top_logprobs=request.top_logprobs or 0,
+                stop=request.stop
+            ):
+                # Accumulate response for logging
+                chunk_data = json.loads(chunk.replace("data: ", "").strip())
+                if "token" in chunk_data:
+                    response_tokens.append(chunk_data["token"])
+                yield chunk
+        finally:
+            worker.num_requests -= 1
+            # Log the assistant response to console
+            full_response = "".join(response_tokens)
+            logger.info(f"[ASSISTANT] (GPU {worker.gpu_id}): {full_response}")
+            logger.info("="*20)
+
+    return StreamingResponse(
+        stream_and_log(),
+        media_type="text/event-stream"
+    )
 
 @app.get("/health")
 async def health():
@@ -389,7 +568,7 @@ async def health():
         "status": "ok",
         "ready": worker_pool is not None and len(worker_pool.workers) > 0,
         "num_gpus": worker_pool.num_gpus if worker_pool else 0,
-        "available_workers": worker_pool.available_workers.qsize() if worker_pool else 0
+        "available_workers": worker_pool.num_idle_workers() if worker_pool else 0
     }
 
 @app.get("/stats")
@@ -398,12 +577,13 @@ async def stats():
     worker_pool = app.state.worker_pool
     return {
         "total_workers": len(worker_pool.workers),
-        "available_workers": worker_pool.available_workers.qsize(),
-        "busy_workers": len(worker_pool.workers) - worker_pool.available_workers.qsize(),
+        "available_workers": worker_pool.num_idle_workers(),
+        "busy_workers": len(worker_pool.workers) - worker_pool.num_idle_workers(),
         "workers": [
             {
                 "gpu_id": w.gpu_id,
-                "device": str(w.device)
+                "device": str(w.device),
+                "active_requests": w.num_requests
             } for w in worker_pool.workers
         ]
     }
@@ -332,6 +332,75 @@ class TestSDPAOnly:
         assert cache.get_pos() == T_prefill + 1
         set_impl(None)
 
+    def test_kvcache_paged_matches_contiguous(self):
+        """Paged KV cache (scattered pages, rows at different lengths) matches the contiguous cache."""
+        set_impl('sdpa')
+        B, T_max, H, D = 2, 32, 4, 16
+        page_size = 4
+        lengths = [10, 3]
+        window = 6
+
+        k_cache = torch.zeros(B, T_max, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        v_cache = torch.zeros(B, T_max, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        k_pages = torch.zeros(2 * T_max // page_size, page_size, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        v_pages = torch.zeros_like(k_pages)
+        # hand out pages in a scrambled order so rows are not contiguous in the pool
+        page_table = torch.tensor([[5, 0, 7, 2, 9, 11, 13, 15], [3, 14, 1, 4, 6, 8, 10, 12]], dtype=torch.int32, device=self.DEVICE)
+        for b, length in enumerate(lengths):
+            k_init = torch.randn(length, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            v_init = torch.randn(length, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            k_cache[b, :length] = k_init
+            v_cache[b, :length] = v_init
+            for t in range(length):
+                page = page_table[b, t // page_size]
+                k_pages[page, t % page_size] = k_init[t]
+                v_pages[page, t % page_size] = v_init[t]
+
+        for T_new in [1, 3]: # decode and chunked prefill
+            q = torch.randn(B, T_new, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            k = torch.randn(B, T_new, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            v = torch.randn(B, T_new, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            cache_seqlens = torch.tensor(lengths, dtype=torch.int32, device=self.DEVICE)
+            y_contiguous = flash_attn.flash_attn_with_kvcache(
+                q, k_cache, v_cache, k=k, v=v, cache_seqlens=cache_seqlens,
+                causal=True, window_size=(window, 0)
+            )
+            y_paged = flash_attn.flash_attn_with_kvcache(
+                q, k_pages, v_pages, k=k, v=v, cache_seqlens=cache_seqlens,
+                causal=True, window_size=(window, 0), page_table=page_table
+            )
+            assert_close(y_contiguous, y_paged, "paged", atol=1e-5, rtol=1e-5)
+            lengths = [length + T_new for length in lengths]
+        set_impl(None)
+
+    def test_ring_kvcache_matches_full(self):
+        """A ring buffer of window + 1 (or more) slots gives the same sliding window attention as the full cache, across wraps."""
+        set_impl('sdpa')
+        B, T_max, H, D = 2, 40, 4, 16
+        window = 6
+        for ring_size in [window + 1, window + 3]:
+            self._check_ring_kvcache(B, T_max, H, D, window, ring_size)
+        set_impl(None)
+
+    def _check_ring_kvcache(self, B, T_max, H, D, window, ring_size):
+        k_cache = torch.zeros(B, T_max, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        v_cache = torch.zeros_like(k_cache)
+        k_ring = torch.zeros(B, ring_size, H, D, device=self.DEVICE, dtype=self.DTYPE)
+        v_ring = torch.zeros_like(k_ring)
+        lengths = [0, 3] # rows at different positions
+        for T_new in [5, 1, 1, 9, 2, 1, 1, 1]: # prefill chunks longer and shorter than the ring, and decode
+            q = torch.randn(B, T_new, H * 2, D, device=self.DEVICE, dtype=self.DTYPE) # GQA
+            k = torch.randn(B, T_new, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            v = torch.randn(B, T_new, H, D, device=self.DEVICE, dtype=self.DTYPE)
+            cache_seqlens = torch.tensor(lengths, dtype=torch.int32, device=self.DEVICE)
+            y_full = flash_attn.flash_attn_with_kvcache(
+                q, k_cache, v_cache, k=k, v=v, cache_seqlens=cache_seqlens,
+                causal=True, window_size=(window, 0)
+            )
+            y_ring = flash_attn.flash_attn_with_ring_kvcache(q, k_ring, v_ring, k, v, cache_seqlens, (window, 0))
+            assert_close(y_full, y_ring, "ring", atol=1e-5, rtol=1e-5)
+            lengths = [length + T_new for length in lengths]
+
 
 # =============================================================================
 # Override mechanism tests
@@ -4,8 +4,18 @@ Test Engine class. Example run:
 python -m pytest tests/test_engine.py -v
 """
 
+import os
+import pytest
+import time
+import threading
 import torch
-from nanochat.engine import KVCache, Engine
+import nanochat.engine as engine_module
+from nanochat.engine import ToolCall, use_calculator, KVCache, PagedKVCache, Engine, Scheduler, speculative_sample, sample_tokens, sampling_params, filter_logits, rng_keys
+from nanochat.gpt import GPT, GPTConfig, rotary_embeddings
+from nanochat.prefix_cache import PrefixCache
+from nanochat.session import Session, model_fingerprint, restore_session, save_session
+from nanochat.constraints import RegexConstraint, choice_constraint
+from nanochat.decode_step import DecodeStep
 from dataclasses import dataclass
 
 
@@ -20,6 +30,7 @@ class MockConfig:
     n_embd: int = 64
     n_layer: int = 2
     sequence_len: int = 128
+    vocab_size: int = 262
 
 
 class MockModel:
@@ -31,22 +42,52 @@ class MockModel:
     def __init__(self, vocab_size=262):  # 256 bytes + 6 special tokens
         self.vocab_size = vocab_size
         self.config = MockConfig()
-        self._device = "cpu"
+        self._device = torch.device("cpu")
 
     def get_device(self):
         return self._device
 
-    def forward(self, ids, kv_cache=None):
+    def forward(self, ids, kv_cache=None, positions=None):
         """Return uniform logits so sampling is spread across vocab."""
         B, T = ids.shape
         # With FA3, flash_attn_with_kvcache updates cache in-place and we advance position
         if kv_cache is not None:
             kv_cache.advance(T)
         # Uniform logits -> equal probability for all tokens
+        if positions is not None:
+            T = 1 if isinstance(positions, int) else positions.view(B, -1).size(1)
         logits = torch.zeros(B, T, self.vocab_size)
         return logits
 
 
+class ScriptedModel(MockModel):
+    """
+    Mock model that always predicts the next token of a fixed script (by absolute position),
+    except at the positions in wrong, where it predicts a different token.
+    """
+    def __init__(self, script, wrong=()):
+        super().__init__()
+        self.script = script
+        self.wrong = set(wrong)
+
+    def forward(self, ids, kv_cache=None, positions=None):
+        B, T = ids.shape
+        starts = kv_cache.cache_seqlens.tolist() if kv_cache is not None else [0] * B
+        if kv_cache is not None:
+            kv_cache.advance(T)
+        if positions is None:
+            positions = list(range(T))
+        else:
+            positions = [positions % T] if isinstance(positions, int) else positions.view(-1).tolist()
+        logits = torch.zeros(B, len(positions), self.vocab_size)
+        for b, start in enumerate(starts):
+            for i, t in enumerate(positions):
+                pos = min(start + t + 1, len(self.script) - 1)
+                token = self.script[pos] if pos not in self.wrong else (self.script[pos] + 1) % 256
+                logits[b, i, token] = 10.0
+        return logits
+
+
 class ByteTokenizer:
     """
     Simple byte-level tokenizer for testing.
@@ -81,6 +122,23 @@ class ByteTokenizer:
         byte_tokens = [t for t in tokens if t < 256]
         return bytes(byte_tokens).decode("utf-8", errors="replace")
 
+def build_tiny_model(seed=0):
+    """
+    A tiny real GPT on CPU (vocab covers the ByteTokenizer) with all weights random.
+    init_weights() zeros the output projections, which would make attention a no-op,
+    so we re-randomize everything to make the positions actually matter.
+    """
+    config = GPTConfig(sequence_len=64, vocab_size=262, n_layer=2, n_head=4, n_kv_head=2, n_embd=64, window_pattern="SL")
+    torch.manual_seed(seed)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for name, p in model.named_parameters():
+            if p.ndim == 2:
+                torch.nn.init.normal_(p, std=0.5 if "wte" in name or "lm_head" in name else 0.1)
+    model.eval()
+    return model
+
 def test_kv_cache_basic():
     """Test basic KVCache functionality for FA3."""
     batch_size = 2
@@ -265,3 +323,822 @@ def test_different_seeds_introduce_variation_when_temperature_nonzero():
 
     # Sanity check: sampling actually introduces variation
     assert len(outputs) > 1, "All seeds produced the same output which is statistically highly improbable."
+
+
+def test_kv_cache_narrow_and_move_row():
+    """narrow() views share storage with the parent cache, move_row() copies a row."""
+    kv_cache = KVCache(batch_size=3, num_heads=2, seq_len=16, head_dim=4, num_layers=2, device="cpu", dtype=torch.float32)
+    view = kv_cache.narrow(1, 2)
+    view.advance(5)
+    assert kv_cache.cache_seqlens.tolist() == [0, 5, 5]
+    view.k_cache[:, 1, :5] = 3.0
+    kv_cache.move_row(2, 0, 5)
+    assert kv_cache.cache_seqlens.tolist() == [5, 5, 5]
+    assert (kv_cache.k_cache[:, 0, :5] == 3.0).all()
+
+
+def test_ragged_positions_match_single_rows():
+    """Rows at different positions in one batch give the same logits as running each row alone."""
+    model = build_tiny_model()
+    engine = Engine(model, ByteTokenizer())
+    prompts = [[261, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11], [261, 20, 21], [261, 30, 31, 32, 33, 34, 35]]
+    next_tokens = [40, 41, 42]
+    with torch.inference_mode():
+        # reference: each row alone
+        expected = []
+        for prompt, token in zip(prompts, next_tokens):
+            kv_cache = engine.new_kv_cache(1, 64, "cpu", torch.float32)
+            model.forward(torch.tensor([prompt]), kv_cache=kv_cache)
+            expected.append(model.forward(torch.tensor([[token]]), kv_cache=kv_cache)[:, -1, :])
+        # batched: prefill every row separately, then decode all rows together
+        kv_cache = engine.new_kv_cache(len(prompts), 64, "cpu", torch.float32)
+        for row, prompt in enumerate(prompts):
+            model.forward(torch.tensor([prompt]), kv_cache=kv_cache.narrow(row, 1))
+        logits = model.forward(torch.tensor(next_tokens).unsqueeze(1), kv_cache=kv_cache)[:, -1, :]
+    assert kv_cache.cache_seqlens.tolist() == [len(p) + 1 for p in prompts]
+    assert torch.allclose(logits, torch.cat(expected), atol=1e-4)
+
+
+def test_scheduler_matches_engine():
+    """Requests admitted at different steps into one continuous batch produce the same greedy outputs as Engine."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer)
+    prompts = [[261, 72, 101, 108, 108, 111], [261, 1, 2, 3, 4, 5, 6, 7, 8, 9], [261, 50], [261, 9, 8, 7]]
+    max_tokens = 12
+    expected = []
+    for prompt in prompts:
+        results, _ = engine.generate_batch(prompt, max_tokens=max_tokens, temperature=0.0)
+        expected.append(results[0][len(prompt):])
+
+    scheduler = Scheduler(engine, batch_size=2, seq_len=64) # fewer rows than requests => queueing
+    requests = [scheduler.submit(prompts[0], max_tokens=max_tokens, temperature=0.0)]
+    scheduler.step()
+    scheduler.step()
+    requests += [scheduler.submit(prompt, max_tokens=max_tokens, temperature=0.0) for prompt in prompts[1:]]
+    while scheduler.has_work():
+        assert scheduler.step() <= 2
+    assistant_end = tokenizer.encode_special("<|assistant_end|>")
+    for request, expected_tokens in zip(requests, expected):
+        tokens = [token for token, _ in request if token not in (assistant_end, tokenizer.get_bos_token_id())]
+        assert tokens == expected_tokens
+
+
+def test_scheduler_seed_independent_of_batch():
+    """A request's samples depend only on its own seed, not on which other requests share the batch."""
+    engine = Engine(MockModel(), ByteTokenizer())
+    prompt = [261, 72, 101, 108, 108, 111]
+
+    scheduler = Scheduler(engine, batch_size=4, seq_len=64)
+    alone = scheduler.submit(prompt, max_tokens=8, seed=7)
+    while scheduler.has_work():
+        scheduler.step()
+
+    scheduler = Scheduler(engine, batch_size=4, seq_len=64)
+    others = [scheduler.submit(prompt, max_tokens=5, seed=s) for s in (1, 2)]
+    together = scheduler.submit(prompt, max_tokens=8, seed=7)
+    while scheduler.has_work():
+        scheduler.step()
+    assert list(alone) == list(together)
+    assert all(len(list(request)) == 5 for request in others)
+
+
+def test_paged_kv_cache_allocation():
+    """Pages are handed out on demand from the shared pool and returned when a row is freed."""
+    kv_cache = PagedKVCache(batch_size=2, num_heads=2, seq_len=32, head_dim=4, num_layers=2, device="cpu", dtype=torch.float32, page_size=8, num_pages=5)
+    assert kv_cache.reserve(0, 9) # 2 pages
+    assert kv_cache.reserve(1, 16) # 2 pages
+    assert kv_cache.num_free_tokens() == 8
+    assert not kv_cache.reserve(1, 32) # needs 2 more pages, only 1 left
+    assert kv_cache.row_pages[1] == [2, 3] # a failed reserve allocates nothing
+    kv_cache.free_row(0)
+    assert kv_cache.num_free_tokens() == 24
+    kv_cache.move_row(1, 0, 16)
+    assert kv_cache.row_pages == [[2, 3], []]
+    assert kv_cache.page_table[0, :2].tolist() == [2, 3]
+
+
+def test_scheduler_paged_matches_engine():
+    """With a paged KV cache whose pool is too small for all requests at once, outputs still match Engine."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer)
+    prompts = [[261, 72, 101, 108, 108, 111], [261, 1, 2, 3, 4, 5, 6, 7, 8, 9], [261, 50], [261, 9, 8, 7]]
+    max_tokens = 12
+    expected = []
+    for prompt in prompts:
+        results, _ = engine.generate_batch(prompt, max_tokens=max_tokens, temperature=0.0)
+        expected.append(results[0][len(prompt):])
+
+    # each request needs up to 6 pages of 4 tokens, the pool only has 10
+    scheduler = Scheduler(engine, batch_size=4, seq_len=64, page_size=4, num_pages=10)
+    requests = [scheduler.submit(prompt, max_tokens=max_tokens, temperature=0.0) for prompt in prompts]
+    while scheduler.has_work():
+        scheduler.step()
+    assert scheduler.kv_cache.num_free_tokens() == 40 # everything was returned to the pool
+    ends = (tokenizer.encode_special("<|assistant_end|>"), tokenizer.get_bos_token_id())
+    for request, expected_tokens in zip(requests, expected):
+        tokens = [token for token, _ in request if token not in ends]
+        assert tokens == expected_tokens
+
+
+def test_chunked_prefill_matches_engine():
+    """Prefilling in chunks (Engine) or under a per-step token budget (Scheduler) doesn't change outputs."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    prompts = [[261, 50], list(range(261, 239, -1)), [261, 72, 101, 108, 108, 111], [261, 9, 8, 7, 6, 5, 4, 3, 2]]
+    reference = Engine(model, tokenizer)
+    expected = [reference.generate_batch(prompt, max_tokens=10, temperature=0.0)[0][0][len(prompt):] for prompt in prompts]
+    engine = Engine(model, tokenizer, prefill_chunk_size=4)
+    assert [engine.generate_batch(prompt, max_tokens=10, temperature=0.0)[0][0][len(prompt):] for prompt in prompts] == expected
+    ends = (tokenizer.encode_special("<|assistant_end|>"), tokenizer.get_bos_token_id())
+    for page_size, num_pages in [(None, None), (4, 12)]:
+        scheduler = Scheduler(engine, batch_size=3, seq_len=64, page_size=page_size, num_pages=num_pages)
+        assert scheduler.max_prefill_tokens == 4
+        requests = [scheduler.submit(prompts[0], max_tokens=10, temperature=0.0)]
+        scheduler.step()
+        requests += [scheduler.submit(prompt, max_tokens=10, temperature=0.0) for prompt in prompts[1:]]
+        # the long prompt takes several steps to prefill, the first request keeps decoding meanwhile
+        scheduler.step()
+        assert scheduler.prefilling is requests[1] and requests[0].queue.qsize() == 2
+        while scheduler.has_work():
+            scheduler.step()
+        for request, expected_tokens in zip(requests, expected):
+            assert [token for token, _ in request if token not in ends] == expected_tokens
+
+
+def test_prefix_cache_tree():
+    """Radix tree matching, splitting and LRU eviction under the token budget."""
+    kv_cache = KVCache(batch_size=1, num_heads=1, seq_len=16, head_dim=2, num_layers=1, device="cpu", dtype=torch.float32)
+    kv_cache.k_cache[0, 0, :, 0, 0] = torch.arange(16.0) # KV of position t holds t
+    prefix_cache = PrefixCache(max_tokens=10)
+    prefix_cache.store([1, 2, 3, 4, 5, 6], kv_cache)
+    prefix_cache.store([1, 2, 3, 7, 8], kv_cache) # splits the first edge after [1, 2, 3]
+    assert prefix_cache.num_tokens == 8
+
+    dst = KVCache(batch_size=1, num_heads=1, seq_len=16, head_dim=2, num_layers=1, device="cpu", dtype=torch.float32)
+    assert prefix_cache.load([1, 2, 3, 7, 9], dst) == 4
+    assert dst.get_pos() == 4
+    assert dst.k_cache[0, 0, :4, 0, 0].tolist() == [0.0, 1.0, 2.0, 3.0]
+
+    # [4, 5, 6] is now the least recently used leaf and makes room for the new branch
+    prefix_cache.store([1, 2, 9, 9, 9], kv_cache)
+    assert prefix_cache.num_tokens <= 10
+    assert prefix_cache.load([1, 2, 3, 4, 5, 6], dst) == 3
+    assert prefix_cache.load([1, 2, 3, 7, 8], dst) == 5
+
+
+def test_prefix_cache_engine_matches():
+    """Engine outputs are unchanged by the prefix cache, and a follow-up turn reuses the previous turn."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    prompt = [261, 72, 101, 108, 108, 111]
+    reference = Engine(model, tokenizer)
+    engine = Engine(model, tokenizer, prefix_cache=PrefixCache(max_tokens=1000))
+
+    expected, _ = reference.generate_batch(prompt, max_tokens=10, temperature=0.0)
+    results, _ = engine.generate_batch(prompt, max_tokens=10, temperature=0.0)
+    assert results == expected
+
+    # the second turn continues the first one: everything but the new tokens comes from the cache
+    follow_up = expected[0] + [1, 2, 3]
+    expected, _ = reference.generate_batch(follow_up, max_tokens=10, temperature=0.0)
+    misses = engine.prefix_cache.misses
+    results, _ = engine.generate_batch(follow_up, max_tokens=10, temperature=0.0)
+    assert results == expected
+    assert engine.prefix_cache.misses - misses <= 4 # at most the 3 new tokens + the last reply token
+
+
+def test_scheduler_prefix_cache_matches_engine():
+    """Shared prefixes are loaded from the prefix cache by the Scheduler (also into a paged cache)."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    prefix = [261, 10, 11, 12, 13, 14, 15, 16, 17]
+    prompts = [prefix + [1], prefix + [2, 3], prefix + [4, 5, 6]]
+    reference = Engine(model, tokenizer)
+    expected = [reference.generate_batch(prompt, max_tokens=8, temperature=0.0)[0][0][len(prompt):] for prompt in prompts]
+    for page_size in [None, 4]:
+        engine = Engine(model, tokenizer, prefix_cache=PrefixCache(max_tokens=1000))
+        scheduler = Scheduler(engine, batch_size=2, seq_len=64, page_size=page_size)
+        requests = [scheduler.submit(prompt, max_tokens=8, temperature=0.0) for prompt in prompts]
+        while scheduler.has_work():
+            scheduler.step()
+        assert engine.prefix_cache.hits >= 2 * len(prefix)
+        ends = (tokenizer.encode_special("<|assistant_end|>"), tokenizer.get_bos_token_id())
+        for request, expected_tokens in zip(requests, expected):
+            assert [token for token, _ in request if token not in ends] == expected_tokens
+
+
+def test_speculative_greedy_matches_engine():
+    """Greedy speculative decoding gives exactly the plain Engine output, with a perfect and a poor draft."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    prompt = [261, 72, 101, 108, 108, 111]
+    expected = list(Engine(model, tokenizer).generate(prompt, max_tokens=20, temperature=0.0))
+    for draft_model in [build_tiny_model(), build_tiny_model(seed=1)]:
+        for num_draft_tokens in [1, 3]:
+            engine = Engine(model, tokenizer, draft_model=draft_model, num_draft_tokens=num_draft_tokens)
+            assert list(engine.generate(prompt, max_tokens=20, temperature=0.0)) == expected
+
+
+def test_speculative_sample_matches_target_distribution():
+    """With temperature > 0, accept/resample keeps the emitted token distributed as the target."""
+    torch.manual_seed(0)
+    vocab_size, num_trials = 5, 20000
+    target_logits = torch.randn(2, vocab_size)
+    draft_probs = torch.softmax(torch.randn(1, vocab_size), dim=-1)
+    rng = torch.Generator()
+    rng.manual_seed(0)
+    counts = torch.zeros(vocab_size)
+    for _ in range(num_trials):
+        draft_token = torch.multinomial(draft_probs[0], 1, generator=rng).item()
+        emitted = speculative_sample(target_logits, draft_probs, [draft_token], rng)
+        counts[emitted[0]] += 1
+    expected = torch.softmax(target_logits[0], dim=-1)
+    assert torch.allclose(counts / num_trials, expected, atol=0.02)
+
+
+def test_speculative_tool_use():
+    """Forced calculator tokens are injected in speculative mode, even when the draft guesses wrong."""
+    tokenizer = ByteTokenizer()
+    # <bos> H <python_start> 1 + 1 <python_end> <output_start> 2 <output_end> ! <assistant_end>
+    script = [261, 72, 256, 49, 43, 49, 257, 258, 50, 259, 33, 260]
+    engine = Engine(ScriptedModel(script), tokenizer, draft_model=ScriptedModel(script, wrong=[4, 8, 10]), num_draft_tokens=3)
+    columns = list(engine.generate(script[:2], max_tokens=20, temperature=0.0))
+    assert [column[0] for column, _ in columns] == script[2:]
+    assert [masks[0] for _, masks in columns] == [1, 1, 1, 1, 1, 0, 0, 0, 1, 1]
+
+
+def test_forward_positions_match_full_logits():
+    """Logits computed only at selected positions equal the corresponding full logits."""
+    model = build_tiny_model()
+    idx = torch.randint(0, 256, (3, 10))
+    with torch.no_grad():
+        logits = model(idx)
+        assert torch.allclose(model(idx, positions=-1), logits[:, -1:])
+        positions = torch.tensor([9, 0, 4])
+        assert torch.allclose(model(idx, positions=positions), logits[torch.arange(3), positions].unsqueeze(1))
+        positions = torch.tensor([[1, 2], [3, 4], [8, 9]])
+        assert torch.allclose(model(idx, positions=positions), logits.gather(1, positions.unsqueeze(-1).expand(-1, -1, logits.size(-1))))
+
+
+def test_chunked_cross_entropy_matches():
+    """The chunked loss gives the same losses and gradients as the full logits path, for every reduction."""
+    model = build_tiny_model()
+    idx = torch.randint(0, 256, (2, 12))
+    targets = torch.randint(0, 256, (2, 12))
+    targets[0, :3] = -1 # some ignored positions
+    for reduction in ['mean', 'sum', 'none']:
+        results = []
+        for loss_chunk_size in [None, 5]:
+            model.loss_chunk_size = loss_chunk_size
+            model.zero_grad()
+            loss = model(idx, targets, loss_reduction=reduction)
+            loss.sum().backward()
+            results.append((loss.detach(), model.lm_head.weight.grad.clone(), model.transformer.wte.weight.grad.clone()))
+        for expected, actual in zip(*results):
+            assert expected.shape == actual.shape
+            assert torch.allclose(expected, actual, atol=1e-5, rtol=1e-4)
+    model.loss_chunk_size = None
+
+
+def test_sample_tokens_distribution_and_filters():
+    """Gumbel-max sampling follows softmax(logits / T), and top_k / top_p / min_p mask the right tokens per row."""
+    torch.manual_seed(0)
+    logits = torch.randn(1, 6) * 2
+    num_rows = 20000
+    keys = rng_keys(torch.full((num_rows,), 7), torch.arange(num_rows))
+    temperature = torch.full((num_rows,), 1.5)
+    tokens = sample_tokens(logits.expand(num_rows, -1), keys, 3, temperature)
+    frequencies = torch.bincount(tokens, minlength=6).float() / num_rows
+    assert torch.allclose(frequencies, torch.softmax(logits[0] / 1.5, dim=-1), atol=0.02)
+    # same keys and step => same samples, another step => different samples
+    assert torch.equal(sample_tokens(logits.expand(num_rows, -1), keys, 3, temperature), tokens)
+    assert not torch.equal(sample_tokens(logits.expand(num_rows, -1), keys, 4, temperature), tokens)
+
+    # per-row filters: probabilities 0.5, 0.25, 0.15, 0.1
+    logits = torch.tensor([0.5, 0.25, 0.15, 0.1]).log().expand(4, -1)
+    kept = lambda **kwargs: torch.isfinite(filter_logits(logits, **kwargs)).sum(dim=-1).tolist()
+    assert kept(top_k=torch.tensor([1, 2, 0, 10])) == [1, 2, 4, 4]
+    assert kept(top_p=torch.tensor([0.5, 0.6, 0.8, 1.0])) == [1, 2, 3, 4]
+    assert kept(min_p=torch.tensor([0.0, 0.3, 0.5, 0.9])) == [4, 3, 2, 1]
+    assert kept(top_k=torch.tensor([3, 3, 0, 0]), top_p=torch.tensor([0.5, 1.0, 0.6, 1.0])) == [1, 3, 2, 4]
+
+    # sampling among the top_k candidates only draws the same tokens as sampling over the whole vocabulary
+    logits = torch.randn(64, 1000) * 3
+    keys = rng_keys(torch.full((64,), 5), torch.arange(64))
+    sampling = sampling_params("cpu", [1.0] * 64, [5, 50] * 32, 0.9, 0.05)
+    assert sampling["num_candidates"] == 50
+    tokens = sample_tokens(logits, keys, 2, **sampling)
+    assert torch.equal(tokens, sample_tokens(logits, keys, 2, **{**sampling, "num_candidates": None}))
+    assert tokens[1].item() == sample_tokens(logits[1:2], keys[1:2], 2, **sampling_params("cpu", 1.0, 50, 0.9, 0.05)).item()
+
+
+def test_scheduler_mixed_sampling_settings():
+    """Requests with different settings share a batch, a greedy request still matches the Engine."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer)
+    prompt = [261, 72, 101, 108, 108, 111]
+    expected = list(engine.generate(prompt, max_tokens=10, temperature=0.0))
+    scheduler = Scheduler(engine, batch_size=3, seq_len=64)
+    greedy = scheduler.submit(prompt, max_tokens=10, temperature=0.0)
+    scheduler.submit(prompt, max_tokens=10, temperature=1.0, top_p=0.9, seed=1)
+    scheduler.submit(prompt, max_tokens=10, temperature=0.7, top_k=5, min_p=0.1, seed=2)
+    while scheduler.has_work():
+        scheduler.step()
+    assert [([token], [mask]) for token, mask in greedy] == expected
+
+
+def test_scheduler_request_callback():
+    """A request with a callback gets its tokens handed over through it, driven from another thread."""
+    import threading
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer)
+    prompt = [261, 72, 101, 108, 108, 111]
+    expected = [(column[0], masks[0]) for column, masks in engine.generate(prompt, max_tokens=10, temperature=0.0)]
+    scheduler = Scheduler(engine, batch_size=2, seq_len=64)
+    items = []
+    scheduler.submit(prompt, max_tokens=10, temperature=0.0, callback=items.append)
+    thread = threading.Thread(target=lambda: [scheduler.step() for _ in iter(scheduler.has_work, False)])
+    thread.start()
+    thread.join()
+    assert items == expected + [None]
+
+
+def test_scheduler_abort_after_failed_step():
+    """After a step raises, abort ends its requests with the error and the Scheduler serves the next ones."""
+    model = build_tiny_model()
+    engine = Engine(model, ByteTokenizer())
+    prompt = [261, 72, 101, 108, 108, 111]
+    expected = [(column[0], masks[0]) for column, masks in engine.generate(prompt, max_tokens=10, temperature=0.0)]
+    scheduler = Scheduler(engine, batch_size=2, seq_len=64)
+    forward = model.forward
+    def failing_forward(*args, **kwargs):
+        raise RuntimeError("device lost")
+    requests = [scheduler.submit(prompt, max_tokens=10, temperature=0.0) for _ in range(2)]
+    scheduler.step()
+    model.forward = failing_forward
+    with pytest.raises(RuntimeError):
+        scheduler.step()
+    model.forward = forward
+    scheduler.abort(RuntimeError("device lost"))
+    assert not scheduler.has_work()
+    for request in requests:
+        with pytest.raises(RuntimeError, match="device lost"):
+            list(request)
+    request = scheduler.submit(prompt, max_tokens=10, temperature=0.0)
+    while scheduler.has_work():
+        scheduler.step()
+    assert list(request) == expected
+
+
+def test_ring_kv_cache_matches_full_generation():
+    """Generating well past the sliding window with ring buffers for the S layers matches the uncached model."""
+    model = build_tiny_model() # window_pattern "SL" => layer 0 has a window of 32
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer, ring_kv_cache=True) # the default without FA3
+    assert Engine(model, tokenizer, ring_kv_cache=False).window_sizes() is None
+    cache = engine.new_kv_cache(2, 64, torch.device("cpu"), torch.float32, window_sizes=engine.window_sizes())
+    assert cache.is_ring_layer(0) and not cache.is_ring_layer(1)
+    assert cache.get_layer_cache(0)[0].shape == (2, 33, 2, 16) and cache.get_layer_cache(1)[0].shape == (2, 64, 2, 16)
+
+    prompt = [261, 72, 101, 108, 108, 111]
+    expected = list(model.generate(prompt, max_tokens=50, temperature=0.0))
+    results, _ = engine.generate_batch(prompt, num_samples=2, max_tokens=50, temperature=0.0)
+    for result in results:
+        assert result[len(prompt):] == expected[:len(result) - len(prompt)]
+
+
+def test_kv_cache_grows_on_reserve():
+    """A KVCache with a small capacity grows geometrically on reserve(), keeping its contents."""
+    cache = KVCache(batch_size=2, num_heads=2, seq_len=100, head_dim=4, num_layers=2, device="cpu", dtype=torch.float32, capacity=8)
+    assert cache.k_cache.shape == (2, 2, 8, 2, 4)
+    k = torch.randn(2, 6, 2, 4)
+    cache.write_row(1, 0, k, k + 1)
+    cache.cache_seqlens[1] = 6
+    cache.reserve(1, 8) # fits, no growth
+    assert cache.capacity == 8
+    cache.reserve(1, 9) # doubles
+    assert cache.capacity == 16 and cache.k_cache.shape == (2, 2, 16, 2, 4)
+    cache.reserve(0, 90) # jumps straight to what's asked for, capped at seq_len
+    assert cache.capacity == 90
+    cache.reserve(0, 100)
+    assert cache.capacity == 100
+    k_read, v_read = cache.read_row(1, 0, 6)
+    assert torch.equal(k_read, k) and torch.equal(v_read, k + 1)
+    assert cache.get_layer_cache(1)[0] is cache.k_layers[1]
+
+
+def test_ring_layers_grow_on_reserve():
+    """Ring buffers are allocated lazily too, and only become rings once they reach their ring size."""
+    cache = KVCache(batch_size=1, num_heads=2, seq_len=100, head_dim=4, num_layers=2, device="cpu", dtype=torch.float32, window_sizes=[9, -1], capacity=4)
+    assert [k.size(1) for k in cache.k_layers] == [4, 4] and not cache.is_ring_layer(0)
+    k = torch.randn(2, 4, 2, 4)
+    cache.write_row(0, 0, k, k)
+    cache.reserve(0, 8)
+    assert [k.size(1) for k in cache.k_layers] == [8, 8] and not cache.is_ring_layer(0)
+    cache.reserve(0, 30) # the ring stops at window + 1 slots
+    assert [k.size(1) for k in cache.k_layers] == [10, 30] and cache.is_ring_layer(0)
+    cache.cache_seqlens[0] = 4
+    assert torch.equal(cache.read_row(0, 0, 4)[0], k)
+
+
+def test_growing_kv_cache_matches_full_generation():
+    """Engine and Scheduler outputs with lazily grown caches (including ring layers) match the uncached model."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer)
+    assert engine.kv_dtype() == torch.float32
+    prompt = [261, 72, 101, 108, 108, 111]
+    expected = list(model.generate(prompt, max_tokens=50, temperature=0.0))
+    results, _ = engine.generate_batch(prompt, num_samples=2, max_tokens=50, temperature=0.0)
+    for result in results:
+        assert result[len(prompt):] == expected[:len(result) - len(prompt)]
+    scheduler = Scheduler(engine, batch_size=2)
+    request = scheduler.submit(prompt, max_tokens=50, temperature=0.0)
+    while scheduler.has_work():
+        scheduler.step()
+    tokens = [token for token, _ in request]
+    assert tokens == expected[:len(tokens)]
+
+
+def test_generate_drops_finished_rows():
+    """Finished rows leave the decode batch, the live rows sample exactly what the uncached model gives them."""
+    model = build_tiny_model()
+    forward, batch_sizes = model.forward, []
+    def biased_forward(ids, *args, **kwargs):
+        # make <|assistant_end|> likely so the rows finish at different steps
+        logits = forward(ids, *args, **kwargs)
+        logits[..., 260] += 4.0
+        if kwargs.get("kv_cache") is not None:
+            batch_sizes.append(ids.size(0))
+        return logits
+    model.forward = biased_forward
+    engine = Engine(model, ByteTokenizer())
+    prompt = [261, 72, 101, 108, 108, 111]
+    num_samples, seed = 8, 3
+    rows = [[] for _ in range(num_samples)]
+    for token_column, _ in engine.generate(prompt, num_samples=num_samples, max_tokens=30, temperature=1.0, seed=seed):
+        for row, token in zip(rows, token_column):
+            if not row or row[-1] != 260:
+                row.append(token)
+    batch_sizes = batch_sizes[1:] # skip the prefill
+    assert sorted(batch_sizes, reverse=True) == batch_sizes and batch_sizes[-1] < num_samples
+    keys = rng_keys(torch.full((num_samples,), seed), torch.arange(num_samples))
+    temperature = torch.ones(1)
+    for i, row in enumerate(rows):
+        for step, token in enumerate(row):
+            logits = biased_forward(torch.tensor([prompt + row[:step]]))[:, -1]
+            assert sample_tokens(logits, keys[i:i + 1], step, temperature).item() == token
+
+
+def test_generate_batch_multiple_prompts():
+    """A list of ragged prompts decoded together gives every prompt the samples it gets on its own."""
+    model = build_tiny_model()
+    engine = Engine(model, ByteTokenizer())
+    prompts = [[261, 72, 101, 108, 108, 111], [261, 1, 2, 3, 4, 5, 6, 7, 8, 9], [261, 50]]
+    num_samples = [3, 1, 2]
+    kwargs = dict(max_tokens=10, temperature=1.0, top_k=50, seed=7)
+    results, masks = engine.generate_batch(prompts, num_samples=num_samples, batch_size=4, **kwargs)
+    assert [len(r) for r in results] == num_samples
+    for prompt, n, prompt_results, prompt_masks in zip(prompts, num_samples, results, masks):
+        expected, expected_masks = engine.generate_batch(prompt, num_samples=n, **kwargs)
+        assert prompt_results == expected and prompt_masks == expected_masks
+
+
+def test_tool_calls_run_in_background(monkeypatch):
+    """A row waiting for a slow tool call doesn't hold up the others, and timeouts work off the main thread."""
+    eval_formula = engine_module.eval_formula
+    def slow_eval_formula(formula):
+        time.sleep(0.5)
+        return eval_formula(formula)
+    monkeypatch.setattr(engine_module, "eval_formula", slow_eval_formula)
+    tokenizer = ByteTokenizer()
+    # <bos> H <python_start> 1 + 1 <python_end> <output_start> 2 <output_end> ! <assistant_end>
+    script = [261, 72, 256, 49, 43, 49, 257, 258, 50, 259, 33, 260]
+    engine = Engine(ScriptedModel(script), tokenizer)
+    scheduler = Scheduler(engine, batch_size=2, seq_len=32)
+    t0 = time.monotonic()
+    finish_times = {}
+    callback = lambda name: lambda item: finish_times.setdefault(name, time.monotonic() - t0) if item is None else None
+    tool_request = scheduler.submit(script[:2], temperature=0.0)
+    other_request = scheduler.submit(script[:9], temperature=0.0, callback=callback("other"))
+    while scheduler.has_work():
+        scheduler.step()
+    assert [token for token, _ in tool_request] == script[2:]
+    assert finish_times["other"] < 0.4 # done while the tool call was still running
+    # the same in Engine.generate, where the rows wait in lockstep
+    results, masks = engine.generate_batch(script[:2], num_samples=2, temperature=0.0)
+    assert results == [script[:-1]] * 2 and masks[0][7:10] == [0, 0, 0]
+
+    # a call that misses its deadline gives no result, also from a thread other than the main one
+    results = []
+    thread = threading.Thread(target=lambda: results.append((ToolCall("1+1", max_time=0.1).result(), use_calculator("2*3"))))
+    thread.start()
+    thread.join()
+    assert results == [(None, 6)]
+
+
+def test_tool_cache():
+    """Repeated tool calls are served from a bounded LRU of result tokens."""
+    tokenizer = ByteTokenizer()
+    script = [261, 72, 256, 49, 43, 49, 257, 258, 50, 259, 33, 260]
+    engine = Engine(ScriptedModel(script), tokenizer, tool_cache_size=2)
+    for _ in range(3):
+        results, _ = engine.generate_batch(script[:2], temperature=0.0)
+        assert results[0] == script[:-1]
+    assert (engine.tool_cache.hits, engine.tool_cache.misses) == (2, 1)
+    assert engine.tool_cache.get(" 1 + 1") == (50,) # spaces don't matter in math
+    cache = engine.tool_cache
+    cache.put("'a b'.count(' ')", [49])
+    cache.put("2*3", [54])
+    assert cache.get("1+1") is None and cache.get("'ab'.count(' ')") is None # evicted, different string
+    assert cache.get("'a b'.count(' ')") == (49,)
+
+
+def test_session_resumes_conversation(tmp_path):
+    """A session continues the conversation exactly, also after a save/load, prefilling only the new tokens."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    reference = Engine(model, tokenizer)
+    engine = Engine(model, tokenizer)
+    num_forwarded = []
+    forward = model.forward
+    def counting_forward(ids, *args, **kwargs):
+        num_forwarded.append(ids.size(1))
+        return forward(ids, *args, **kwargs)
+    model.forward = counting_forward
+
+    session = Session(engine, "test", tokens=[261, 72, 101, 108, 108, 111])
+    for turn in range(2):
+        expected, _ = reference.generate_batch(list(session.tokens), max_tokens=6, temperature=0.0)
+        num_forwarded.clear()
+        for token_column, _ in session.generate(max_tokens=6, temperature=0.0):
+            session.tokens.append(token_column[0])
+        assert session.tokens == expected[0]
+        if turn == 1:
+            assert num_forwarded[0] == 4 # the 3 new tokens + the last reply token
+        session.tokens.extend([1, 2, 3])
+    path = session.save(str(tmp_path / "test.pt"))
+
+    resumed = Session(engine, "test")
+    assert resumed.load(path) == session.num_cached()
+    assert resumed.tokens == session.tokens
+    expected, _ = reference.generate_batch(list(resumed.tokens), max_tokens=6, temperature=0.0)
+    num_forwarded.clear()
+    for token_column, _ in resumed.generate(max_tokens=6, temperature=0.0):
+        resumed.tokens.append(token_column[0])
+    assert resumed.tokens == expected[0]
+    assert num_forwarded[0] == 4
+
+
+def test_scheduler_session(tmp_path):
+    """Requests with a session path save their conversation and the next turn restores it, also into a paged cache."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    reference = Engine(model, tokenizer)
+    ends = (tokenizer.encode_special("<|assistant_end|>"), tokenizer.get_bos_token_id())
+    num_forwarded = []
+    forward = model.forward
+    def counting_forward(ids, *args, **kwargs):
+        num_forwarded.append(ids.size(1))
+        return forward(ids, *args, **kwargs)
+    for page_size in [None, 4]:
+        path = str(tmp_path / f"session_{page_size}.pt")
+        scheduler = Scheduler(Engine(model, tokenizer), batch_size=2, seq_len=64, page_size=page_size)
+        tokens = [261, 10, 11, 12]
+        for turn in range(2):
+            expected, _ = reference.generate_batch(tokens, max_tokens=6, temperature=0.0)
+            request = scheduler.submit(tokens, max_tokens=6, temperature=0.0, session_path=path)
+            num_forwarded.clear()
+            model.forward = counting_forward
+            while scheduler.has_work():
+                scheduler.step()
+            model.forward = forward
+            reply = [token for token, _ in request]
+            assert [token for token in reply if token not in ends] == expected[0][len(tokens):]
+            if turn == 1:
+                assert num_forwarded[0] == 3 # the 2 new tokens + the last reply token
+            tokens = tokens + reply + [1, 2]
+        assert restore_session(path, tokens, KVCache(1, 2, 64, 16, 2, "cpu", torch.float32), fingerprint=model_fingerprint(model)) == len(tokens) - 3
+
+
+def test_session_is_only_restored_by_its_model(tmp_path):
+    """A session's KV is only restored into a KV cache of the same layout, for the model that computed it."""
+    model = build_tiny_model()
+    path = str(tmp_path / "session.pt")
+    tokens = [261, 10, 11, 12]
+    cache = KVCache(1, 2, 64, 16, 2, "cpu", torch.float32)
+    with torch.no_grad():
+        model.forward(torch.tensor([tokens]), kv_cache=cache)
+    save_session(path, tokens, cache, fingerprint=model_fingerprint(model))
+    assert restore_session(path, tokens, KVCache(1, 2, 64, 16, 2, "cpu", torch.float32), fingerprint=model_fingerprint(model)) == 4
+    assert restore_session(path, tokens, KVCache(1, 2, 64, 16, 2, "cpu", torch.bfloat16), fingerprint=model_fingerprint(model)) == 0
+    other = build_tiny_model()
+    with torch.no_grad():
+        other.lm_head.weight.mul_(2) # another checkpoint of the same shape
+    assert restore_session(path, tokens, KVCache(1, 2, 64, 16, 2, "cpu", torch.float32), fingerprint=model_fingerprint(other)) == 0
+    model.set_rope_scaling("ntk", 2.0)
+    assert restore_session(path, tokens, KVCache(1, 2, 64, 16, 2, "cpu", torch.float32), fingerprint=model_fingerprint(model)) == 0
+
+
+def test_beam_search():
+    """One beam is greedy decoding, wider beams are scored consistently with their KV rows taken over correctly."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer)
+    prompt = [261, 72, 101, 108, 108, 111]
+    expected, _ = engine.generate_batch(prompt, max_tokens=8, temperature=0.0)
+    results, masks, _ = engine.beam_search(prompt, num_beams=1, max_tokens=8)
+    assert results == expected
+
+    results, masks, scores = engine.beam_search(prompt, num_beams=4, max_tokens=5, length_penalty=0.0)
+    assert len(results) == 4 and len(set(map(tuple, results))) == 4
+    assert scores == sorted(scores, reverse=True)
+    logprobs = engine.score(prompt, [result[len(prompt):] for result in results])
+    for result, mask, score, row_logprobs in zip(results, masks, scores, logprobs):
+        assert result[:len(prompt)] == prompt and len(mask) == len(result)
+        if len(result) == len(prompt) + 5: # did not end early: the score is the sum of the log-probs of its tokens
+            assert abs(sum(row_logprobs) - score) < 1e-3
+    greedy_score = sum(engine.score(prompt, [expected[0][len(prompt):len(prompt) + 5]])[0])
+    assert scores[0] >= greedy_score - 1e-3
+
+
+def test_best_of_n():
+    """Best-of-n returns the samples of generate_batch ranked by their log-probability."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer)
+    prompt = [261, 72, 101, 108, 108, 111]
+    samples, _ = engine.generate_batch(prompt, num_samples=4, max_tokens=6, temperature=1.0, seed=1)
+    results, masks, scores = engine.best_of_n(prompt, 4, length_penalty=0.0, max_tokens=6, temperature=1.0, seed=1)
+    assert sorted(results) == sorted(samples)
+    assert scores == sorted(scores, reverse=True)
+    assert abs(scores[0] - sum(engine.score(prompt, [results[0][len(prompt):]])[0])) < 1e-4
+
+
+def test_generate_logprobs():
+    """Log-probs from generation match a separate scoring pass, in Engine.generate and on the Scheduler."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer)
+    prompt = [261, 72, 101, 108, 108, 111]
+    results, masks, logprobs = engine.generate_batch(prompt, num_samples=3, max_tokens=6, temperature=1.0, logprobs=True)
+    for result, row_logprobs in zip(results, logprobs):
+        assert len(row_logprobs) == len(result) and row_logprobs[:len(prompt)] == [0.0] * len(prompt)
+        expected = engine.score(prompt, [result[len(prompt):]])[0]
+        assert all(abs(a - b) < 1e-4 for a, b in zip(row_logprobs[len(prompt):], expected))
+    _, _, prompt_logprobs = engine.generate_batch([prompt, prompt[:3]], num_samples=3, max_tokens=6, temperature=1.0, logprobs=True)
+    assert all(abs(a - b) < 1e-4 for row, expected in zip(prompt_logprobs[0], logprobs) for a, b in zip(row, expected))
+
+    # greedy tokens are the most likely alternative
+    for token_column, _, logprob_column in engine.generate(prompt, max_tokens=4, temperature=0.0, top_logprobs=3):
+        logprob, top = logprob_column[0]
+        assert len(top) == 3 and top[0] == (token_column[0], logprob)
+    scheduler = Scheduler(engine, batch_size=2)
+    request = scheduler.submit(prompt, max_tokens=4, temperature=0.0, top_logprobs=2)
+    while scheduler.has_work():
+        scheduler.step()
+    for token, _, (logprob, top) in request:
+        assert len(top) == 2 and top[0] == (token, logprob)
+
+
+def test_stop_strings():
+    """A row ends with the token that completes a stop string, in Engine.generate and on the Scheduler."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer)
+    prompt = [261, 72, 101, 108, 108, 111]
+    full, _ = engine.generate_batch(prompt, max_tokens=12, temperature=0.0)
+    generated = full[0][len(prompt):]
+    stop = tokenizer.decode(generated[3:5])
+    end = next(n for n in range(len(generated) + 1) if stop in tokenizer.decode(generated[:n]))
+    expected = full[0][:len(prompt) + end]
+    results, _ = engine.generate_batch(prompt, max_tokens=12, temperature=0.0, stop=["never", stop])
+    assert results[0] == expected
+    results, _ = engine.generate_batch([prompt], max_tokens=12, temperature=0.0, stop=[stop])
+    assert results[0][0] == expected
+
+
+def test_constrained_decoding():
+    """Constrained rows only ever generate matches of their regex and end as soon as they can't go on."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    engine = Engine(model, tokenizer)
+    prompt = [261, 72, 101, 108, 108, 111]
+    constraint = RegexConstraint(tokenizer, 262, r"#### -?[0-9]{1,3}")
+    assert constraint.allowed("").nonzero().flatten().tolist() == [ord("#")]
+    assert constraint.allowed("#### ").nonzero().flatten().tolist() == [ord("-")] + list(range(ord("0"), ord("9") + 1))
+    results, _ = engine.generate_batch(prompt, num_samples=4, max_tokens=20, temperature=1.0, constraint=constraint)
+    for result in results:
+        assert constraint.is_complete(tokenizer.decode(result[len(prompt):]))
+
+    choices = ["yes", "no", "maybe"]
+    constraint = choice_constraint(tokenizer, 262, choices)
+    results, _ = engine.generate_batch([prompt, prompt[:2]], num_samples=3, max_tokens=20, temperature=1.0, constraint=constraint)
+    for prompt_results, p in zip(results, [prompt, prompt[:2]]):
+        for result in prompt_results:
+            assert tokenizer.decode(result[len(p):]) in choices
+
+
+def test_gpt_generate_matches_naive_and_engine():
+    """The KV cached GPT.generate matches re-forwarding the whole sequence every step, and the Engine."""
+    model = build_tiny_model()
+    engine = Engine(model, ByteTokenizer())
+    prompt = [261, 72, 101, 108, 108, 111]
+    ids = torch.tensor([prompt])
+    naive = []
+    with torch.inference_mode():
+        for _ in range(40): # longer than the sliding window (ring buffer) of the first layer
+            next_id = model.forward(ids)[:, -1, :].argmax(dim=-1, keepdim=True)
+            ids = torch.cat((ids, next_id), dim=1)
+            naive.append(next_id.item())
+    assert list(model.generate(prompt, max_tokens=40, temperature=0.0)) == naive
+    expected, _ = engine.generate_batch(prompt, max_tokens=40, temperature=0.0)
+    assert prompt + naive[:len(expected[0]) - len(prompt)] == expected[0]
+    sampled = list(model.generate(prompt, max_tokens=10, temperature=1.0, top_k=20, seed=3))
+    assert sampled == list(model.generate(prompt, max_tokens=10, temperature=1.0, top_k=20, seed=3))
+
+
+def test_rotary_tables_grow_and_are_shared():
+    """The rotary tables are shared by the models of a process and grow past the trained sequence length."""
+    model, other = build_tiny_model(), build_tiny_model(seed=1)
+    assert model.cos is other.cos # one table for both
+    ids = torch.randint(0, 256, (1, 200)) # the tiny model trained on 64 tokens
+    with torch.inference_mode():
+        logits = model.forward(ids)
+        assert model.cos.size(1) >= 200
+        # growing the tables doesn't change the positions that were there before
+        torch.testing.assert_close(model.forward(ids[:, :32]), logits[:, :32])
+        other.forward(ids) # picks up the grown table instead of computing its own
+    assert model.cos is other.cos
+
+
+def test_rope_scaling():
+    """NTK and YaRN scaling stretch the context, and are the plain rotary embeddings at factor 1."""
+    model = build_tiny_model()
+    engine = Engine(model, ByteTokenizer())
+    ids = torch.randint(0, 256, (1, 48))
+    with torch.inference_mode():
+        expected = model.forward(ids)
+        for mode in ["ntk", "yarn"]:
+            torch.testing.assert_close(model.set_rope_scaling(mode, 1).forward(ids), expected)
+            scaled = model.set_rope_scaling(mode, 4).forward(ids)
+            assert not torch.allclose(scaled, expected)
+            assert model.context_len == 256 and model.window_sizes == [(128, 0), (256, 0)]
+            # the engine generates past the trained sequence length, same as re-forwarding everything
+            results, _ = engine.generate_batch([261] + list(range(65, 165)), max_tokens=100, temperature=0.0)
+            assert len(results[0]) > 64
+            prompt = results[0][:-1]
+            naive = model.forward(torch.tensor([prompt]))[0, -1].argmax().item()
+            assert naive == results[0][-1] or results[0][-1] in (256, 257) # the last token could have been forced as a terminal one
+        torch.testing.assert_close(model.set_rope_scaling(None, 1).forward(ids), expected)
+    assert model.context_len == 64
+
+
+def test_compiled_decode_matches_eager():
+    """The compiled decode step (padded batch buckets, full length caches) generates the same tokens as eager decoding."""
+    model = build_tiny_model()
+    tokenizer = ByteTokenizer()
+    eager = Engine(model, tokenizer)
+    engine = Engine(model, tokenizer, compile_decode=True)
+    engine.decode_step = DecodeStep(model, backend="aot_eager") # inductor takes minutes to compile on CPU
+    prompt = [261, 72, 101, 108, 108, 111]
+    engine.warmup(3, engine.window_sizes())
+    engine.warmup(4) # the Scheduler layout
+    with torch._dynamo.config.patch(error_on_recompile=True): # warmup compiled every shape there is
+        # rows finish at different steps, so the batch shrinks and gets padded
+        for kwargs in [dict(temperature=0.0), dict(temperature=1.0, top_k=20, seed=5)]:
+            expected, _ = eager.generate_batch(prompt, num_samples=3, max_tokens=30, **kwargs)
+            assert engine.generate_batch(prompt, num_samples=3, max_tokens=30, **kwargs)[0] == expected
+        # continuous batching: requests come and go, a long prompt is prefilled in chunks next to the decoding rows
+        prompts = [prompt, [261] + list(range(1, 20)), [261, 50], [261, 9, 8, 7]]
+        outputs = []
+        for e in (eager, engine):
+            scheduler = Scheduler(e, batch_size=4, max_prefill_tokens=4)
+            requests = [scheduler.submit(p, max_tokens=5 + 3 * i, temperature=0.0) for i, p in enumerate(prompts)]
+            while scheduler.has_work():
+                scheduler.step()
+            outputs.append([list(request) for request in requests])
+        assert outputs[0] == outputs[1]
+
+
+def test_session_store_is_pruned(tmp_path):
+    """Background session saves don't clash, and the store keeps only the most recently used sessions."""
+    cache = KVCache(1, 2, 64, 16, 2, "cpu", torch.float32)
+    cache.cache_seqlens[0] = 4
+    futures = [save_session(str(tmp_path / f"s{i}.pt"), [261, 1, 2, 3], cache, background=True, max_sessions=2) for i in range(4)]
+    for future in futures:
+        future.result()
+    assert sorted(os.listdir(tmp_path)) == ["s2.pt", "s3.pt"] # no leftover tmp files either
+    os.utime(tmp_path / "s3.pt", (time.time() - 10, time.time() - 10)) # s2 used more recently than s3
+    size = os.path.getsize(tmp_path / "s2.pt")
+    save_session(str(tmp_path / "s4.pt"), [261, 1, 2, 3], cache, max_bytes=2 * size)
+    assert sorted(os.listdir(tmp_path)) == ["s2.pt", "s4.pt"]
+
+
+def test_rotary_tables_key_on_the_device():
+    """Device names that refer to the same device share one rotary table."""
+    assert rotary_embeddings(16, 8, "cpu")[0] is rotary_embeddings(16, 8, torch.device("cpu"))[0]
@@ -0,0 +1,80 @@
+"""
+Test weight-only quantization. Example run:
+
+python -m pytest tests/test_quantize.py -v
+"""
+
+import torch
+import torch.nn as nn
+import pytest
+from nanochat.gpt import GPT, GPTConfig
+from nanochat.quantize import QuantizedLinear, quantize_model
+
+
+def build_tiny_model():
+    config = GPTConfig(sequence_len=64, vocab_size=256, n_layer=2, n_head=4, n_kv_head=2, n_embd=128, window_pattern="SL")
+    torch.manual_seed(0)
+    model = GPT(config)
+    model.init_weights()
+    with torch.no_grad():
+        for name, p in model.named_parameters():
+            if p.ndim == 2:
+                torch.nn.init.normal_(p, std=0.5 if "wte" in name or "lm_head" in name else 0.1)
+    model.eval()
+    return model
+
+
+@pytest.mark.parametrize("bits,group_size,tolerance", [(8, None, 0.01), (4, 32, 0.1), (4, 128, 0.15)])
+def test_quantized_linear_matches_linear(bits, group_size, tolerance):
+    """The fused kernels and the explicit dequantization agree with the float layer up to the quantization error."""
+    torch.manual_seed(0)
+    linear = nn.Linear(128, 96, bias=False)
+    quantized = QuantizedLinear.from_linear(linear, bits, group_size)
+    assert torch.allclose(quantized.dequantize(), linear.weight, atol=tolerance * linear.weight.abs().max().item())
+    x = torch.randn(2, 5, 128)
+    expected = linear(x)
+    y = quantized(x) # CPU kernel where available
+    y_dequantized = nn.functional.linear(x, quantized.dequantize())
+    assert y.shape == expected.shape
+    assert torch.allclose(y, y_dequantized, atol=1e-4, rtol=1e-4)
+    assert (y - expected).norm() / expected.norm() < tolerance
+
+
+@pytest.mark.parametrize("quantize", ["int8", "int4"])
+def test_quantized_model_state_dict_round_trip(quantize):
+    """A quantized model stays close to the float one, and its state dict loads into empty quantized modules."""
+    model = build_tiny_model()
+    idx = torch.randint(0, 256, (2, 16))
+    expected = model(idx)
+    quantize_model(model, quantize)
+    assert isinstance(model.lm_head, QuantizedLinear) and isinstance(model.transformer.h[0].attn.c_q, QuantizedLinear)
+    logits = model(idx)
+    agreement = (logits.argmax(-1) == expected.argmax(-1)).float().mean().item()
+    assert agreement > (0.9 if quantize == "int8" else 0.6)
+
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    reloaded = build_tiny_model()
+    quantize_model(reloaded, quantize, empty=True)
+    reloaded.load_state_dict(state_dict, strict=True, assign=True)
+    assert torch.equal(reloaded(idx), logits)
+
+
+@pytest.mark.parametrize("quantize", [None, "int8", "int4"])
+def test_fuse_qkv(quantize):
+    """Fused q, k, v projections give the same logits and keep the unfused state dict layout."""
+    model = build_tiny_model()
+    if quantize is not None:
+        quantize_model(model, quantize)
+    idx = torch.randint(0, 256, (2, 16))
+    expected = model(idx)
+    state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+    model.fuse_qkv()
+    attn = model.transformer.h[0].attn
+    assert attn.c_qkv is not None and not hasattr(attn, "c_q")
+    assert torch.allclose(model(idx), expected, atol=1e-5)
+    fused_state_dict = model.state_dict()
+    assert fused_state_dict.keys() == state_dict.keys()
+    assert all(torch.equal(fused_state_dict[k], v) for k, v in state_dict.items())
+    # loading an unfused state dict into the fused model
+    model.load_state_dict(state_dict)
+    assert torch.allclose(model(idx), expected, atol=1e-5)
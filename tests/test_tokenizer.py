@@ -0,0 +1,27 @@
+"""
+Test the streaming decoder. Example run:
+
+python -m pytest tests/test_tokenizer.py -v
+"""
+
+from nanochat.tokenizer import StreamDecoder
+
+
+def test_stream_decoder_holds_back_partial_characters():
+    """Multi-byte characters split across tokens are only emitted once complete."""
+    text = "héllo 👋 wörld"
+    data = text.encode("utf-8")
+    # one byte per token splits every multi-byte character
+    decoder = StreamDecoder(lambda token: bytes([token]))
+    pieces = [decoder.step(b) for b in data]
+    assert "".join(pieces) + decoder.flush() == text
+    assert all("�" not in piece for piece in pieces)
+    assert pieces[data.index("👋".encode("utf-8")) + 3] == "👋" # the emoji arrives with its last byte
+
+
+def test_stream_decoder_flushes_incomplete_tail():
+    """A stream cut in the middle of a character ends with a replacement character."""
+    decoder = StreamDecoder(lambda token: token)
+    assert decoder.step(b"ok ") == "ok "
+    assert decoder.step("👋".encode("utf-8")[:2]) == ""
+    assert decoder.flush() == "�"